@@ -1,22 +1,100 @@
+import asyncio
+import atexit
+import bisect
+import contextvars
+import heapq
+import csv
+import json
 import logging
+import logging.handlers
+import math
+import multiprocessing
 import os
+import queue
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
 from datetime import datetime
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton
+from telegram import Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, 
-    ConversationHandler, ContextTypes, CallbackQueryHandler
+    ConversationHandler, ContextTypes, CallbackQueryHandler, TypeHandler,
+    BasePersistence, PersistenceInput, ApplicationHandlerStop
 )
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from telegram.error import BadRequest
 from dotenv import load_dotenv 
 
-# Enable logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# gspread and oauth2client are heavy to import, so they are imported lazily
+# inside the Google Sheets helpers below (first use happens during warm-up).
+
+# Process start time, used to measure readiness and time-to-first-response
+PROCESS_START = time.monotonic()
+
 logger = logging.getLogger(__name__)
+# Per-step diagnostics from the conversation handlers; DEBUG records here are sampled
+hot_logger = logging.getLogger(f"{__name__}.hot")
 
 # Load environment variables
 load_dotenv()
 
+# Root log level, and per-logger overrides such as "httpx=WARNING,Moein_Balance.hot=DEBUG"
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+
+# Keep one in this many DEBUG records from the hot-path logger
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '100'))
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records as they are, so message formatting happens on the listener thread."""
+
+    def prepare(self, record):
+        return record
+
+class SampleFilter(logging.Filter):
+    """Pass every INFO-and-above record but only one in `every` records below INFO."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(every, 1)
+        self._count = 0
+
+    def filter(self, record) -> bool:
+        if record.levelno >= logging.INFO:
+            return True
+        self._count += 1
+        return (self._count - 1) % self.every == 0
+
+_log_listener = None
+
+def setup_logging() -> None:
+    """Send log records through a queue to a listener thread that does the formatting and the writing."""
+    global _log_listener
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [DeferredQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL.upper())
+    for entry in filter(None, (part.strip() for part in LOG_LEVELS.split(","))):
+        name, _, level = entry.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    hot_logger.addFilter(SampleFilter(LOG_SAMPLE_EVERY))
+
+    _log_listener = logging.handlers.QueueListener(log_queue, handler)
+    _log_listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging() -> None:
+    """Write out the records still queued and stop the listener thread."""
+    global _log_listener
+    if _log_listener is not None:
+        listener, _log_listener = _log_listener, None
+        listener.stop()
+
 # Define conversation states
 (TRANSACTION_TYPE, RECEIPT_NUM, PACK_NUM, ID_NUM, PURITY, WEIGHT, PARTNER_NAME,
  DEAL_DIRECTION, DEAL_TYPE, AMOUNT, RATE, GIVER_PARTNER_NAME, RECEIVER_PARTNER_NAME,
@@ -30,6 +108,112 @@ HEADERS = [
     "توضیحات", "زمان ثبت"
 ]
 
+# Values the bot computes at save time, written after HEADERS so the sheet needs no formulas.
+# Bump DERIVED_VERSION when a calculation changes; /backfill rewrites rows of older versions.
+DERIVED_HEADERS = ["طلای خالص", "ارزش معامله", "مقدار علامت‌دار", "نسخه محاسبه"]
+DERIVED_VERSION = 1
+SHEET_HEADERS = HEADERS + DERIVED_HEADERS
+
+# Rows read and written per step (and per writer request) when backfilling derived columns
+BACKFILL_BATCH_ROWS = int(os.getenv('BACKFILL_BATCH_ROWS', '1000'))
+
+# Cells in the GreenLand worksheet holding the last document number per transaction type
+DOCUMENT_COUNTER_CELLS = {"دریافت": "A2", "پرداخت": "B2", "معامله": "C2"}
+
+# Maximum time (seconds) the startup warm-up may take before polling starts anyway
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', '30'))
+
+# Key of the ledger spreadsheet (from its URL). Used when BRANCHES is not set.
+SPREADSHEET_KEY = os.getenv('SPREADSHEET_KEY', '')
+
+# Branch ledgers as JSON: branch name -> spreadsheet key and the Telegram user/chat IDs
+# routed to it, e.g. {"tehran": {"key": "1AbC...", "users": [111], "chats": [-100222]}}
+BRANCHES = os.getenv('BRANCHES', '')
+
+# Branch for users and chats not listed in BRANCHES
+DEFAULT_BRANCH = os.getenv('DEFAULT_BRANCH', 'default')
+
+# Transactions are written to one worksheet per period: "month", "year", or "none" (single sheet)
+PARTITION_PERIOD = os.getenv('PARTITION_PERIOD', 'month')
+
+# Worksheet listing every Transactions partition with its period and row count
+PARTITION_INDEX_SHEET = "Partitions"
+PARTITION_INDEX_HEADERS = ["نام برگه", "شروع دوره", "پایان دوره", "تعداد ردیف"]
+
+# Legacy single Transactions worksheet (still read as an unbounded partition)
+LEGACY_TRANSACTIONS_SHEET = "Transactions"
+
+# Where transactions and partner names are stored: "sheets" (Google Sheets, production),
+# "sqlite" (local database, fast primary or offline mode) or "csv" (append-only archive files)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sheets')
+LOCAL_STORE_PATH = os.getenv('LOCAL_STORE_PATH', 'ledger.sqlite3')
+CSV_ARCHIVE_DIR = os.getenv('CSV_ARCHIVE_DIR', 'archive')
+
+# Number of bot worker processes; updates are distributed across them by chat ID
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+
+# SQLite file holding conversation state and caches shared by all worker processes
+STATE_DB_PATH = os.getenv('BOT_STATE_DB', 'bot_state.sqlite3')
+
+# Seconds between batched writes of newly added partner names
+PARTNER_FLUSH_INTERVAL = float(os.getenv('PARTNER_FLUSH_INTERVAL', '5'))
+
+# Seconds a worker waits for the single Sheets writer before giving up on a write
+WRITER_TIMEOUT = float(os.getenv('WRITER_TIMEOUT', '60'))
+
+# How many committed idempotency keys are kept in memory, and how long (hours) they are kept on disk
+COMMITTED_KEYS_LIMIT = int(os.getenv('COMMITTED_KEYS_LIMIT', '1000'))
+COMMITTED_KEYS_TTL_HOURS = float(os.getenv('COMMITTED_KEYS_TTL_HOURS', '168'))
+
+# Number of a user's most used partners pinned to the first row of the partner keyboard,
+# the half-life (days) after which a past use counts half as much in the ranking,
+# and how many scored partners are kept per user and transaction type
+PARTNER_PIN_COUNT = int(os.getenv('PARTNER_PIN_COUNT', '3'))
+PARTNER_RANK_HALF_LIFE_DAYS = float(os.getenv('PARTNER_RANK_HALF_LIFE_DAYS', '7'))
+PARTNER_RANK_KEEP = int(os.getenv('PARTNER_RANK_KEEP', '30'))
+
+# Reconciliation of the bot's own record of written rows against the Transactions sheets:
+# hours between checks (off by default; turning it on adds a hidden Checksums worksheet),
+# rows per checksum block, and the chat that gets the report
+RECONCILE_INTERVAL_HOURS = float(os.getenv('RECONCILE_INTERVAL_HOURS', '0'))
+RECONCILE_BLOCK_ROWS = int(os.getenv('RECONCILE_BLOCK_ROWS', '500'))
+ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID', '')
+
+# Hidden worksheet with one fingerprint formula row per Transactions block; rows written with
+# another formula version are rewritten. Text hashes are reduced modulo a prime below 2**26 so
+# every product in the formulas stays exact in a spreadsheet's floating point
+CHECKSUM_SHEET = "Checksums"
+CHECKSUM_HEADERS = ["نام برگه", "بلوک", "اثر متن", "اثر اعداد", "تعداد خانه", "نسخه فرمول"]
+FINGERPRINT_VERSION = 2
+FINGERPRINT_MODULUS = 67108859
+
+# Unfinished drafts idle for this many minutes are closed (0 keeps them until the cap is hit),
+# at most DRAFT_LIMIT drafts are kept live per process, and closed drafts can be resumed from
+# a prompt for PARKED_DRAFT_TTL_HOURS
+DRAFT_IDLE_MINUTES = float(os.getenv('DRAFT_IDLE_MINUTES', '30'))
+DRAFT_LIMIT = int(os.getenv('DRAFT_LIMIT', '200'))
+DRAFT_RESUME_PROMPT = os.getenv('DRAFT_RESUME_PROMPT', '1') == '1'
+PARKED_DRAFT_TTL_HOURS = float(os.getenv('PARKED_DRAFT_TTL_HOURS', '72'))
+
+# user_data keys that belong to the draft in progress
+DRAFT_KEYS = (
+    "transaction", "next_state", "current_partner_field", "adding_new_partner", "edit_field",
+    "card", "card_notice", "card_show_duplicate", "api_calls", "saved_row"
+)
+
+# Seconds a shutdown may spend finishing in-flight updates and Sheets writes before it gives up
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '25'))
+
+# Most transactions a session basket may hold before it has to be committed
+BASKET_LIMIT = int(os.getenv('BASKET_LIMIT', '50'))
+
+# Transactions per page of /history results, and how many recent queries per chat keep working page buttons
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '5'))
+HISTORY_QUERIES_KEPT = int(os.getenv('HISTORY_QUERIES_KEPT', '20'))
+
+# Number of recent deals per deal type and direction averaged for the suggested rate
+RATE_SUGGESTION_WINDOW = int(os.getenv('RATE_SUGGESTION_WINDOW', '10'))
+
 # Define callback prefixes for better organization
 CB_TRANSACTION_TYPE = "type_"
 CB_DEAL_DIRECTION = "dir_"
@@ -39,6 +223,26 @@ CB_EDIT_VALUE = "edit_value_"
 CB_PARTNER_NAME = "partner_"
 CB_GIVER_PARTNER = "giver_partner_"
 CB_RECEIVER_PARTNER = "receiver_partner_"
+CB_CONFIRM = "confirm_"
+CB_SHOW_DUPLICATE = "show_duplicate"
+CB_RESUME_DRAFT = "resume_draft"
+CB_SKIP_PACK = "skip_pack"
+CB_RATE = "rate_"
+CB_HISTORY = "history_"
+CB_BASKET_ADD = "basket_add"
+CB_BASKET_COMMIT = "basket_commit"
+CB_BASKET_COMMIT_FORCE = "basket_commit_force"
+CB_BASKET_CLEAR = "basket_clear"
+
+# Maximum length of the text in a callback query alert
+CALLBACK_ALERT_LIMIT = 200
+
+# Message shown when a transaction has been saved (re-sent on repeated confirms)
+SAVE_SUCCESS_MESSAGE = "✅ تراکنش با موفقیت در Google Sheets ذخیره شد!"
+
+# Resume prompts for a draft closed after DRAFT_IDLE_MINUTES, or to stay under DRAFT_LIMIT
+DRAFT_IDLE_MESSAGE = "⏸ تراکنش ناتمام شما به دلیل بی‌فعالیتی بسته شد."
+DRAFT_CAP_MESSAGE = "⏸ تراکنش ناتمام شما بسته شد چون تعداد تراکنش‌های باز ربات به حداکثر رسید."
 
 # Define persistent menu that will always be available
 MENU_KEYBOARD = ReplyKeyboardMarkup([
@@ -63,189 +267,2560 @@ FIELD_MAPPING = {
     "توضیحات": "description"
 }
 
+# Quick-entry commands: command -> (transaction type, single-word fields, trailing partner fields).
+# The partner fields take the rest of the line, "|" starts the description, and the two
+# حواله partners are separated by ">", e.g. /r 1234 56 ali 750 12.5 partner | note
+QUICK_ENTRY_COMMANDS = {
+    "r": ("دریافت", ["receipt_num", "pack_num", "id_num", "purity", "weight"], ["partner_name"]),
+    "p": ("پرداخت", ["receipt_num", "purity", "weight"], ["partner_name"]),
+    "d": ("معامله", ["receipt_num", "deal_direction", "deal_type", "amount", "rate"], ["partner_name"]),
+    "h": ("حواله", ["deal_type", "amount"], ["giver_partner_name", "receiver_partner_name"]),
+}
+QUICK_ENTRY_USAGE = {
+    "r": "/r شماره‌سند شماره‌پاکت اسم‌ریگیری عیار وزن طرف‌حساب | توضیحات",
+    "p": "/p شماره‌سند عیار وزن طرف‌حساب | توضیحات",
+    "d": "/d شماره‌سند Buy|Sell نوع‌معامله مقدار نرخ طرف‌حساب | توضیحات",
+    "h": "/h نوع‌حواله مقدار پرداخت‌کننده > دریافت‌کننده | توضیحات",
+}
+QUICK_ENTRY_NUMERIC_FIELDS = {"receipt_num", "pack_num", "purity", "weight", "amount", "rate"}
+QUICK_ENTRY_DEAL_TYPES = {
+    "معامله": ["AED", "Gold Milion", "Gold gr", "USD"],
+    "حواله": ["AED", "Milion", "Gold gr", "USD"],
+}
+QUICK_ENTRY_DIRECTIONS = {"buy": "Buy", "sell": "Sell", "خرید": "Buy", "فروش": "Sell"}
+
 # Google Sheets setup
-def setup_google_sheets():
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    # Check if we're using environment variable for credentials
-    if 'GOOGLE_API_KEY' in os.environ:
-        import json
-        # Parse JSON from environment variable
-        credentials_dict = json.loads(os.environ['GOOGLE_API_KEY'])
-        credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, scope)
-    else:
-        # Use local file path (your original code)
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            os.getenv('GOOGLE_API_KEY'), scope)
-    
-    client = gspread.authorize(credentials)
-    
-    try:
-        spreadsheet = client.open("Test")
-    except gspread.SpreadsheetNotFound:
-        spreadsheet = client.create("Transaction_Log")
-        spreadsheet.share('amir.reihani251@gmail.com', perm_type='user', role='writer')
-    
-    try:
-        worksheet = spreadsheet.worksheet("Transactions")
-        # Check if headers exist
-        existing_headers = worksheet.row_values(1)
-        if not existing_headers or existing_headers != HEADERS:
-            # Clear first row and add all headers
-            if existing_headers:
-                worksheet.delete_row(1)
-            # Use update to set headers in the first row
-            worksheet.update('A1', [HEADERS])
-    except gspread.WorksheetNotFound:
-        worksheet = spreadsheet.add_worksheet(title="Transactions", rows=1000, cols=20)
-        # Add headers
-        worksheet.update('A1', [HEADERS])
-    
-    return worksheet
+SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 
-def get_last_number_from_other_sheet(cell: str) -> str:
-    """Read a specific cell from another worksheet (e.g., 'GreenLand')."""
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        # Check if we're using environment variable for credentials
-    if 'GOOGLE_API_KEY' in os.environ:
-        import json
-        # Parse JSON from environment variable
-        credentials_dict = json.loads(os.environ['GOOGLE_API_KEY'])
-        credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, scope)
-    else:
-        # Use local file path (your original code)
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            os.getenv('GOOGLE_API_KEY'), scope)
-    
-    client = gspread.authorize(credentials)
+# Handles reused across calls so OAuth and the spreadsheet lookup happen once per process
+_sheets_client = None
+_spreadsheets = {}  # spreadsheet handles by key
+_spreadsheets_lock = threading.Lock()
 
-    spreadsheet = client.open("Test")
-    worksheet_toread = spreadsheet.worksheet("GreenLand")  # Change to your worksheet name
-    return worksheet_toread.acell(cell).value
+# Set in worker processes: the shared local store and the client for the single Sheets writer
+_shared_store = None
+_sheets_writer = None
 
-# Add these functions to fetch and update partner names
+# Periodic loops of this process, cancelled when it drains
+_background_tasks = []
+
+class SharedStore:
+    """Small SQLite key/value store shared by all bot processes on the host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._conn.commit()
+
+    def get(self, namespace: str, key: str, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace: str, key: str, value) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False))
+            )
+            self._conn.commit()
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+            self._conn.commit()
+
+    def prune(self, namespace: str, field: str, older_than: float) -> None:
+        """Delete entries whose JSON value has a numeric `field` below `older_than`."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM kv WHERE namespace = ? AND json_extract(value, ?) < ?",
+                (namespace, f"$.{field}", older_than)
+            )
+            self._conn.commit()
+
+    def set_many(self, namespace: str, values: dict) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                [(namespace, key, json.dumps(value, ensure_ascii=False)) for key, value in values.items()]
+            )
+            self._conn.commit()
+
+    def items(self, namespace: str) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM kv WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+class CommittedKeyIndex:
+    """Idempotency keys of recently saved drafts, mapped to the row reference they were saved in."""
+
+    def __init__(self, limit: int = COMMITTED_KEYS_LIMIT, ttl_hours: float = COMMITTED_KEYS_TTL_HOURS):
+        self.limit = limit
+        self.ttl = ttl_hours * 3600
+        self._recent = OrderedDict()
+
+    def get(self, key: str):
+        """Return the saved row reference for a key, or None if it was never committed."""
+        if key in self._recent:
+            self._recent.move_to_end(key)
+            return self._recent[key]
+        if _shared_store is not None:
+            entry = _shared_store.get("committed_keys", key)
+            if entry is not None:
+                self._remember(key, entry["row"])
+                return entry["row"]
+        return None
+
+    def add(self, key: str, row: str) -> None:
+        self._remember(key, row)
+        if _shared_store is not None:
+            now = time.time()
+            _shared_store.set("committed_keys", key, {"row": row, "committed_at": now})
+            _shared_store.prune("committed_keys", "committed_at", now - self.ttl)
+
+    def _remember(self, key: str, row: str) -> None:
+        self._recent[key] = row
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.limit:
+            self._recent.popitem(last=False)
+
+_committed_keys = CommittedKeyIndex()
+
+class SQLitePersistence(BasePersistence):
+    """Keep conversation state and user/chat data in the shared SQLite store."""
+
+    def __init__(self, store: SharedStore, update_interval: float = 5):
+        # bot_data is per process (e.g. startup bookkeeping), so it is not shared
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.store = store
+
+    async def get_user_data(self):
+        return {int(key): value for key, value in self.store.items("user_data").items()}
+
+    async def get_chat_data(self):
+        return {int(key): value for key, value in self.store.items("chat_data").items()}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        return {
+            tuple(json.loads(key)): state
+            for key, state in self.store.items(f"conversation:{name}").items()
+        }
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        if new_state is None:
+            self.store.delete(f"conversation:{name}", json.dumps(list(key)))
+        else:
+            self.store.set(f"conversation:{name}", json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        self.store.set("user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        self.store.set("chat_data", str(chat_id), data)
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.store.delete("user_data", str(user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self.store.delete("chat_data", str(chat_id))
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+class SheetsWriterClient:
+    """Forward Sheets writes from a worker process to the single writer process."""
+
+    def __init__(self, requests, replies, worker_index: int):
+        self.requests = requests
+        self.replies = replies
+        self.worker_index = worker_index
+        self._lock = threading.Lock()
+
+    def call(self, op: str, payload):
+        """Send a request and wait for its reply. This blocks, so handlers call it through asyncio.to_thread."""
+        with self._lock:
+            request_id = uuid.uuid4().hex
+            self.requests.put((op, request_id, self.worker_index, payload))
+            while True:
+                try:
+                    reply_id, ok, result = self.replies.get(timeout=WRITER_TIMEOUT)
+                except queue.Empty:
+                    raise TimeoutError(f"Sheets writer did not answer '{op}' within {WRITER_TIMEOUT}s")
+                # Drop late replies to requests that already timed out
+                if reply_id == request_id:
+                    break
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+def publish_shared_caches():
+    """Copy every branch's partner and counter caches into the shared store for the workers."""
+    if _shared_store is None:
+        return
+    for branch in get_branches().values():
+        if branch.partner_index.loaded:
+            _shared_store.set("cache", f"partners:{branch.name}", branch.partner_index.names)
+        _shared_store.set("cache", f"document_counters:{branch.name}", branch.document_counters)
+
+def get_sheets_client():
+    """Authorize against Google once and reuse the client."""
+    global _sheets_client
+    if _sheets_client is None:
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
 
-def get_partner_names_from_sheet():
-    """Fetch partner names from the GreenLand worksheet."""
-    try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
         # Check if we're using environment variable for credentials
         if 'GOOGLE_API_KEY' in os.environ:
             import json
             # Parse JSON from environment variable
             credentials_dict = json.loads(os.environ['GOOGLE_API_KEY'])
-            credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, scope)
+            credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, SCOPE)
         else:
-            # Use local file path (your original code)
+            # Use local file path
             credentials = ServiceAccountCredentials.from_json_keyfile_name(
-                os.getenv('GOOGLE_API_KEY'), scope)
-        
-        client = gspread.authorize(credentials)
-        spreadsheet = client.open("Test")
-        worksheet = spreadsheet.worksheet("GreenLand")
-        # Find the column by header name instead of assuming position
-        headers = worksheet.row_values(1)
-        
-        try:
-            # Find column index for "نام مشتری"
-            header_index = headers.index("نام مشتری") + 1  # Convert to 1-based index for gspread
-            
-            # If found, get values from that column
-            if header_index:
-                partner_column = worksheet.col_values(header_index)
-                # Remove header and empty values
-                partner_names = [name for name in partner_column[1:] if name.strip()]
-                
-                # Add logging to help debug
-                logger.info(f"Found {len(partner_names)} partner names: {partner_names[:5]}...")
-                return partner_names
+                os.getenv('GOOGLE_API_KEY'), SCOPE)
+
+        _sheets_client = gspread.authorize(credentials)
+    return _sheets_client
+
+class Branch:
+    """One branch ledger: its spreadsheet key plus the handles and caches that belong to it."""
+
+    def __init__(self, name: str, key: str, users=(), chats=()):
+        self.name = name
+        self.key = key
+        self.users = set(users)
+        self.chats = set(chats)
+        # Only Sheets keeps its rows in date partitions
+        self.partitions = PartitionCatalog(self) if STORAGE_BACKEND == "sheets" else None
+        self.document_counters = {}
+        # Serializes row allocation for transaction writes made from this process
+        self.write_lock = threading.Lock()
+        store_class, directory_class = STORAGE_BACKENDS[STORAGE_BACKEND]
+        self.store = store_class(self)
+        self.partner_index = directory_class(self)
+        # In-memory indexes over this branch's Transactions rows (see register_row_index)
+        self.indexes = {index_name: factory() for index_name, factory in _row_index_factories.items()}
+        self.indexed_seq = 0  # number of rows fed to the indexes, in save order
+        self.index_lock = threading.RLock()
+
+_branches = None
+_branch_by_user = {}
+_branch_by_chat = {}
+_current_branch = contextvars.ContextVar("current_branch", default=None)
+
+def get_branches() -> dict:
+    """Build the branches from configuration on first use."""
+    global _branches
+    if _branches is None:
+        config = json.loads(BRANCHES) if BRANCHES else {DEFAULT_BRANCH: {"key": SPREADSHEET_KEY}}
+        branches = {}
+        for name, settings in config.items():
+            branch = Branch(name, settings.get("key", ""), settings.get("users", ()), settings.get("chats", ()))
+            branches[name] = branch
+            for user_id in branch.users:
+                _branch_by_user[int(user_id)] = branch
+            for chat_id in branch.chats:
+                _branch_by_chat[int(chat_id)] = branch
+        _branches = branches
+    return _branches
+
+def get_branch(name: str = None) -> Branch:
+    """Return a branch by name, or the default branch."""
+    branches = get_branches()
+    if name in branches:
+        return branches[name]
+    return branches.get(DEFAULT_BRANCH) or next(iter(branches.values()))
+
+def current_branch() -> Branch:
+    """Return the branch of the update being handled (the default branch outside updates)."""
+    return _current_branch.get() or get_branch()
+
+def branch_for_update(update: Update) -> Branch:
+    """Route an update to its branch by user first, then by chat."""
+    get_branches()
+    if update.effective_user and update.effective_user.id in _branch_by_user:
+        return _branch_by_user[update.effective_user.id]
+    if update.effective_chat and update.effective_chat.id in _branch_by_chat:
+        return _branch_by_chat[update.effective_chat.id]
+    return get_branch()
+
+async def route_to_branch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Select the branch ledger for the rest of this update's handlers."""
+    _current_branch.set(branch_for_update(update))
+
+def get_spreadsheet(branch: Branch = None):
+    """Open a branch's spreadsheet by key once and reuse the handle."""
+    branch = branch or current_branch()
+    with _spreadsheets_lock:
+        if branch.key not in _spreadsheets:
+            client = get_sheets_client()
+            if branch.key:
+                _spreadsheets[branch.key] = client.open_by_key(branch.key)
             else:
-                logger.error(f"Header 'نام مشتری' not found in worksheet. Available headers: {headers}")
-                return []
-        except ValueError:
-            logger.error(f"Header 'نام مشتری' not found in worksheet. Available headers: {headers}")
+                # Title lookup is a slow Drive search; configure SPREADSHEET_KEY instead
+                logger.warning("No spreadsheet key configured for branch '%s'; opening 'Test' by title", branch.name)
+                _spreadsheets[branch.key] = client.open("Test")
+        return _spreadsheets[branch.key]
+
+def period_bounds(date_text: str) -> tuple:
+    """Return (partition title, first day, last day) of the period containing a YYYY-MM-DD date."""
+    try:
+        day = datetime.strptime(str(date_text).strip()[:10], "%Y-%m-%d")
+    except ValueError:
+        day = datetime.now()
+    if PARTITION_PERIOD == "year":
+        return f"Transactions_{day.year}", f"{day.year}-01-01", f"{day.year}-12-31"
+    next_month = datetime(day.year + day.month // 12, day.month % 12 + 1, 1)
+    last_day = (next_month - datetime(day.year, day.month, 1)).days
+    return (f"Transactions_{day.year}-{day.month:02d}",
+            f"{day.year}-{day.month:02d}-01", f"{day.year}-{day.month:02d}-{last_day:02d}")
+
+def partition_bounds(date_text: str) -> tuple:
+    """(partition title, first day, last day) for a transaction date under PARTITION_PERIOD."""
+    if PARTITION_PERIOD == "none":
+        return LEGACY_TRANSACTIONS_SHEET, "", ""
+    return period_bounds(date_text)
+
+def make_row_ref(title: str, row_number: int) -> str:
+    """Reference to a saved row, e.g. "Transactions_2024-05!12"."""
+    return f"{title}!{row_number}"
+
+def parse_row_ref(row_ref: str) -> tuple:
+    """Split a row reference into (worksheet title, row number)."""
+    title, row_number = row_ref.rsplit("!", 1)
+    return title, int(row_number)
+
+def format_row_ref(row_ref: str) -> str:
+    """Human-readable form of a row reference for messages."""
+    title, row_number = parse_row_ref(row_ref)
+    return f"ردیف {row_number} برگه {title}"
+
+class PartitionCatalog:
+    """The Transactions partitions of one branch and their row counts.
+
+    Every period gets its own worksheet, created on demand with the HEADERS
+    row. The catalog is mirrored in the PARTITION_INDEX_SHEET worksheet so row
+    counts and periods are known without reading the partitions themselves.
+    The counts only say where the next row should go; allocate_rows() checks
+    that those rows are empty before anything is written there.
+    """
+
+    def __init__(self, branch: Branch):
+        self.branch = branch
+        self.loaded = False
+        # title -> {"start": str, "end": str, "rows": int, "index_row": int}; empty bounds mean unbounded
+        self.entries = {}
+        self._worksheets = {}
+        self._index_worksheet = None
+        self._last_index_row = 1
+        self._lock = threading.RLock()
+
+    def load(self) -> None:
+        """Read the index sheet (creating it if needed) and pick up the legacy worksheet."""
+        import gspread
+
+        with self._lock:
+            spreadsheet = get_spreadsheet(self.branch)
+            try:
+                index_worksheet = spreadsheet.worksheet(PARTITION_INDEX_SHEET)
+                rows = index_worksheet.get_all_values()
+            except gspread.WorksheetNotFound:
+                index_worksheet = spreadsheet.add_worksheet(
+                    title=PARTITION_INDEX_SHEET, rows=100, cols=len(PARTITION_INDEX_HEADERS))
+                index_worksheet.update('A1', [PARTITION_INDEX_HEADERS])
+                rows = [PARTITION_INDEX_HEADERS]
+            self._index_worksheet = index_worksheet
+            # New partitions are registered below the last used row, never in a blank row between entries
+            self._last_index_row = max(len(rows), 1)
+
+            self.entries = {}
+            for index_row_number, row in enumerate(rows[1:], start=2):
+                row = list(row) + [""] * (len(PARTITION_INDEX_HEADERS) - len(row))
+                if not row[0]:
+                    continue
+                self.entries[row[0]] = {
+                    "start": row[1], "end": row[2],
+                    "rows": int(to_english_number(row[3]) or 0), "index_row": index_row_number
+                }
+
+            if LEGACY_TRANSACTIONS_SHEET not in self.entries:
+                try:
+                    self._validate_headers(spreadsheet.worksheet(LEGACY_TRANSACTIONS_SHEET))
+                    self._register(LEGACY_TRANSACTIONS_SHEET, "", "", self.count_rows(LEGACY_TRANSACTIONS_SHEET))
+                except gspread.WorksheetNotFound:
+                    pass
+            self.loaded = True
+
+    def _validate_headers(self, worksheet) -> None:
+        # Check if headers exist
+        existing_headers = worksheet.row_values(1)
+        if worksheet.col_count < len(SHEET_HEADERS):
+            worksheet.add_cols(len(SHEET_HEADERS) - worksheet.col_count)
+        if existing_headers[:len(HEADERS)] == HEADERS and existing_headers != SHEET_HEADERS:
+            # Sheets from before the derived columns only need the new header cells
+            worksheet.update('A1', [SHEET_HEADERS])
+        elif not any(str(cell).strip() for cell in existing_headers):
+            # Empty first row: set headers without touching the rows below
+            worksheet.update('A1', [SHEET_HEADERS])
+        elif existing_headers != SHEET_HEADERS:
+            # Row 1 may hold data or someone else's layout; never overwrite or delete it
+            logger.error("Unexpected headers in worksheet '%s': %s (expected %s)",
+                         worksheet.title, existing_headers, SHEET_HEADERS)
+            raise ValueError(f"Worksheet '{worksheet.title}' has unexpected headers; fix row 1 by hand and restart.")
+        self._worksheets[worksheet.title] = worksheet
+
+    def _register(self, title: str, start: str, end: str, rows: int) -> None:
+        self._last_index_row += 1
+        index_row_number = self._last_index_row
+        self._index_worksheet.update(f"A{index_row_number}", [[title, start, end, rows]])
+        self.entries[title] = {"start": start, "end": end, "rows": rows, "index_row": index_row_number}
+
+    def worksheet(self, title: str):
+        with self._lock:
+            if title not in self._worksheets:
+                # First use in this process: make sure the grid and headers include the derived columns
+                self._validate_headers(get_spreadsheet(self.branch).worksheet(title))
+            return self._worksheets[title]
+
+    def partition_for(self, date_text: str) -> str:
+        """Return the partition for a transaction date, creating its worksheet on first use."""
+        import gspread
+
+        title, start, end = partition_bounds(date_text)
+        with self._lock:
+            if title in self.entries:
+                return title
+            spreadsheet = get_spreadsheet(self.branch)
+            try:
+                worksheet = spreadsheet.worksheet(title)
+                self._validate_headers(worksheet)
+                rows = self.count_rows(title)
+            except gspread.WorksheetNotFound:
+                worksheet = spreadsheet.add_worksheet(title=title, rows=1000, cols=len(SHEET_HEADERS))
+                worksheet.update('A1', [SHEET_HEADERS])
+                self._worksheets[title] = worksheet
+                rows = 0
+            self._register(title, start, end, rows)
+            logger.info("Created partition '%s' for branch '%s'", title, self.branch.name)
+            return title
+
+    def overlapping(self, start_date: str = None, end_date: str = None) -> list:
+        """Partitions whose period overlaps [start_date, end_date], oldest first."""
+        titles = []
+        for title, entry in self.entries.items():
+            if start_date and entry["end"] and entry["end"] < start_date:
+                continue
+            if end_date and entry["start"] and entry["start"] > end_date:
+                continue
+            titles.append(title)
+        return sorted(titles, key=lambda title: self.entries[title]["start"])
+
+    def set_row_count(self, title: str, rows: int) -> None:
+        """Correct a partition's row count (e.g. after reading it in full)."""
+        with self._lock:
+            entry = self.entries[title]
+            if entry["rows"] != rows:
+                entry["rows"] = rows
+                self._index_worksheet.update(f"D{entry['index_row']}", [[rows]])
+
+    def count_rows(self, title: str) -> int:
+        """Count a worksheet's rows below the header, up to its last non-empty row."""
+        return max(len(self.worksheet(title).get_all_values()) - 1, 0)
+
+    def _rows_empty(self, title: str, first_row: int, last_row: int) -> bool:
+        values = get_spreadsheet(self.branch).values_get(
+            f"'{title}'!A{first_row}:{column_letter(len(SHEET_HEADERS))}{last_row}"
+        ).get("values", [])
+        return not any(str(value) for row in values for value in row)
+
+    def allocate_rows(self, title: str, count: int = 1) -> int:
+        """Reserve the next `count` rows of a partition and return the first, growing its grid when needed.
+
+        The rows are read back before they are handed out. If anything is
+        already there (rows added by hand, or a count that was never
+        corrected) the count is taken from the sheet itself, so a save never
+        overwrites a row.
+        """
+        with self._lock:
+            entry = self.entries[title]
+            worksheet = self.worksheet(title)
+            while True:
+                row_number = entry["rows"] + 2  # +2 for the header row and 1-based rows
+                last_row = row_number + count - 1
+                if last_row > worksheet.row_count:
+                    worksheet.add_rows(max(1000, count))
+                if self._rows_empty(title, row_number, last_row):
+                    break
+                counted = self.count_rows(title)
+                logger.warning(
+                    "Rows %d-%d of '%s' are not empty: the index has %d rows, the sheet %d",
+                    row_number, last_row, title, entry["rows"], counted
+                )
+                entry["rows"] = max(counted, entry["rows"] + 1)
+            entry["rows"] += count
+            return row_number
+
+    def write_row(self, title: str, row_number: int, row_data) -> None:
+        """Write a row and its partition's new row count in a single API call."""
+        with self._lock:
+            entry = self.entries[title]
+            get_spreadsheet(self.branch).values_batch_update({
+                "valueInputOption": "RAW",
+                "data": [
+                    {"range": f"'{title}'!A{row_number}:{column_letter(len(row_data))}{row_number}", "values": [row_data]},
+                    {"range": f"'{PARTITION_INDEX_SHEET}'!D{entry['index_row']}", "values": [[entry["rows"]]]}
+                ]
+            })
+
+def write_partition_rows(catalog: "PartitionCatalog", rows: list) -> None:
+    """Write (title, row number, row data) rows and their partitions' row counts in a single API call.
+
+    Rows must be allocated in order, so each partition's rows form one range.
+    """
+    ranges = {}
+    for title, row_number, row_data in rows:
+        ranges.setdefault(title, (row_number, []))[1].append(row_data)
+    data = []
+    for title, (first_row, values) in ranges.items():
+        last_column = column_letter(max(len(row) for row in values))
+        data.append({"range": f"'{title}'!A{first_row}:{last_column}{first_row + len(values) - 1}", "values": values})
+        data.append({
+            "range": f"'{PARTITION_INDEX_SHEET}'!D{catalog.entries[title]['index_row']}",
+            "values": [[catalog.entries[title]["rows"]]]
+        })
+    get_spreadsheet(catalog.branch).values_batch_update({"valueInputOption": "RAW", "data": data})
+
+def column_letter(column: int) -> str:
+    """Return the A1 letters of a 1-based column number."""
+    letters = ""
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def setup_google_sheets(branch: Branch = None) -> PartitionCatalog:
+    """Return the branch's Transactions partitions, validating headers and the index sheet on first use only."""
+    branch = branch or current_branch()
+    if not branch.partitions.loaded:
+        branch.partitions.load()
+    return branch.partitions
+
+class TransactionStore(ABC):
+    """Where a branch's transaction rows are kept.
+
+    Rows are lists in HEADERS order; each saved row gets a row reference
+    ("title!row") that stays valid for later lookups.
+    """
+
+    # Whether saved rows can be read back and edited in place (/edit)
+    supports_edit = False
+
+    def __init__(self, branch: Branch):
+        self.branch = branch
+        self.loaded = False
+        self._load_lock = threading.Lock()
+
+    def ensure_loaded(self) -> "TransactionStore":
+        if not self.loaded:
+            with self._load_lock:
+                if not self.loaded:
+                    self.load()
+        return self
+
+    @abstractmethod
+    def load(self) -> None:
+        """Prepare the storage (schema, row counts) once per process."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def append(self, row_data) -> str:
+        """Save a row and return its row reference."""
+        raise NotImplementedError
+
+    def append_many(self, rows: list) -> list:
+        """Save several rows and return their row references, in order."""
+        return [self.append(row_data) for row_data in rows]
+
+    @abstractmethod
+    def read(self, start_date: str = None, end_date: str = None):
+        """Yield (row reference, header-keyed row) for rows dated within the range, in save order."""
+        raise NotImplementedError
+
+    def read_row(self, row_ref: str) -> list:
+        """Return the current values of one saved row, padded to SHEET_HEADERS."""
+        raise NotImplementedError
+
+    def update_cells(self, row_ref: str, changes: dict) -> None:
+        """Overwrite only the given cells ({column index: value}) of a saved row."""
+        raise NotImplementedError
+
+    def document_counters(self) -> dict:
+        """Last document number per transaction type."""
+        counters = dict.fromkeys(DOCUMENT_COUNTER_CELLS)
+        for _, row in self.read():
+            if row.get("نوع تراکنش") in counters and str(row.get("شماره سند", "")).strip():
+                counters[row["نوع تراکنش"]] = row["شماره سند"]
+        return counters
+
+class SheetsTransactionStore(TransactionStore):
+    """Production storage: one Transactions worksheet per period, tracked by the PartitionCatalog."""
+
+    supports_edit = True
+
+    def load(self) -> None:
+        self.branch.partitions.load()
+        self.loaded = True
+
+    def append(self, row_data) -> str:
+        # Pick the partition by transaction date; the row count comes from the index, not a full read
+        catalog = self.branch.partitions
+        title = catalog.partition_for(row_data[HEADERS.index("تاریخ")])
+        next_row = catalog.allocate_rows(title)
+
+        # Update specific cells in the next empty row (ensure same order as HEADERS)
+        try:
+            catalog.write_row(title, next_row, row_data)
+        except Exception:
+            # Give the row back so the next save doesn't leave a gap
+            with catalog._lock:
+                catalog.entries[title]["rows"] -= 1
+            raise
+        return make_row_ref(title, next_row)
+
+    def append_many(self, rows: list) -> list:
+        # Each partition's rows are allocated (and checked) as one range, and all rows,
+        # in however many partitions, go out in one values_batch_update
+        catalog = self.branch.partitions
+        positions = {}
+        for i, row_data in enumerate(rows):
+            positions.setdefault(catalog.partition_for(row_data[HEADERS.index("تاریخ")]), []).append(i)
+        allocated = []
+        row_refs = [None] * len(rows)
+        with catalog._lock:
+            try:
+                for title, indexes in positions.items():
+                    first_row = catalog.allocate_rows(title, len(indexes))
+                    for offset, i in enumerate(indexes):
+                        allocated.append((title, first_row + offset, rows[i]))
+                        row_refs[i] = make_row_ref(title, first_row + offset)
+                write_partition_rows(catalog, allocated)
+            except Exception:
+                # Give the rows back, still under the lock, so the next save doesn't leave a gap
+                for title, _, _ in allocated:
+                    catalog.entries[title]["rows"] -= 1
+                raise
+        return row_refs
+
+    def read(self, start_date: str = None, end_date: str = None):
+        """Only partitions overlapping the range are read; the legacy worksheet is
+        unbounded, so its rows are filtered by date.
+        """
+        catalog = self.branch.partitions
+        for title in catalog.overlapping(start_date, end_date):
+            rows = catalog.worksheet(title).get_all_values()
+            if start_date is None and end_date is None:
+                catalog.set_row_count(title, len(rows) - 1)
+            for row_number, row in enumerate(rows[1:], start=2):
+                row = row_to_dict(row)
+                date = str(row.get("تاریخ", ""))[:10]
+                if (start_date and date < start_date) or (end_date and date > end_date):
+                    continue
+                yield make_row_ref(title, row_number), row
+
+    def read_row(self, row_ref: str) -> list:
+        title, row_number = parse_row_ref(row_ref)
+        response = get_spreadsheet(self.branch).values_get(
+            f"'{title}'!A{row_number}:{column_letter(len(SHEET_HEADERS))}{row_number}",
+            params={"valueRenderOption": "UNFORMATTED_VALUE"}
+        )
+        values = (response.get("values") or [[]])[0]
+        return values + [""] * (len(SHEET_HEADERS) - len(values))
+
+    def update_cells(self, row_ref: str, changes: dict) -> None:
+        title, row_number = parse_row_ref(row_ref)
+        get_spreadsheet(self.branch).values_batch_update({
+            "valueInputOption": "RAW",
+            "data": [
+                {"range": f"'{title}'!{column_letter(column + 1)}{row_number}", "values": [[value]]}
+                for column, value in sorted(changes.items())
+            ]
+        })
+
+    def document_counters(self) -> dict:
+        """Read all document counters from the GreenLand worksheet in one request."""
+        worksheet = get_spreadsheet(self.branch).worksheet("GreenLand")
+        types = list(DOCUMENT_COUNTER_CELLS)
+        ranges = worksheet.batch_get([DOCUMENT_COUNTER_CELLS[t] for t in types])
+        counters = {}
+        for transaction_type, value_range in zip(types, ranges):
+            counters[transaction_type] = value_range[0][0] if value_range and value_range[0] else None
+        return counters
+
+# One connection per database file, shared by the branches stored in it
+_local_connections = {}
+_local_connections_lock = threading.Lock()
+
+def local_connection(path: str) -> tuple:
+    """Return (connection, lock) for a local SQLite ledger, creating its tables on first use."""
+    with _local_connections_lock:
+        if path not in _local_connections:
+            conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS transactions ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, branch TEXT NOT NULL, "
+                "type TEXT NOT NULL, date TEXT NOT NULL, row TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS transactions_by_date ON transactions (branch, date)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS partners ("
+                "branch TEXT NOT NULL, name TEXT NOT NULL, PRIMARY KEY (branch, name))"
+            )
+            conn.commit()
+            _local_connections[path] = (conn, threading.Lock())
+        return _local_connections[path]
+
+# Row references of the SQLite backend use this in place of a worksheet title
+SQLITE_ROW_TITLE = "SQLite"
+
+class SQLiteTransactionStore(TransactionStore):
+    """Local storage in LOCAL_STORE_PATH: a fast primary, or an offline mode without Google access."""
+
+    supports_edit = True
+
+    def load(self) -> None:
+        self._conn, self._lock = local_connection(LOCAL_STORE_PATH)
+        self.loaded = True
+
+    def append(self, row_data) -> str:
+        row = list(row_data)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO transactions (branch, type, date, row) VALUES (?, ?, ?, ?)",
+                (self.branch.name, str(row[HEADERS.index("نوع تراکنش")]),
+                 str(row[HEADERS.index("تاریخ")])[:10], json.dumps(row, ensure_ascii=False))
+            )
+            self._conn.commit()
+        return make_row_ref(SQLITE_ROW_TITLE, cursor.lastrowid)
+
+    def read(self, start_date: str = None, end_date: str = None):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, row FROM transactions WHERE branch = ? AND date >= ? AND date <= ? ORDER BY id",
+                (self.branch.name, start_date or "", end_date or "\uffff")
+            ).fetchall()
+        for row_id, row in rows:
+            yield make_row_ref(SQLITE_ROW_TITLE, row_id), row_to_dict(json.loads(row))
+
+    def read_row(self, row_ref: str) -> list:
+        _, row_id = parse_row_ref(row_ref)
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT row FROM transactions WHERE branch = ? AND id = ?", (self.branch.name, row_id)
+            ).fetchone()
+        values = json.loads(found[0]) if found else []
+        return values + [""] * (len(SHEET_HEADERS) - len(values))
+
+    def update_cells(self, row_ref: str, changes: dict) -> None:
+        _, row_id = parse_row_ref(row_ref)
+        values = self.read_row(row_ref)
+        for column, value in changes.items():
+            values[column] = value
+        with self._lock:
+            self._conn.execute(
+                "UPDATE transactions SET type = ?, date = ?, row = ? WHERE branch = ? AND id = ?",
+                (str(values[HEADERS.index("نوع تراکنش")]), str(values[HEADERS.index("تاریخ")])[:10],
+                 json.dumps(values, ensure_ascii=False), self.branch.name, row_id)
+            )
+            self._conn.commit()
+
+    def document_counters(self) -> dict:
+        counters = {}
+        with self._lock:
+            for transaction_type in DOCUMENT_COUNTER_CELLS:
+                found = self._conn.execute(
+                    "SELECT row FROM transactions WHERE branch = ? AND type = ? ORDER BY id DESC LIMIT 1",
+                    (self.branch.name, transaction_type)
+                ).fetchone()
+                counters[transaction_type] = row_to_dict(json.loads(found[0]))["شماره سند"] if found else None
+        return counters
+
+class CSVTransactionStore(TransactionStore):
+    """Append-only CSV files, one per partition, under CSV_ARCHIVE_DIR/<branch>.
+
+    Row numbers match the worksheet layout (header on line 1), so row
+    references look the same as in Sheets.
+    """
+
+    def load(self) -> None:
+        self.directory = os.path.join(CSV_ARCHIVE_DIR, self.branch.name)
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.rows = {}
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".csv") and filename != "partners.csv":
+                with open(os.path.join(self.directory, filename), newline="", encoding="utf-8") as f:
+                    self.rows[filename[:-4]] = sum(1 for _ in csv.reader(f)) - 1
+        self.loaded = True
+
+    def _path(self, title: str) -> str:
+        return os.path.join(self.directory, f"{title}.csv")
+
+    def append(self, row_data) -> str:
+        title, _, _ = partition_bounds(row_data[HEADERS.index("تاریخ")])
+        with self._lock:
+            new_file = title not in self.rows
+            with open(self._path(title), "a", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(SHEET_HEADERS)
+                writer.writerow(row_data)
+            self.rows[title] = self.rows.get(title, 0) + 1
+            return make_row_ref(title, self.rows[title] + 1)
+
+    def read(self, start_date: str = None, end_date: str = None):
+        for title in sorted(self.rows):
+            with open(self._path(title), newline="", encoding="utf-8") as f:
+                rows = list(csv.reader(f))
+            for row_number, row in enumerate(rows[1:], start=2):
+                row = row_to_dict(row)
+                date = str(row.get("تاریخ", ""))[:10]
+                if (start_date and date < start_date) or (end_date and date > end_date):
+                    continue
+                yield make_row_ref(title, row_number), row
+
+def read_transactions(branch: Branch = None, start_date: str = None, end_date: str = None):
+    """Yield (row reference, header-keyed row) for saved transactions in a date range."""
+    branch = branch or current_branch()
+    return branch.store.ensure_loaded().read(start_date, end_date)
+
+def load_document_counters(branch: Branch = None) -> dict:
+    """Read all document counters from the branch's storage."""
+    branch = branch or current_branch()
+    counters = branch.store.ensure_loaded().document_counters()
+    branch.document_counters.clear()
+    branch.document_counters.update(counters)
+    return counters
+
+def get_document_counter(transaction_type: str):
+    """Return the last document number for a transaction type, served from the warm cache."""
+    if transaction_type not in DOCUMENT_COUNTER_CELLS:
+        return None
+    branch = current_branch()
+    if _sheets_writer is not None:
+        # Worker process: the writer keeps the counters current in the shared store
+        counters = _shared_store.get("cache", f"document_counters:{branch.name}", {})
+        if counters.get(transaction_type) is not None:
+            return counters[transaction_type]
+    if transaction_type not in branch.document_counters:
+        load_document_counters(branch)
+    return branch.document_counters.get(transaction_type)
+
+def note_document_counters(rows: list, branch: Branch) -> None:
+    """Move the cached counters to the document numbers of rows just saved, so prompts stay in memory."""
+    for row_data in rows:
+        transaction_type = str(row_data[HEADERS.index("نوع تراکنش")])
+        number = row_data[HEADERS.index("شماره سند")]
+        if transaction_type in DOCUMENT_COUNTER_CELLS and str(number).strip():
+            branch.document_counters[transaction_type] = number
+
+# Add these functions to fetch and update partner names
+
+# Arabic letter forms and separators folded away before comparing partner names
+_PARTNER_NAME_TRANSLATION = str.maketrans({
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه", "أ": "ا", "إ": "ا", "آ": "ا",
+    "\u200c": " ", "\u200f": "", "\u200e": "", "ـ": ""
+})
+
+def normalize_partner_name(name: str) -> str:
+    """Normalize a partner name so Persian/Arabic spelling variants compare equal."""
+    name = to_english_number(str(name)).translate(_PARTNER_NAME_TRANSLATION)
+    return " ".join(name.split())
+
+def read_partner_column(branch: Branch = None):
+    """Read the "نام مشتری" column of the GreenLand worksheet.
+
+    Returns (worksheet, 1-based column index, column values without the header).
+    """
+    worksheet = get_spreadsheet(branch).worksheet("GreenLand")
+    # Find the column by header name instead of assuming position
+    headers = worksheet.row_values(1)
+    try:
+        # Find column index for "نام مشتری"
+        header_index = headers.index("نام مشتری") + 1  # Convert to 1-based index for gspread
+    except ValueError:
+        raise ValueError(f"Header 'نام مشتری' not found in worksheet. Available headers: {headers}")
+    return worksheet, header_index, worksheet.col_values(header_index)[1:]
+
+class PartnerDirectory(ABC):
+    """Local index of a branch's partner names with a queue of new names waiting to be written.
+
+    Duplicate checks are set lookups on normalized names. New names are
+    written in one batch per flush and are kept in the shared store until
+    then, so a crash before the flush doesn't lose them. Subclasses provide
+    the reading and writing for their storage.
+    """
+
+    def __init__(self, branch: Branch):
+        self.branch = branch
+        self.names = None
+        self._keys = set()
+        self._pending = []
+        self._lock = threading.Lock()
+        # Held while a batch is written, so flushes never overlap and adds never wait for the network
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    @property
+    def loaded(self) -> bool:
+        return self.names is not None
+
+    def load(self) -> None:
+        """Read the stored names once and index them."""
+        stored_names = self._read_names()
+        with self._lock:
+            self.names = [name for name in stored_names if name.strip()]
+            self._keys = {normalize_partner_name(name) for name in self.names}
+            # Names queued before a restart, then names queued since; those already stored are dropped
+            queued = _shared_store.get("partner_queue", self.branch.name, []) if _shared_store is not None else []
+            pending = []
+            for name in queued + self._pending:
+                key = normalize_partner_name(name)
+                if key not in self._keys:
+                    self.names.append(name)
+                    self._keys.add(key)
+                    pending.append(name)
+            self._pending = pending
+            self._save_queue()
+        logger.info("Found %d partner names: %s...", len(self.names), self.names[:5])
+
+    def contains(self, name: str) -> bool:
+        return normalize_partner_name(name) in self._keys
+
+    def add(self, name: str) -> bool:
+        """Queue a new partner name; return False if it (or a spelling variant) already exists."""
+        name = " ".join(name.split())
+        key = normalize_partner_name(name)
+        with self._lock:
+            if not key or key in self._keys:
+                return False
+            self._keys.add(key)
+            self.names.append(name)
+            self._pending.append(name)
+            self._save_queue()
+        return True
+
+    def _save_queue(self) -> None:
+        # Called with the lock held
+        if _shared_store is not None:
+            _shared_store.set("partner_queue", self.branch.name, self._pending)
+
+    def flush_due(self, interval: float) -> bool:
+        return bool(self._pending) and time.monotonic() - self._last_flush >= interval
+
+    def flush(self) -> int:
+        """Write all queued names in one batch and return how many were written."""
+        with self._flush_lock:
+            # Take the queue under the lock and write it outside, so adds don't wait for the write
+            with self._lock:
+                self._last_flush = time.monotonic()
+                pending, self._pending = self._pending, []
+            if not pending:
+                return 0
+            try:
+                self._write_names(pending)
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = pending
+                raise
+            with self._lock:
+                self._save_queue()
+        return len(pending)
+
+    @abstractmethod
+    def _read_names(self) -> list:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _write_names(self, names: list) -> None:
+        raise NotImplementedError
+
+class SheetsPartnerDirectory(PartnerDirectory):
+    """Partner names in the "نام مشتری" column of the GreenLand worksheet.
+
+    Rows are allocated under the flush lock so two batches can never claim
+    the same rows, and are read back before writing so names typed into the
+    sheet by hand are never overwritten.
+    """
+
+    def __init__(self, branch: Branch):
+        super().__init__(branch)
+        self._worksheet = None
+        self._column = None
+        self._next_row = None
+
+    def _read_names(self) -> list:
+        worksheet, column, partner_column = read_partner_column(self.branch)
+        with self._lock:
+            self._worksheet = worksheet
+            self._column = column
+            # Queued names go after the column
+            self._next_row = len(partner_column) + 2  # +2 because col_values skips header and gspread is 1-based
+        return partner_column
+
+    def _write_names(self, names: list) -> None:
+        from gspread.utils import rowcol_to_a1
+
+        while True:
+            start_row = self._next_row
+            end_row = start_row + len(names) - 1
+            cell_range = f"{rowcol_to_a1(start_row, self._column)}:{rowcol_to_a1(end_row, self._column)}"
+            if not any(str(cell).strip() for row in self._worksheet.get(cell_range) for cell in row):
+                break
+            # Names were typed below the column since it was read; continue after them
+            self._next_row = max(len(self._worksheet.col_values(self._column)) + 1, start_row + 1)
+            logger.warning("Rows %d-%d of the partner column are not empty; moving to row %d",
+                           start_row, end_row, self._next_row)
+        self._worksheet.update(cell_range, [[name] for name in names])
+        self._next_row = end_row + 1
+        logger.info("Wrote %d new partner names to rows %d-%d", len(names), start_row, end_row)
+
+class SQLitePartnerDirectory(PartnerDirectory):
+    """Partner names in the partners table of LOCAL_STORE_PATH."""
+
+    def _read_names(self) -> list:
+        self._conn, self._db_lock = local_connection(LOCAL_STORE_PATH)
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT name FROM partners WHERE branch = ? ORDER BY rowid", (self.branch.name,)
+            ).fetchall()
+        return [name for (name,) in rows]
+
+    def _write_names(self, names: list) -> None:
+        with self._db_lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO partners (branch, name) VALUES (?, ?)",
+                [(self.branch.name, name) for name in names]
+            )
+            self._conn.commit()
+
+class CSVPartnerDirectory(PartnerDirectory):
+    """Partner names in CSV_ARCHIVE_DIR/<branch>/partners.csv, one per line."""
+
+    def _read_names(self) -> list:
+        directory = os.path.join(CSV_ARCHIVE_DIR, self.branch.name)
+        os.makedirs(directory, exist_ok=True)
+        self._path = os.path.join(directory, "partners.csv")
+        if not os.path.exists(self._path):
+            return []
+        with open(self._path, newline="", encoding="utf-8") as f:
+            return [row[0] for row in csv.reader(f) if row]
+
+    def _write_names(self, names: list) -> None:
+        with open(self._path, "a", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows([name] for name in names)
+
+# Storage backend name -> (TransactionStore class, PartnerDirectory class)
+STORAGE_BACKENDS = {
+    "sheets": (SheetsTransactionStore, SheetsPartnerDirectory),
+    "sqlite": (SQLiteTransactionStore, SQLitePartnerDirectory),
+    "csv": (CSVTransactionStore, CSVPartnerDirectory),
+}
+
+def flush_partner_queue() -> None:
+    """Write every branch's queued partner names, logging instead of raising so callers can retry later."""
+    for branch in get_branches().values():
+        try:
+            branch.partner_index.flush()
+        except Exception as e:
+            logger.error("Error writing new partner names for branch '%s' (will retry): %s", branch.name, e)
+
+def get_partner_names(branch: Branch = None):
+    """Return partner names from the local index, loading it on first use."""
+    branch = branch or current_branch()
+    partner_index = branch.partner_index
+    if _sheets_writer is not None:
+        # Worker process: the writer keeps the partner list current in the shared store
+        shared_names = _shared_store.get("cache", f"partners:{branch.name}")
+        if shared_names:
+            return shared_names
+    if not partner_index.loaded:
+        try:
+            partner_index.load()
+        except Exception as e:
+            # Don't cache a failed fetch; try again next time
+            logger.error("Error fetching partner names: %s", e)
             return []
+    return partner_index.names
+
+def add_partner_name_to_sheet(name, branch: Branch = None):
+    """Add a new partner name to the GreenLand worksheet.
+
+    The name is checked against the local index and queued; the queue is
+    written to the sheet in batches by flush_partner_queue().
+    """
+    branch = branch or current_branch()
+    partner_index = branch.partner_index
+    if _sheets_writer is not None:
+        return _sheets_writer.call("add_partner", {"branch": branch.name, "name": name})
+    if not partner_index.loaded:
+        try:
+            partner_index.load()
         except Exception as e:
-            logger.error(f"Error fetching partner names: {e}")
+            logger.error("Error adding partner name: %s", e)
+            return False
+
+    added = partner_index.add(name)
+    if added:
+        publish_shared_caches()
+    return added
+
+# In-memory indexes over the Transactions rows. Every branch gets its own instance
+# of each registered index; they are seeded from one full read at startup and fed
+# every row saved afterwards, so lookups never hit Sheets.
+_row_index_factories = {}
+
+# True in the Sheets writer process, which mirrors indexed rows into the shared store for the workers
+_publish_rows = False
+
+def register_row_index(name: str, factory):
+    """Register an index class that every branch should build over its Transactions rows."""
+    _row_index_factories[name] = factory
+    return factory
+
+def branch_index(name: str, branch: Branch = None):
+    """Return the current branch's instance of a registered row index."""
+    return (branch or current_branch()).indexes[name]
+
+def row_to_dict(row) -> dict:
+    """Map a Transactions row (list in HEADERS order) to a header-keyed dict."""
+    return {header: (row[i] if i < len(row) else "") for i, header in enumerate(HEADERS)}
+
+def index_row(row_ref: str, row: dict, branch: Branch = None) -> None:
+    """Feed one Transactions row to every index of a branch."""
+    branch = branch or current_branch()
+    with branch.index_lock:
+        for index in branch.indexes.values():
+            index.add(row_ref, row)
+        branch.indexed_seq += 1
+        seq = branch.indexed_seq
+    if _publish_rows:
+        _shared_store.set(f"rows:{branch.name}", str(seq), {"ref": row_ref, "row": row})
+        _shared_store.set("cache", f"row_seq:{branch.name}", seq)
+
+def reindex_row(row_ref: str, old_row: dict, row: dict, branch: Branch = None) -> None:
+    """Replace an edited row in every index of a branch."""
+    branch = branch or current_branch()
+    with branch.index_lock:
+        for index in branch.indexes.values():
+            index.remove(row_ref, old_row)
+            index.add(row_ref, row)
+        branch.indexed_seq += 1
+        seq = branch.indexed_seq
+    if _publish_rows:
+        _shared_store.set(f"rows:{branch.name}", str(seq), {"ref": row_ref, "row": row, "old": old_row})
+        _shared_store.set("cache", f"row_seq:{branch.name}", seq)
+
+def seed_row_indexes(branch: Branch = None) -> int:
+    """Read a branch's Transactions partitions once and build all its indexes from them."""
+    branch = branch or current_branch()
+    rows = list(read_transactions(branch))
+    with branch.index_lock:
+        for index in branch.indexes.values():
+            index.clear()
+        for row_ref, row in rows:
+            for index in branch.indexes.values():
+                index.add(row_ref, row)
+        branch.indexed_seq = len(rows)
+    if _publish_rows:
+        _shared_store.set_many(
+            f"rows:{branch.name}",
+            {str(seq): {"ref": row_ref, "row": row} for seq, (row_ref, row) in enumerate(rows, start=1)}
+        )
+        _shared_store.set("cache", f"row_seq:{branch.name}", len(rows))
+    logger.info("Indexed %d transaction rows for branch '%s'", len(rows), branch.name)
+    return len(rows)
+
+def refresh_row_indexes(branch: Branch = None) -> None:
+    """In a worker process, pull rows saved by the writer since the last refresh."""
+    if _sheets_writer is None:
+        return
+    branch = branch or current_branch()
+    shared_seq = _shared_store.get("cache", f"row_seq:{branch.name}", 0)
+    with branch.index_lock:
+        for seq in range(branch.indexed_seq + 1, shared_seq + 1):
+            entry = _shared_store.get(f"rows:{branch.name}", str(seq))
+            if entry is not None and "old" in entry:
+                reindex_row(entry["ref"], entry["old"], entry["row"], branch)
+            elif entry is not None:
+                index_row(entry["ref"], entry["row"], branch)
+            else:
+                branch.indexed_seq = seq
+
+def normalize_receipt(value) -> str:
+    """Normalize a receipt number typed by a user or read back from the sheet."""
+    text = to_english_number(str(value)).strip().replace(",", "")
+    if text.endswith(".0") and text[:-2].isdigit():
+        text = text[:-2]
+    return text
+
+class ReceiptIndex:
+    """Hash index of (transaction type, receipt number) to the row that used it."""
+
+    def __init__(self):
+        self._rows = {}
+
+    def clear(self) -> None:
+        self._rows.clear()
+
+    def add(self, row_ref: str, row: dict) -> None:
+        receipt = normalize_receipt(row.get("شماره سند", ""))
+        if receipt:
+            self._rows[(row.get("نوع تراکنش", ""), receipt)] = (row_ref, row)
+
+    def remove(self, row_ref: str, row: dict) -> None:
+        key = (row.get("نوع تراکنش", ""), normalize_receipt(row.get("شماره سند", "")))
+        if self._rows.get(key, (None,))[0] == row_ref:
+            del self._rows[key]
+
+    def lookup(self, transaction_type: str, receipt) -> tuple:
+        """Return (row reference, row) for an already used receipt number, or None."""
+        return self._rows.get((transaction_type, normalize_receipt(receipt)))
+
+register_row_index("receipts", ReceiptIndex)
+
+def parse_number(value):
+    """Parse a numeric cell or user input, returning None when it is not a number."""
+    try:
+        return float(to_english_number(str(value)).strip().replace(",", ""))
+    except ValueError:
+        return None
+
+def format_number(value: float) -> str:
+    """Format a number without a trailing .0 or float noise."""
+    return f"{round(value, 6):f}".rstrip("0").rstrip(".")
+
+class RateIndex:
+    """Latest and rolling-average deal rates per (deal type, direction), and the latest per partner."""
+
+    def __init__(self):
+        self._recent = {}
+        self._partner_rates = {}
+
+    def clear(self) -> None:
+        self._recent.clear()
+        self._partner_rates.clear()
+
+    def add(self, row_ref: str, row: dict) -> None:
+        if row.get("نوع تراکنش") != "معامله":
+            return
+        rate = parse_number(row.get("نرخ", ""))
+        if rate is None:
+            return
+        key = (row.get("نوع معامله", ""), row.get("جهت معامله", ""))
+        self._recent.setdefault(key, deque(maxlen=RATE_SUGGESTION_WINDOW)).append(rate)
+        partner = row.get("طرف حساب", "")
+        if partner:
+            self._partner_rates[(normalize_partner_name(partner),) + key] = rate
+
+    def remove(self, row_ref: str, row: dict) -> None:
+        # Suggestions only; the corrected rate is added as the most recent one
+        pass
+
+    def suggestions(self, deal_type: str, deal_direction: str, partner: str = None) -> list:
+        """Return (label, rate) pairs to offer at the rate prompt, without duplicates."""
+        suggestions = []
+        if partner:
+            rate = self._partner_rates.get((normalize_partner_name(partner), deal_type, deal_direction))
+            if rate is not None:
+                suggestions.append((f"آخرین نرخ {partner}", rate))
+        recent = self._recent.get((deal_type, deal_direction))
+        if recent:
+            suggestions.append(("آخرین نرخ", recent[-1]))
+            if len(recent) > 1:
+                suggestions.append((f"میانگین {len(recent)} معامله", sum(recent) / len(recent)))
+        seen = set()
+        unique = []
+        for label, rate in suggestions:
+            text = format_number(rate)
+            if text not in seen:
+                seen.add(text)
+                unique.append((label, text))
+        return unique
+
+register_row_index("rates", RateIndex)
+
+# Balance unit for gold received and paid out, counted as fine gold (وزن × عیار / 1000)
+FINE_GOLD_UNIT = "طلای خالص"
+
+def fine_gold(row: dict):
+    """Return the fine-gold grams of a row's weight and purity, or None if either is missing."""
+    weight = parse_number(row.get("وزن", ""))
+    purity = parse_number(row.get("عیار", ""))
+    if weight is None or purity is None:
+        return None
+    return weight * purity / 1000
+
+def transaction_movements(row: dict) -> list:
+    """Return the (partner, unit, amount) balance changes of a Transactions row.
+
+    A positive amount means we owe the partner more (they are بستانکار):
+    gold received from them, a deal where we sell to them (we owe delivery),
+    or a حواله they give. Payments, purchases and حواله received go the other way.
+    """
+    transaction_type = row.get("نوع تراکنش", "")
+    if transaction_type in ("دریافت", "پرداخت"):
+        amount = fine_gold(row)
+        if amount is None or not row.get("طرف حساب"):
             return []
-    except gspread.exceptions.WorksheetNotFound:
-        logger.error(f"Worksheet 'Green land' not found. Please check the name.")
+        sign = 1 if transaction_type == "دریافت" else -1
+        return [(row["طرف حساب"], FINE_GOLD_UNIT, sign * amount)]
+    amount = parse_number(row.get("مقدار", ""))
+    unit = row.get("نوع معامله", "")
+    if amount is None or not unit:
         return []
-    except Exception as e:
-        logger.error(f"Error connecting to sheet: {e}")
+    if transaction_type == "معامله" and row.get("طرف حساب"):
+        sign = 1 if row.get("جهت معامله") == "Sell" else -1
+        return [(row["طرف حساب"], unit, sign * amount)]
+    if transaction_type == "حواله":
+        movements = []
+        if row.get("طرف پرداخت کننده"):
+            movements.append((row["طرف پرداخت کننده"], unit, amount))
+        if row.get("طرف دریافت کننده"):
+            movements.append((row["طرف دریافت کننده"], unit, -amount))
+        return movements
+    return []
+
+class BalanceIndex:
+    """Per-partner, per-unit running balances over the transaction dates.
+
+    Each (partner, unit) keeps a sorted list of dates and the cumulative balance
+    at the end of each date, so a balance on any day is one binary search.
+    Rows arriving in date order extend the lists; a back-dated row is held
+    aside and the series is rebuilt the next time it is queried.
+    """
+
+    def __init__(self):
+        self._series = {}
+        self._backdated = {}
+        self._units = {}
+        self._names = {}
+
+    def clear(self) -> None:
+        self._series.clear()
+        self._backdated.clear()
+        self._units.clear()
+        self._names.clear()
+
+    def add(self, row_ref: str, row: dict) -> None:
+        self._apply(row, 1)
+
+    def remove(self, row_ref: str, row: dict) -> None:
+        self._apply(row, -1)
+
+    def _apply(self, row: dict, sign: int) -> None:
+        date = str(row.get("تاریخ", ""))[:10]
+        if not date:
+            return
+        for partner, unit, amount in transaction_movements(row):
+            amount *= sign
+            partner_key = normalize_partner_name(partner)
+            self._names.setdefault(partner_key, partner)
+            self._units.setdefault(partner_key, set()).add(unit)
+            key = (partner_key, unit)
+            dates, sums = self._series.setdefault(key, ([], []))
+            if key in self._backdated or (dates and date < dates[-1]):
+                self._backdated.setdefault(key, []).append((date, amount))
+            elif dates and date == dates[-1]:
+                sums[-1] += amount
+            else:
+                dates.append(date)
+                sums.append((sums[-1] if sums else 0) + amount)
+
+    def _rebuild(self, key) -> None:
+        dates, sums = self._series[key]
+        changes = [(date, total - (sums[i - 1] if i else 0)) for i, (date, total) in enumerate(zip(dates, sums))]
+        changes.extend(self._backdated.pop(key))
+        changes.sort(key=lambda change: change[0])
+        dates.clear()
+        sums.clear()
+        for date, amount in changes:
+            if dates and date == dates[-1]:
+                sums[-1] += amount
+            else:
+                dates.append(date)
+                sums.append((sums[-1] if sums else 0) + amount)
+
+    def partner_name(self, partner: str) -> str:
+        """Return the spelling of a partner as first seen in the ledger, or None if unknown."""
+        return self._names.get(normalize_partner_name(partner))
+
+    def balances_as_of(self, partner: str, date: str) -> dict:
+        """Return {unit: balance} for a partner at the end of a date (YYYY-MM-DD)."""
+        partner_key = normalize_partner_name(partner)
+        balances = {}
+        for unit in sorted(self._units.get(partner_key, ())):
+            key = (partner_key, unit)
+            if key in self._backdated:
+                self._rebuild(key)
+            dates, sums = self._series[key]
+            position = bisect.bisect_right(dates, date)
+            if position:
+                balances[unit] = sums[position - 1]
+        return balances
+
+register_row_index("balances", BalanceIndex)
+
+class HistoryIndex:
+    """Saved rows by partner name, receipt number and date, newest first, for /history."""
+
+    def __init__(self):
+        self._rows = []
+        self._refs = {}
+        self._positions = {}
+
+    def clear(self) -> None:
+        self._rows.clear()
+        self._refs.clear()
+        self._positions.clear()
+
+    @staticmethod
+    def _keys(row: dict) -> set:
+        keys = {("date", str(row.get("تاریخ", ""))[:10]), ("receipt", normalize_receipt(row.get("شماره سند", "")))}
+        for header in ("طرف حساب", "طرف پرداخت کننده", "طرف دریافت کننده"):
+            if row.get(header):
+                keys.add(("partner", normalize_partner_name(row[header])))
+        return {key for key in keys if key[1]}
+
+    def add(self, row_ref: str, row: dict) -> None:
+        position = self._refs.get(row_ref)
+        if position is None:
+            position = self._refs[row_ref] = len(self._rows)
+            self._rows.append((row_ref, row))
+        else:
+            self._rows[position] = (row_ref, row)
+        for key in self._keys(row):
+            self._positions.setdefault(key, []).append(position)
+
+    def remove(self, row_ref: str, row: dict) -> None:
+        position = self._refs.get(row_ref)
+        for key in self._keys(row):
+            if position in self._positions.get(key, ()):
+                self._positions[key].remove(position)
+
+    def get(self, row_ref: str) -> dict:
+        """Return the indexed row saved at a row reference, or None."""
+        position = self._refs.get(row_ref)
+        return None if position is None else self._rows[position][1]
+
+    def lookup(self, text: str) -> list:
+        """Return (row reference, row) pairs matching a date, a receipt number or a partner name, newest first."""
+        text = " ".join(text.split())
+        try:
+            key = ("date", parse_date_argument(text))
+        except ValueError:
+            key = ("receipt", normalize_receipt(text))
+        if key not in self._positions:
+            key = ("partner", normalize_partner_name(text))
+        positions = self._positions.get(key, [])
+        positions = sorted(positions, key=lambda position: (str(self._rows[position][1].get("تاریخ", ""))[:10], position), reverse=True)
+        return [self._rows[position] for position in positions]
+
+register_row_index("history", HistoryIndex)
+
+class PacketIndex:
+    """Lifecycle of gold packets by pack number: received (دریافت) and paid out (پرداخت).
+
+    Open packets and their total grams and fine gold are kept up to date on
+    every change, so status lookups and the open totals are O(1).
+    """
+
+    def __init__(self):
+        self._events = {}
+        self._open = {}
+        self.open_weight = 0.0
+        self.open_fine_gold = 0.0
+
+    def clear(self) -> None:
+        self._events.clear()
+        self._open.clear()
+        self.open_weight = 0.0
+        self.open_fine_gold = 0.0
+
+    def add(self, row_ref: str, row: dict) -> None:
+        pack = normalize_receipt(row.get("شماره پاکت", ""))
+        if pack and row.get("نوع تراکنش") in ("دریافت", "پرداخت"):
+            self._events.setdefault(pack, []).append((row_ref, row))
+            self._refresh(pack)
+
+    def remove(self, row_ref: str, row: dict) -> None:
+        pack = normalize_receipt(row.get("شماره پاکت", ""))
+        if pack in self._events:
+            self._events[pack] = [event for event in self._events[pack] if event[0] != row_ref]
+            self._refresh(pack)
+
+    def _refresh(self, pack: str) -> None:
+        previous = self._open.pop(pack, None)
+        if previous is not None:
+            self.open_weight -= previous["weight"]
+            self.open_fine_gold -= previous["fine_gold"]
+        status = self.status(pack)
+        if status and status["state"] == "open":
+            self._open[pack] = status
+            self.open_weight += status["weight"]
+            self.open_fine_gold += status["fine_gold"]
+
+    def status(self, pack) -> dict:
+        """Return the packet's state ("open" or "paid"), receipt details and events, or None if unknown.
+
+        The state follows the latest event by date, then save time, then save
+        order, so a packet received again after a payment is open again.
+        """
+        events = self._events.get(normalize_receipt(pack))
+        if not events:
+            return None
+        # Back-dated rows are saved out of order; sorted() keeps save order for equal keys
+        events = sorted(events, key=lambda event: (str(event[1].get("تاریخ", ""))[:10], str(event[1].get("زمان ثبت", ""))))
+        received = [row for _, row in events if row.get("نوع تراکنش") == "دریافت"]
+        if not received:
+            return None
+        row = received[-1]
+        paid = events[-1][1].get("نوع تراکنش") == "پرداخت"
+        return {
+            "pack": normalize_receipt(pack),
+            "state": "paid" if paid else "open",
+            "name": row.get("اسم ریگیری", ""),
+            "partner": row.get("طرف حساب", ""),
+            "date": str(row.get("تاریخ", ""))[:10],
+            "weight": parse_number(row.get("وزن", "")) or 0.0,
+            "purity": row.get("عیار", ""),
+            "fine_gold": fine_gold(row) or 0.0,
+            "events": list(events),
+        }
+
+    def open_packets(self) -> list:
+        """Statuses of the packets still held, oldest receipt first."""
+        return sorted(self._open.values(), key=lambda status: (status["date"], status["pack"]))
+
+register_row_index("packets", PacketIndex)
+
+class TransferIndex:
+    """Net position of every partner per currency from حواله transfers.
+
+    A giver's position goes up and a receiver's goes down by the amount, so a
+    positive position means the partner is owed (creditor) and a negative one
+    that they owe (debtor). Recording the suggested settlements as حواله
+    brings the positions back to zero.
+    """
+
+    def __init__(self):
+        self._net = {}
+        self._names = {}
+
+    def clear(self) -> None:
+        self._net.clear()
+        self._names.clear()
+
+    def add(self, row_ref: str, row: dict) -> None:
+        self._apply(row, 1)
+
+    def remove(self, row_ref: str, row: dict) -> None:
+        self._apply(row, -1)
+
+    def _apply(self, row: dict, sign: int) -> None:
+        if row.get("نوع تراکنش") != "حواله":
+            return
+        for partner, unit, amount in transaction_movements(row):
+            partner_key = normalize_partner_name(partner)
+            self._names.setdefault(partner_key, partner)
+            positions = self._net.setdefault(unit, {})
+            positions[partner_key] = positions.get(partner_key, 0) + sign * amount
+
+    def units(self) -> list:
+        return sorted(self._net)
+
+    def positions(self, unit: str) -> dict:
+        """Return {partner name: net position} for a currency, leaving out settled partners."""
+        return {
+            self._names[partner_key]: amount
+            for partner_key, amount in self._net.get(unit, {}).items() if round(amount, 6) != 0
+        }
+
+register_row_index("transfers", TransferIndex)
+
+def minimal_settlements(positions: dict) -> list:
+    """Return (debtor, creditor, amount) transfers that bring every position to zero.
+
+    Greedy min-cash-flow: the largest debtor pays the largest creditor as much
+    as one of them can, and whoever has a remainder goes back on its heap.
+    O(n log n) in the number of partners and at most n - 1 transfers.
+    """
+    creditors = [(-amount, name) for name, amount in positions.items() if amount > 0]
+    debtors = [(amount, name) for name, amount in positions.items() if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append((debtor, creditor, amount))
+        if round(-credit - amount, 6) > 0:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if round(-debt - amount, 6) > 0:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return transfers
+
+def derived_values(row: dict) -> list:
+    """Compute the DERIVED_HEADERS values of a row: fine gold, deal value, signed amount and version."""
+    gold = fine_gold(row) if row.get("نوع تراکنش") in ("دریافت", "پرداخت") else None
+    deal_value = None
+    if row.get("نوع تراکنش") == "معامله":
+        amount = parse_number(row.get("مقدار", ""))
+        rate = parse_number(row.get("نرخ", ""))
+        if amount is not None and rate is not None:
+            deal_value = amount * rate
+    # The balance change of the row's own partner; حواله rows move two partners and have none
+    signed = next((amount for partner, _, amount in transaction_movements(row) if partner == row.get("طرف حساب")), None)
+    return ["" if value is None else round(value, 6) for value in (gold, deal_value, signed)] + [DERIVED_VERSION]
+
+def backfill_derived_columns(branch: Branch = None) -> int:
+    """Write derived values into saved rows that lack them or have an older version; return the rows written.
+
+    The partitions are processed in windows of BACKFILL_BATCH_ROWS rows, so
+    saves wait for at most one window and, in multi-process mode, every
+    writer request stays well within WRITER_TIMEOUT.
+    """
+    branch = branch or current_branch()
+    written, cursor = 0, None
+    while True:
+        if _sheets_writer is not None:
+            step_written, cursor = _sheets_writer.call("backfill_derived", {"branch": branch.name, "cursor": cursor})
+        else:
+            step_written, cursor = backfill_derived_step(branch, cursor)
+        written += step_written
+        if cursor is None:
+            return written
+
+def backfill_derived_step(branch: Branch, cursor) -> tuple:
+    """Backfill one window of rows starting at `cursor` ((title, first row), or None for the start).
+
+    The window is read with one ranged read and its stale rows are written
+    back in one batched update of the derived columns only, under the write
+    lock. Returns (rows written, cursor of the next window or None when done).
+    """
+    catalog = setup_google_sheets(branch)
+    titles = catalog.overlapping()
+    if not titles:
+        return 0, None
+    title, first_row = cursor or (titles[0], 2)
+    first_column = column_letter(len(HEADERS) + 1)
+    last_column = column_letter(len(SHEET_HEADERS))
+    version_column = len(SHEET_HEADERS) - 1
+    # Reads past the end of the grid are rejected
+    last_row = min(first_row + BACKFILL_BATCH_ROWS - 1, catalog.worksheet(title).row_count)
+
+    with branch.write_lock:
+        rows = []
+        if first_row <= last_row:
+            rows = get_spreadsheet(branch).values_get(f"'{title}'!A{first_row}:{last_column}{last_row}").get("values", [])
+        # Consecutive stale rows become one range
+        runs = []
+        for row_number, row in enumerate(rows, start=first_row):
+            if not any(row) or (len(row) > version_column and str(row[version_column]) == str(DERIVED_VERSION)):
+                continue
+            values = derived_values(row_to_dict(row))
+            if runs and runs[-1][0] + len(runs[-1][1]) == row_number:
+                runs[-1][1].append(values)
+            else:
+                runs.append((row_number, [values]))
+        if runs:
+            get_spreadsheet(branch).values_batch_update({"valueInputOption": "RAW", "data": [
+                {"range": f"'{title}'!{first_column}{start}:{last_column}{start + len(values) - 1}", "values": values}
+                for start, values in runs
+            ]})
+        written = sum(len(values) for _, values in runs)
+        # Trailing empty rows are left out of the read, so a short window past the counted rows is the end
+        partition_done = last_row >= catalog.worksheet(title).row_count or (
+            len(rows) < BACKFILL_BATCH_ROWS and last_row > catalog.entries[title]["rows"])
+
+    if written:
+        logger.info("Backfilled derived columns of %d rows in '%s' (rows %d-%d)", written, title, first_row, last_row)
+    if not partition_done:
+        return written, (title, last_row + 1)
+    position = titles.index(title) + 1
+    return written, ((titles[position], 2) if position < len(titles) else None)
+
+def rate_suggestion_keyboard(transaction: dict, prefix: str):
+    """Build one-tap buttons for the recently used rates of a deal, or None if there are none."""
+    refresh_row_indexes()
+    suggestions = branch_index("rates").suggestions(
+        transaction.get("deal_type", ""),
+        transaction.get("deal_direction", ""),
+        transaction.get("partner_name")
+    )
+    if not suggestions:
+        return None
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{label}: {rate}", callback_data=f"{prefix}{rate}")]
+        for label, rate in suggestions
+    ])
+
+def append_transaction_row(row_data, idempotency_key: str = None, branch: Branch = None) -> str:
+    """Write a transaction row to the partition of its date and return the row reference.
+
+    A draft whose idempotency key was already committed is not written again;
+    the row it was saved in is returned instead.
+    """
+    branch = branch or current_branch()
+    if _sheets_writer is not None:
+        row_ref = _sheets_writer.call(
+            "append_transaction",
+            {"branch": branch.name, "row": row_data, "idempotency_key": idempotency_key}
+        )
+        refresh_row_indexes(branch)
+        return row_ref
+
+    with branch.write_lock:
+        if idempotency_key:
+            committed_ref = _committed_keys.get(idempotency_key)
+            if committed_ref is not None:
+                logger.info("Draft %s already saved in %s; skipping write", idempotency_key, committed_ref)
+                return committed_ref
+
+        row_ref = branch.store.ensure_loaded().append(row_data)
+        if idempotency_key:
+            _committed_keys.add(idempotency_key, row_ref)
+        index_row(row_ref, row_to_dict(row_data), branch)
+        record_ledger_row(row_ref, row_data, branch)
+        note_document_counters([row_data], branch)
+
+    return row_ref
+
+def append_transaction_rows(rows: list, idempotency_keys: list, branch: Branch = None) -> list:
+    """Write several transaction rows in one batch and return their row references.
+
+    Rows whose idempotency key was already committed are not written again.
+    """
+    branch = branch or current_branch()
+    if _sheets_writer is not None:
+        row_refs = _sheets_writer.call(
+            "append_transactions",
+            {"branch": branch.name, "rows": rows, "idempotency_keys": idempotency_keys}
+        )
+        refresh_row_indexes(branch)
+        return row_refs
+
+    with branch.write_lock:
+        row_refs = [_committed_keys.get(key) for key in idempotency_keys]
+        pending = [i for i, row_ref in enumerate(row_refs) if row_ref is None]
+        if pending:
+            written = branch.store.ensure_loaded().append_many([rows[i] for i in pending])
+            for i, row_ref in zip(pending, written):
+                row_refs[i] = row_ref
+                _committed_keys.add(idempotency_keys[i], row_ref)
+                index_row(row_ref, row_to_dict(rows[i]), branch)
+                record_ledger_row(row_ref, rows[i], branch)
+            note_document_counters([rows[i] for i in pending], branch)
+        if len(pending) < len(rows):
+            logger.info("%d basket rows were already saved; skipping them", len(rows) - len(pending))
+
+    return row_refs
+
+def record_ledger_row(row_ref: str, row_data, branch: Branch) -> None:
+    """Remember exactly what the bot wrote to a row, for reconciliation against the sheet."""
+    if _shared_store is not None and STORAGE_BACKEND == "sheets":
+        _shared_store.set(f"ledger:{branch.name}", row_ref, list(row_data))
+
+def cells_equal(old, new) -> bool:
+    """Compare two cell values, treating 1.5 and "1.5" (or 2 and 2.0) as the same."""
+    old_number, new_number = parse_number(old), parse_number(new)
+    if old_number is not None and new_number is not None:
+        return old_number == new_number
+    return str(old) == str(new)
+
+def read_saved_row(row_ref: str, branch: Branch = None) -> list:
+    """Read the current values of one saved row (a single-row read, never the whole sheet)."""
+    branch = branch or current_branch()
+    if _sheets_writer is not None:
+        return _sheets_writer.call("read_row", {"branch": branch.name, "row_ref": row_ref})
+    return branch.store.ensure_loaded().read_row(row_ref)
+
+def update_transaction_row(row_ref: str, original, row_data, branch: Branch = None) -> int:
+    """Write the cells of a saved row that differ from `original`; return how many were written.
+
+    The row is read again first and the update is refused if anything in it
+    changed since `original` was read, so a concurrent edit is never overwritten.
+    """
+    branch = branch or current_branch()
+    if _sheets_writer is not None:
+        written = _sheets_writer.call(
+            "update_transaction",
+            {"branch": branch.name, "row_ref": row_ref, "original": list(original), "row": list(row_data)}
+        )
+        refresh_row_indexes(branch)
+        return written
+
+    with branch.write_lock:
+        store = branch.store.ensure_loaded()
+        current = store.read_row(row_ref)
+        if all(cells_equal(new, now) for new, now in zip(row_data, current)):
+            # The row already holds the edit, e.g. a repeated confirm after the first one was written
+            return 0
+        if not all(cells_equal(old, now) for old, now in zip(original, current)):
+            raise ValueError("این ردیف پس از باز شدن برای ویرایش تغییر کرده است؛ لطفاً دوباره آن را باز کنید.")
+        changes = {
+            column: value for column, (old, value) in enumerate(zip(original, row_data))
+            if not cells_equal(old, value)
+        }
+        if changes:
+            store.update_cells(row_ref, changes)
+            reindex_row(row_ref, row_to_dict(original), row_to_dict(row_data), branch)
+            record_ledger_row(row_ref, row_data, branch)
+
+    if {HEADERS.index("نوع تراکنش"), HEADERS.index("شماره سند")} & set(changes):
+        # An edited document number may or may not be the latest one; re-read (callers run off the event loop)
+        load_document_counters(branch)
+    return len(changes)
+
+def block_bounds(block: int) -> tuple:
+    """First and last sheet row of a checksum block (row 1 is the header)."""
+    start = 2 + block * RECONCILE_BLOCK_ROWS
+    return start, start + RECONCILE_BLOCK_ROWS - 1
+
+def block_fingerprint_formulas(title: str, block: int) -> list:
+    """Sheet formulas computing a block's fingerprint, matching block_fingerprint()."""
+    start, end = block_bounds(block)
+    cells = f"'{title}'!A{start}:P{end}"
+    weight = f"(ROW({cells})*17+COLUMN({cells}))"
+    modulus = FINGERPRINT_MODULUS
+    # Each text cell: its characters' codes weighted by position, so equal-length edits still change it
+    text_hash = "SUMPRODUCT(UNICODE(MID(c,SEQUENCE(LEN(c)),1)),SEQUENCE(LEN(c)))"
+    return [
+        f"=MOD(SUM(MAP({cells},ARRAYFORMULA(MOD({weight},{modulus})),"
+        f"LAMBDA(c,w,IF(ISTEXT(c),MOD(w*MOD({text_hash},{modulus}),{modulus}),0)))),{modulus})",
+        f"=ARRAYFORMULA(SUMPRODUCT(IF(ISNUMBER({cells}),{cells},0)*{weight}))",
+        f"=COUNTA({cells})",
+    ]
+
+def text_hash(value) -> int:
+    """Position-weighted sum of a text's character codes, as the checksum formula computes it.
+
+    Sheets' LEN and MID count UTF-16 code units, so the codes are taken per unit.
+    """
+    units = str(value).encode("utf-16-le")
+    codes = (int.from_bytes(units[i:i + 2], "little") for i in range(0, len(units), 2))
+    return sum(code * position for position, code in enumerate(codes, start=1))
+
+def block_fingerprint(rows: dict) -> tuple:
+    """Fingerprint of rows (row number -> values): position-weighted text hashes, numbers, and cell count."""
+    text = number = count = 0
+    for row_number, values in rows.items():
+        for column, value in enumerate(values, start=1):
+            if value == "" or value is None:
+                continue
+            weight = row_number * 17 + column
+            count += 1
+            if isinstance(value, bool):
+                # Checkboxes are neither text nor numbers to ISTEXT/ISNUMBER
+                continue
+            if isinstance(value, (int, float)):
+                number += value * weight
+            else:
+                weight %= FINGERPRINT_MODULUS
+                text = (text + weight * (text_hash(value) % FINGERPRINT_MODULUS)) % FINGERPRINT_MODULUS
+    return text, number, count
+
+def fingerprints_match(expected: tuple, actual: list) -> bool:
+    try:
+        text, number, count = (float(value or 0) for value in actual[:3])
+    except ValueError:
+        return False
+    return (expected[0] == text and expected[2] == count
+            and math.isclose(expected[1], number, rel_tol=1e-9, abs_tol=1e-6))
+
+def pad_row(values) -> list:
+    values = list(values)[:len(HEADERS)]
+    return values + [""] * (len(HEADERS) - len(values))
+
+def describe_row_difference(row_ref: str, expected, actual) -> str:
+    """One report line for a row whose sheet contents differ from the bot's record."""
+    expected_empty = not any(str(value) for value in expected)
+    actual_empty = not any(str(value) for value in actual)
+    if expected_empty:
+        return f"➕ {format_row_ref(row_ref)}: ردیفی که ربات ثبت نکرده است"
+    if actual_empty:
+        return f"➖ {format_row_ref(row_ref)}: ردیف حذف شده است"
+    changed = [header for header, old, new in zip(HEADERS, expected, actual) if str(old) != str(new)]
+    return f"✏️ {format_row_ref(row_ref)}: تغییر در {'، '.join(changed)}"
+
+def checksum_worksheet(branch: Branch):
+    """Return the branch's checksum worksheet, creating it (hidden) on first use."""
+    import gspread
+
+    spreadsheet = get_spreadsheet(branch)
+    try:
+        worksheet = spreadsheet.worksheet(CHECKSUM_SHEET)
+    except gspread.WorksheetNotFound:
+        worksheet = spreadsheet.add_worksheet(title=CHECKSUM_SHEET, rows=1000, cols=len(CHECKSUM_HEADERS))
+        worksheet.update('A1', [CHECKSUM_HEADERS])
+        worksheet.hide()
+        return worksheet
+    if worksheet.col_count < len(CHECKSUM_HEADERS):
+        # Checksum sheets from before the formula version column
+        worksheet.add_cols(len(CHECKSUM_HEADERS) - worksheet.col_count)
+        worksheet.update('A1', [CHECKSUM_HEADERS])
+    return worksheet
+
+def reconcile_branch(branch: Branch) -> list:
+    """Compare a branch's Transactions sheets with the bot's record of the rows it wrote.
+
+    Block fingerprints are computed by formulas in the checksum worksheet, so
+    a clean check is a single ranged read. Only blocks whose fingerprint
+    differs from the one computed from the record are downloaded and compared
+    row by row. Afterwards the record follows the sheet, so every difference
+    is reported once. Blocks seen for the first time become the baseline.
+
+    The write lock is held only while the record is copied and written back,
+    never across Sheets calls. Rows the bot saved while the check was running
+    are neither reported nor overwritten.
+    """
+    catalog = setup_google_sheets(branch)
+    ledger_namespace = f"ledger:{branch.name}"
+    with branch.write_lock:
+        partition_rows = {title: entry["rows"] for title, entry in catalog.entries.items()}
+        snapshot = _shared_store.items(ledger_namespace)
+        baselined = _shared_store.items(f"ledger_blocks:{branch.name}")
+
+    spreadsheet = get_spreadsheet(branch)
+    worksheet = checksum_worksheet(branch)
+    checksum_rows = spreadsheet.values_get(
+        f"'{CHECKSUM_SHEET}'!A2:F", params={"valueRenderOption": "UNFORMATTED_VALUE"}
+    ).get("values", [])
+    checksums = {}
+    # Rows whose formulas predate the current fingerprint, by block
+    outdated = {}
+    for row_number, row in enumerate(checksum_rows, start=2):
+        if len(row) < 2:
+            continue
+        key = (str(row[0]), int(row[1]))
+        if len(row) >= 6 and str(row[5]) == str(FINGERPRINT_VERSION):
+            checksums[key] = row[2:5]
+        else:
+            outdated[key] = row_number
+
+    # Every block up to and including the first one past each partition's last row
+    blocks = [(title, block) for title, rows in partition_rows.items()
+              for block in range(rows // RECONCILE_BLOCK_ROWS + 1)]
+    missing = [key for key in blocks if key not in checksums and key not in outdated]
+    first_row = len(checksum_rows) + 2
+    positions = [(outdated[key], key) for key in blocks if key in outdated]
+    positions += [(first_row + i, key) for i, key in enumerate(missing)]
+    if positions:
+        if first_row + len(missing) > worksheet.row_count:
+            worksheet.add_rows(len(missing) + 1000)
+        # These blocks have no current fingerprint yet, so they are read in full below
+        spreadsheet.values_batch_update({
+            "valueInputOption": "USER_ENTERED",
+            "data": [{"range": f"'{CHECKSUM_SHEET}'!A{row_number}:F{row_number}",
+                      "values": [[title, block] + block_fingerprint_formulas(title, block) + [FINGERPRINT_VERSION]]}
+                     for row_number, (title, block) in positions]
+        })
+
+    ledger = {}
+    for row_ref, values in snapshot.items():
+        title, row_number = parse_row_ref(row_ref)
+        ledger.setdefault((title, (row_number - 2) // RECONCILE_BLOCK_ROWS), {})[row_number] = pad_row(values)
+
+    to_read = []
+    for title, block in blocks:
+        key = f"{title}:{block}"
+        if key not in baselined or (title, block) not in checksums:
+            to_read.append((title, block))
+        elif not fingerprints_match(block_fingerprint(ledger.get((title, block), {})), checksums[(title, block)]):
+            to_read.append((title, block))
+    if not to_read:
         return []
 
-def add_partner_name_to_sheet(name):
-    """Add a new partner name to the GreenLand worksheet."""
+    ranges = [f"'{title}'!A{block_bounds(block)[0]}:P{block_bounds(block)[1]}" for title, block in to_read]
+    value_ranges = spreadsheet.values_batch_get(
+        ranges, params={"valueRenderOption": "UNFORMATTED_VALUE"}).get("valueRanges", [])
+
+    differences = []
+    with branch.write_lock:
+        current = _shared_store.items(ledger_namespace)
+        for (title, block), value_range in zip(to_read, value_ranges):
+            start, _ = block_bounds(block)
+            actual = {start + offset: pad_row(values)
+                      for offset, values in enumerate(value_range.get("values", [])) if any(str(v) for v in values)}
+            expected = ledger.get((title, block), {})
+            # Rows saved or edited by the bot since the snapshot: the sheet may have been read before the write
+            settled = [n for n in set(expected) | set(actual)
+                       if snapshot.get(make_row_ref(title, n)) == current.get(make_row_ref(title, n))]
+            if f"{title}:{block}" in baselined:
+                for row_number in sorted(settled):
+                    old = expected.get(row_number, pad_row([]))
+                    new = actual.get(row_number, pad_row([]))
+                    if [str(value) for value in old] != [str(value) for value in new]:
+                        differences.append(describe_row_difference(make_row_ref(title, row_number), old, new))
+            # The sheet becomes the record for this block
+            for row_number in settled:
+                if row_number not in actual:
+                    _shared_store.delete(ledger_namespace, make_row_ref(title, row_number))
+            _shared_store.set_many(ledger_namespace, {
+                make_row_ref(title, n): actual[n] for n in settled if n in actual
+            })
+            _shared_store.set(f"ledger_blocks:{branch.name}", f"{title}:{block}", time.time())
+
+    logger.info(
+        "Reconciled branch '%s': %d blocks, %d read, %d differences",
+        branch.name, len(blocks), len(to_read), len(differences)
+    )
+    return differences
+
+def reconcile_ledgers() -> str:
+    """Reconcile every branch and return the report text, or None when nothing differs."""
+    sections = []
+    for branch in get_branches().values():
+        try:
+            differences = reconcile_branch(branch)
+        except Exception as e:
+            logger.error("Reconciliation failed for branch '%s': %s", branch.name, e)
+            differences = [f"❌ خطا در تطبیق: {e}"]
+        if differences:
+            lines = differences[:30]
+            if len(differences) > len(lines):
+                lines.append(f"... و {len(differences) - len(lines)} مورد دیگر")
+            sections.append(f"🔎 مغایرت‌های دفتر {branch.name}:\n" + "\n".join(lines))
+    _shared_store.set("cache", "reconciled_at", time.time())
+    return "\n\n".join(sections) or None
+
+def reconciliation_due() -> bool:
+    # Only Sheets can be edited by hand behind the bot's back
+    if RECONCILE_INTERVAL_HOURS <= 0 or STORAGE_BACKEND != "sheets":
+        return False
+    last = _shared_store.get("cache", "reconciled_at", 0)
+    return time.time() - last >= RECONCILE_INTERVAL_HOURS * 3600
+
+async def send_admin_report(bot: Bot, text: str) -> None:
+    """Send a report to the admin chat, or log it when no admin chat is configured."""
+    if not ADMIN_CHAT_ID:
+        logger.warning("ADMIN_CHAT_ID not set; report not sent:\n%s", text)
+        return
+    try:
+        await bot.send_message(int(ADMIN_CHAT_ID), text[:4096])
+    except Exception as e:
+        logger.error("Error sending report to admin chat: %s", e)
+
+class PartnerRanking:
+    """Per-user partner usage ranked by recency-weighted frequency, kept per transaction type.
+
+    Scores are decayed to the time of the last use before each new use adds 1,
+    so they stay small and comparable. Partners whose score has faded away are
+    dropped and at most `keep` partners are kept, so an entry never grows
+    without bound. Lookups just return the top-K list kept with the scores.
+    """
+
+    # Scores below this (about 10 half-lives without a use) are dropped
+    MIN_SCORE = 2 ** -10
+
+    def __init__(self, limit: int = PARTNER_PIN_COUNT, half_life_days: float = PARTNER_RANK_HALF_LIFE_DAYS,
+                 keep: int = PARTNER_RANK_KEEP):
+        self.limit = limit
+        self.half_life = half_life_days * 86400
+        self.keep = max(keep, limit)
+        self._stats = {}
+
+    def _entry(self, key: str) -> dict:
+        entry = self._stats.get(key)
+        if entry is None:
+            stored = _shared_store.get("partner_ranks", key) if _shared_store is not None else None
+            entry = stored or {"scores": {}, "top": [], "at": None}
+            self._stats[key] = entry
+        return entry
+
+    def top(self, user_id: int, transaction_type: str, branch: Branch = None) -> list:
+        """Return the user's most used partners for a transaction type, best first."""
+        key = f"{(branch or current_branch()).name}:{user_id}:{transaction_type}"
+        return self._entry(key)["top"]
+
+    def record(self, user_id: int, transaction_type: str, names, branch: Branch = None, now: float = None) -> None:
+        """Count one use of each partner name in a confirmed transaction."""
+        key = f"{(branch or current_branch()).name}:{user_id}:{transaction_type}"
+        entry = self._entry(key)
+        now = now or time.time()
+        scores = entry["scores"]
+        if "at" not in entry:
+            # Entries written before scores were decayed hold log2(sum of 2**(t / half_life))
+            scores = {name: 2 ** (score - now / self.half_life) for name, score in scores.items()}
+        elif entry["at"] is not None:
+            decay = 2 ** (-max(now - entry["at"], 0) / self.half_life)
+            scores = {name: score * decay for name, score in scores.items()}
+        for name in names:
+            if name:
+                scores[name] = scores.get(name, 0) + 1
+        ranked = sorted((name for name in scores if scores[name] >= self.MIN_SCORE), key=scores.get, reverse=True)
+        ranked = ranked[:self.keep]
+        entry.update(scores={name: scores[name] for name in ranked}, top=ranked[:self.limit], at=now)
+        if _shared_store is not None:
+            _shared_store.set("partner_ranks", key, entry)
+
+_partner_ranking = PartnerRanking()
+
+def create_partner_buttons(partner_names, prefix, pinned=()):
+    """Create inline keyboard buttons for partner names, with the pinned names first."""
+    keyboard = []
+    if pinned:
+        keyboard.append([InlineKeyboardButton(name, callback_data=f"{prefix}{name}") for name in pinned])
+        pinned_names = set(pinned)
+        partner_names = [name for name in partner_names if name not in pinned_names]
+    # Show partners in rows of 2
+    for i in range(0, len(partner_names), 2):
+        row = [InlineKeyboardButton(partner_names[i], callback_data=f"{prefix}{partner_names[i]}")]
+        if i + 1 < len(partner_names):
+            row.append(InlineKeyboardButton(partner_names[i+1], callback_data=f"{prefix}{partner_names[i+1]}"))
+        keyboard.append(row)
+    
+    # Add button to enter custom name
+    keyboard.append([InlineKeyboardButton("➕ افزودن نام جدید", callback_data=f"{prefix}ADD_NEW")])
+    
+    return keyboard
+
+def row_to_transaction(row: dict) -> dict:
+    """Turn a header-keyed Transactions row back into a draft-style transaction dict."""
+    transaction = {"type": row.get("نوع تراکنش", ""), "date": row.get("تاریخ", "")}
+    for header, key in FIELD_MAPPING.items():
+        value = row.get(header, "")
+        if str(value).strip() != "" or key == "description":
+            transaction[key] = value
+    return transaction
+
+def to_english_number(s):
+    """Convert Persian/Arabic digits in a string to English digits."""
+    if not isinstance(s, str):
+        return s
+    persian_digits = '۰۱۲۳۴۵۶۷۸۹'
+    arabic_digits = '٠١٢٣٤٥٦٧٨٩'
+    english_digits = '0123456789'
+    table = {}
+    for p, e in zip(persian_digits, english_digits):
+        table[ord(p)] = e
+    for a, e in zip(arabic_digits, english_digits):
+        table[ord(a)] = e
+    return s.translate(table)
+
+def count_api_call(context: ContextTypes.DEFAULT_TYPE, kind: str) -> None:
+    """Count an outbound Telegram call against the transaction in progress."""
+    calls = context.user_data.setdefault("api_calls", {})
+    calls[kind] = calls.get(kind, 0) + 1
+
+async def answer_query(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str = None, show_alert: bool = False) -> None:
+    """Answer the callback query of a button tap."""
+    count_api_call(context, "answer")
+    await update.callback_query.answer(text, show_alert=show_alert)
+
+async def edit_card(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, reply_markup=None) -> None:
+    """Replace the transaction card's text and keyboard, sending the card if there is none yet."""
+    card = context.user_data.get("card")
+    if card:
+        count_api_call(context, "edit")
+        try:
+            await context.bot.edit_message_text(
+                text, chat_id=card["chat_id"], message_id=card["message_id"], reply_markup=reply_markup
+            )
+            return
+        except BadRequest as e:
+            if "not modified" in str(e):
+                return
+            # The card was deleted or is too old to edit; start a new one
+            logger.warning("Could not edit transaction card: %s", e)
+
+    count_api_call(context, "send")
+    message = await context.bot.send_message(update.effective_chat.id, text, reply_markup=reply_markup)
+    context.user_data["card"] = {"chat_id": message.chat_id, "message_id": message.message_id}
+
+async def update_card(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str, reply_markup=None) -> None:
+    """Show the next step on the transaction card: the fields filled so far, any notice, and the prompt."""
+    transaction = context.user_data.get("transaction", {})
+    parts = []
+    if transaction.get("type"):
+        parts.append(format_transaction_summary(transaction, "🧾 تراکنش در حال ثبت:").rstrip())
+    notice = context.user_data.pop("card_notice", None)
+    if notice:
+        parts.append(notice)
+    parts.append(prompt)
+
+    if context.user_data.pop("card_show_duplicate", False):
+        rows = list(reply_markup.inline_keyboard) if reply_markup else []
+        rows.append([InlineKeyboardButton("نمایش تراکنش موجود", callback_data=CB_SHOW_DUPLICATE)])
+        reply_markup = InlineKeyboardMarkup(rows)
+
+    await edit_card(update, context, "\n\n".join(parts), reply_markup)
+
+def finish_transaction_card(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Log the Telegram calls the finished transaction took and reset the draft."""
+    calls = context.user_data.get("api_calls", {})
+    hot_logger.debug("Transaction finished with %d Telegram calls: %s", sum(calls.values()), calls)
+    context.user_data.clear()
+    context.user_data["last_api_calls"] = calls
+
+async def api_calls_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Report the outbound Telegram calls used by the user's last transaction."""
+    calls = context.user_data.get("last_api_calls")
+    if not calls:
+        await update.message.reply_text("هنوز تراکنشی ثبت نشده است.")
+        return
+    details = "\n".join(f"{kind}: {count}" for kind, count in sorted(calls.items()))
+    await update.message.reply_text(f"تعداد فراخوانی‌های Telegram در آخرین تراکنش: {sum(calls.values())}\n{details}")
+
+def parse_date_argument(text: str) -> str:
+    """Parse a typed date into YYYY-MM-DD, raising ValueError with a message for the user."""
+    text = to_english_number(text).strip().replace("/", "-")
+    try:
+        return datetime.strptime(text, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"تاریخ نامعتبر است: {text}\nنمونه: 2024-05-01")
+
+async def asof_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Report a partner's balance in each unit at the end of a given date."""
+    args = context.args or []
+    if not args:
+        await update.message.reply_text("استفاده: /asof طرف‌حساب تاریخ\nنمونه: /asof علی 2024-05-01")
+        return
+    date = datetime.now().strftime("%Y-%m-%d")
+    date_error = None
+    if len(args) > 1:
+        try:
+            date = parse_date_argument(args[-1])
+            args = args[:-1]
+        except ValueError as e:
+            # Not a date: the last word is part of the partner name and the date is today
+            date_error = str(e)
+
+    refresh_row_indexes()
+    index = branch_index("balances")
+    partner = index.partner_name(" ".join(args))
+    if partner is None:
+        message = f"تراکنشی برای «{' '.join(args)}» پیدا نشد."
+        if date_error:
+            message += f"\n{date_error}"
+        await update.message.reply_text(message)
+        return
+    balances = index.balances_as_of(partner, date)
+    lines = [f"مانده {partner} در پایان {date}:"]
+    for unit, balance in balances.items():
+        if round(balance, 6) == 0:
+            lines.append(f"• {unit}: تسویه")
+        else:
+            side = "بستانکار" if balance > 0 else "بدهکار"
+            lines.append(f"• {unit}: {format_number(abs(balance))} {side}")
+    if not balances:
+        lines.append("تا این تاریخ تراکنشی ثبت نشده است.")
+    await update.message.reply_text("\n".join(lines))
+
+async def packets_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """List open packets with their totals, or show the lifecycle of one packet."""
+    args = context.args or []
+    if not args:
+        await update.message.reply_text("استفاده: /packets open یا /packets شماره‌پاکت")
+        return
+    refresh_row_indexes()
+    index = branch_index("packets")
+
+    if args[0].lower() in ("open", "باز"):
+        packets = index.open_packets()
+        lines = [
+            f"📦 پاکت‌های باز: {len(packets)}",
+            f"وزن کل: {format_number(index.open_weight)} گرم | طلای خالص: {format_number(index.open_fine_gold)} گرم",
+            ""
+        ]
+        for status in packets[:50]:
+            lines.append(
+                f"• {status['pack']} {status['name']} | {format_number(status['weight'])} گرم {status['purity']} | "
+                f"{status['partner']} | {status['date']}"
+            )
+        if len(packets) > 50:
+            lines.append(f"... و {len(packets) - 50} پاکت دیگر")
+        await update.message.reply_text("\n".join(lines))
+        return
+
+    status = index.status(args[0])
+    if status is None:
+        await update.message.reply_text(f"پاکت {args[0]} دریافت نشده است.")
+        return
+    state = "باز (نزد ما)" if status["state"] == "open" else "پرداخت شده"
+    lines = [
+        f"📦 پاکت {status['pack']} {status['name']}: {state}",
+        f"وزن: {format_number(status['weight'])} گرم، عیار {status['purity']} (طلای خالص {format_number(status['fine_gold'])} گرم)",
+        ""
+    ]
+    for row_ref, row in status["events"]:
+        lines.append(f"• {row.get('نوع تراکنش', '')} {str(row.get('تاریخ', ''))[:10]} | {row.get('طرف حساب', '')} | {format_row_ref(row_ref)}")
+    await update.message.reply_text("\n".join(lines))
+
+async def settle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show net حواله positions per currency and the fewest transfers that settle them."""
+    refresh_row_indexes()
+    index = branch_index("transfers")
+    wanted = " ".join(context.args or []).strip().lower()
+    units = [unit for unit in index.units() if not wanted or unit.lower() == wanted]
+    if not units:
+        await update.message.reply_text(
+            f"حواله‌ای با ارز «{wanted}» ثبت نشده است." if wanted else "حواله‌ای ثبت نشده است."
+        )
+        return
+
+    sections = []
+    for unit in units:
+        positions = index.positions(unit)
+        if not positions:
+            sections.append(f"💱 {unit}: همه تسویه هستند.")
+            continue
+        transfers = minimal_settlements(positions)
+        creditors = sum(1 for amount in positions.values() if amount > 0)
+        lines = [f"💱 {unit}: {creditors} بستانکار، {len(positions) - creditors} بدهکار، {len(transfers)} انتقال برای تسویه"]
+        for debtor, creditor, amount in transfers[:30]:
+            lines.append(f"• {debtor} باید {format_number(amount)} {unit} به {creditor} بدهد")
+        if len(transfers) > 30:
+            lines.append(f"... و {len(transfers) - 30} انتقال دیگر")
+        sections.append("\n".join(lines))
+    await update.message.reply_text("\n\n".join(sections)[:4096])
+
+async def backfill_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Fill the derived columns of rows saved before they existed (admin chat only when ADMIN_CHAT_ID is set)."""
+    if ADMIN_CHAT_ID and str(update.effective_chat.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text("این دستور فقط در گفتگوی مدیر در دسترس است.")
+        return
+    if STORAGE_BACKEND != "sheets":
+        await update.message.reply_text("پر کردن ستون‌های محاسبه‌شده فقط برای Google Sheets لازم است.")
+        return
+    await update.message.reply_text("در حال پر کردن ستون‌های محاسبه‌شده...")
+    try:
+        written = await asyncio.to_thread(backfill_derived_columns, current_branch())
+    except Exception as e:
+        logger.error("Error backfilling derived columns: %s", e)
+        await update.message.reply_text(f"❌ خطا در پر کردن ستون‌ها: {str(e)}")
+        return
+    await update.message.reply_text(f"✅ ستون‌های محاسبه‌شده برای {written} ردیف نوشته شد.")
+
+def render_history_page(text: str, page: int, query_id: str) -> tuple:
+    """Return the message text and navigation buttons for one page of /history results."""
+    refresh_row_indexes()
+    results = branch_index("history").lookup(text)
+    if not results:
+        return f"تراکنشی برای «{text}» پیدا نشد.", None
+    pages = (len(results) + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    lines = [f"🔎 «{text}»: {len(results)} تراکنش (صفحه {page + 1} از {pages})"]
+    for row_ref, row in results[page * HISTORY_PAGE_SIZE:(page + 1) * HISTORY_PAGE_SIZE]:
+        lines.append(format_transaction_summary(row_to_transaction(row), f"{format_row_ref(row_ref)}:").rstrip())
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"{CB_HISTORY}{query_id}_{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"{CB_HISTORY}{query_id}_{page + 1}"))
+    return "\n\n".join(lines)[:4096], InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show saved transactions of a partner, a receipt number or a date, a page at a time."""
+    text = " ".join(context.args or [])
+    if not text:
+        await update.message.reply_text("استفاده: /history طرف‌حساب | شماره سند | تاریخ")
+        return
+    # Page flips re-run the lookup on the in-memory index, so only the query is kept; its short ID
+    # goes into the buttons so older result messages keep paging through their own query
+    queries = context.chat_data.setdefault("history_queries", {})
+    query_id = str(context.chat_data.get("history_seq", 0) + 1)
+    context.chat_data["history_seq"] = int(query_id)
+    queries[query_id] = text
+    for old_id in list(queries)[:-HISTORY_QUERIES_KEPT]:
+        del queries[old_id]
+    message, reply_markup = render_history_page(text, 0, query_id)
+    await update.message.reply_text(message, reply_markup=reply_markup)
+
+async def history_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Flip to another page of the /history results the message belongs to."""
+    query = update.callback_query
+    query_id, _, page = query.data[len(CB_HISTORY):].partition("_")
+    text = context.chat_data.get("history_queries", {}).get(query_id)
+    if not text or not page.isdigit():
+        await answer_query(update, context, "این نتیجه دیگر در دسترس نیست؛ دوباره /history را بفرستید.")
+        return
+    await answer_query(update, context)
+    message, reply_markup = render_history_page(text, int(page), query_id)
+    try:
+        await query.edit_message_text(message, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Tapping the same page twice leaves the message unchanged
+        if "not modified" not in str(e):
+            raise
+
+async def track_draft_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stamp the user's last activity and chat, and stop input meant for a draft closed at the cap.
+
+    A draft closed because DRAFT_LIMIT was reached leaves its conversation in
+    the step it was at; anything but a fresh start gets the resume prompt again.
+    """
+    if not update.effective_user:
+        return
+    user_data = context.user_data
+    user_data["last_activity"] = time.time()
+    if update.effective_chat:
+        user_data["last_chat"] = update.effective_chat.id
+    if user_data.get("draft_parked") != "cap" or "transaction" in user_data:
+        return
+    conversation = transaction_conversation(context.application)
+    # check_update() returns (state, key, handler, check) for the handler the conversation would pick
+    match = conversation.check_update(update)
+    if not match or match[2] in conversation.entry_points or match[2] in conversation.fallbacks:
+        return
+    await send_resume_prompt(context.bot, update.effective_chat.id, DRAFT_CAP_MESSAGE)
+    raise ApplicationHandlerStop
+
+def transaction_conversation(application: Application) -> ConversationHandler:
+    for handler in application.handlers.get(0, []):
+        if isinstance(handler, ConversationHandler) and handler.name == "transaction_conversation":
+            return handler
+    return None
+
+def draft_size(user_data: dict) -> int:
+    """Approximate memory of a draft: the size of its serialized keys in bytes."""
+    draft = {key: user_data[key] for key in DRAFT_KEYS if key in user_data}
+    return len(json.dumps(draft, ensure_ascii=False, default=str).encode())
+
+def live_drafts(application: Application) -> list:
+    """(last activity, (chat ID, user ID), user_data) of the drafts this process serves, oldest first."""
+    slot = application.bot_data.get("worker_slot")
+    drafts = []
+    for user_id, user_data in list(application.user_data.items()):
+        if "transaction" not in user_data or "last_chat" not in user_data:
+            continue
+        chat_id = user_data["last_chat"]
+        # Other workers' users are loaded from the shared store too; leave them alone
+        if slot is not None and chat_id % slot[1] != slot[0]:
+            continue
+        drafts.append((user_data.get("last_activity", 0), (chat_id, user_id), user_data))
+    return sorted(drafts, key=lambda draft: draft[0])
+
+def park_draft(application: Application, key, user_data: dict) -> None:
+    """Move a draft out of memory, keeping it on disk for resuming."""
+    draft = {name: user_data.pop(name) for name in DRAFT_KEYS if name in user_data}
+    application.mark_data_for_update_persistence(user_ids=key[1])
+    if DRAFT_RESUME_PROMPT:
+        now = time.time()
+        _shared_store.set("parked_drafts", str(key[1]), {"draft": draft, "parked_at": now})
+        _shared_store.prune("parked_drafts", "parked_at", now - PARKED_DRAFT_TTL_HOURS * 3600)
+
+async def send_resume_prompt(bot: Bot, chat_id: int, text: str) -> None:
+    """Tell the user their draft was closed, with a button to resume it when resuming is enabled."""
     try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        # Check if we're using environment variable for credentials
-        if 'GOOGLE_API_KEY' in os.environ:
-            import json
-            # Parse JSON from environment variable
-            credentials_dict = json.loads(os.environ['GOOGLE_API_KEY'])
-            credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, scope)
+        if DRAFT_RESUME_PROMPT:
+            await bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("▶️ ادامه تراکنش", callback_data=CB_RESUME_DRAFT)]]
+            ))
         else:
-            # Use local file path (your original code)
-            credentials = ServiceAccountCredentials.from_json_keyfile_name(
-                os.getenv('GOOGLE_API_KEY'), scope)
-        
-        client = gspread.authorize(credentials)
-        spreadsheet = client.open("Test")
-        worksheet = spreadsheet.worksheet("GreenLand")
-        
-        # Find the "نام مشتری" column
-        try:
-            # Find the column by header name instead of assuming position
-            headers = worksheet.row_values(1)
-            # Find column index for "نام مشتری"
-            header_index = headers.index("نام مشتری") + 1  # Convert to 1-based index for gspread
-            partner_column = worksheet.col_values(header_index)[1:]
-            # Check if name already exists
-            if name in partner_column:
-                return False
-            
-            # Find the first empty cell in the column
-            next_row = len(partner_column) + 2  # +2 because col_values skips header and gspread is 1-based
-            worksheet.update_cell(next_row, header_index, name)
-            return True
-        except ValueError:
-            logger.error(f"Header 'نام مشتری' not found in worksheet. Available headers: {headers}")
-            return False
-        except Exception as e:
-            logger.error(f"Error adding partner name: {e}")
-            return False
+            await bot.send_message(chat_id, f"{text}\nلطفاً تراکنش جدیدی شروع کنید.", reply_markup=MENU_KEYBOARD)
     except Exception as e:
-        logger.error(f"Error connecting to sheet: {e}")
-        return False
+        logger.warning("Could not send resume prompt to chat %s: %s", chat_id, e)
 
-def create_partner_buttons(partner_names, prefix):
-    """Create inline keyboard buttons for partner names."""
-    keyboard = []
-    # Show partners in rows of 2
-    for i in range(0, len(partner_names), 2):
-        row = [InlineKeyboardButton(partner_names[i], callback_data=f"{prefix}{partner_names[i]}")]
-        if i + 1 < len(partner_names):
-            row.append(InlineKeyboardButton(partner_names[i+1], callback_data=f"{prefix}{partner_names[i+1]}"))
-        keyboard.append(row)
-    
-    # Add button to enter custom name
-    keyboard.append([InlineKeyboardButton("➕ افزودن نام جدید", callback_data=f"{prefix}ADD_NEW")])
-    
-    return keyboard
+async def draft_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Close a draft left idle for DRAFT_IDLE_MINUTES (the conversation's timeout)."""
+    if "transaction" not in context.user_data:
+        return
+    park_draft(context.application, (update.effective_chat.id, update.effective_user.id), context.user_data)
+    if DRAFT_RESUME_PROMPT:
+        await send_resume_prompt(context.bot, update.effective_chat.id, DRAFT_IDLE_MESSAGE)
 
-def to_english_number(s):
-    """Convert Persian/Arabic digits in a string to English digits."""
-    if not isinstance(s, str):
-        return s
-    persian_digits = '۰۱۲۳۴۵۶۷۸۹'
-    arabic_digits = '٠١٢٣٤٥٦٧٨٩'
-    english_digits = '0123456789'
-    table = {}
-    for p, e in zip(persian_digits, english_digits):
-        table[ord(p)] = e
-    for a, e in zip(arabic_digits, english_digits):
-        table[ord(a)] = e
-    return s.translate(table)
+async def evict_drafts(application: Application, room: int = 0) -> int:
+    """Close the oldest drafts until `room` more fit under DRAFT_LIMIT."""
+    drafts = live_drafts(application)
+    evicted = drafts[:max(len(drafts) + room - DRAFT_LIMIT, 0)]
+
+    for _, key, user_data in evicted:
+        park_draft(application, key, user_data)
+        # The conversation is still at the draft's step; track_draft_activity catches input for it
+        user_data["draft_parked"] = "cap"
+        await send_resume_prompt(application.bot, key[0], DRAFT_CAP_MESSAGE)
+    if evicted:
+        logger.info("Closed %d drafts at the limit, %d still live", len(evicted), len(drafts) - len(evicted))
+    return len(evicted)
+
+async def make_room_for_draft(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keep the number of live drafts under DRAFT_LIMIT before the user starts a new one."""
+    if "transaction" not in context.user_data:
+        await evict_drafts(context.application, room=1)
+
+async def resume_draft_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Bring a closed draft back and show it for confirmation or editing."""
+    query = update.callback_query
+    parked = _shared_store.get("parked_drafts", str(update.effective_user.id))
+    if not parked or not parked["draft"].get("transaction", {}).get("type"):
+        await query.answer()
+        await query.edit_message_text("تراکنش ناتمامی برای ادامه یافت نشد.")
+        return None
+
+    _shared_store.delete("parked_drafts", str(update.effective_user.id))
+    context.user_data.pop("draft_parked", None)
+    context.user_data.update(parked["draft"])
+    # The prompt message becomes the transaction card
+    context.user_data["card"] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
+    await answer_query(update, context)
+    return await show_transaction_summary(update, context)
+
+async def drafts_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Report live drafts and the approximate memory each one holds."""
+    drafts = live_drafts(context.application)
+    now = time.time()
+    sizes = [(draft_size(user_data), now - last_activity, key[1]) for last_activity, key, user_data in drafts]
+    total = sum(size for size, _, _ in sizes)
+    lines = [
+        f"پیش‌نویس‌های فعال: {len(drafts)} از حداکثر {DRAFT_LIMIT}",
+        f"حجم کل: {total} بایت",
+    ]
+    if sizes:
+        lines.append(f"میانگین هر پیش‌نویس: {total // len(sizes)} بایت")
+        for size, idle, user_id in sorted(sizes, reverse=True)[:10]:
+            lines.append(f"• کاربر {user_id}: {size} بایت، {int(idle // 60)} دقیقه بی‌فعالیت")
+    if _shared_store is not None:
+        lines.append(f"پیش‌نویس‌های قابل ادامه: {len(_shared_store.items('parked_drafts'))}")
+    await update.message.reply_text("\n".join(lines))
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send welcome message with a single start button."""
@@ -310,11 +2885,22 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         )
         return MAIN_MENU
 
-async def new_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Start transaction with inline keyboard while keeping persistent menu."""
-    # Initialize transaction data
+def start_transaction_draft(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    """Start an empty draft with a fresh card and fresh call counters, and return it."""
     context.user_data["transaction"] = {}
     context.user_data["transaction"]["date"] = datetime.now().strftime("%Y-%m-%d")
+    # Every draft carries an idempotency key so a repeated confirm can't save it twice
+    context.user_data["transaction"]["idempotency_key"] = uuid.uuid4().hex
+    context.user_data.pop("card", None)
+    context.user_data.pop("saved_row", None)
+    context.user_data.pop("draft_parked", None)
+    context.user_data["api_calls"] = {}
+    return context.user_data["transaction"]
+
+async def new_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start transaction with inline keyboard while keeping persistent menu."""
+    await make_room_for_draft(context)
+    start_transaction_draft(context)
     
     # Use inline keyboard for options while keeping the persistent menu visible
     inline_keyboard = [
@@ -328,7 +2914,7 @@ async def new_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         ]
     ]
     
-    await update.message.reply_text(
+    await update_card(update, context,
         "لطفاً نوع تراکنش را انتخاب کنید:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard)
     )
@@ -338,27 +2924,25 @@ async def new_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def handle_transaction_type_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle transaction type selection from inline keyboard."""
     query = update.callback_query
-    await query.answer()
+    await answer_query(update, context)
     
     # Get transaction type from callback data
     transaction_type = query.data.replace(CB_TRANSACTION_TYPE, "")
     context.user_data["transaction"]["type"] = transaction_type
     
-    # Get last number from sheet if applicable
-    cell_map = {"دریافت": "A2", "پرداخت": "B2", "معامله": "C2"}
+    # Get last number from the warm counter cache if applicable
     last_num = None
-    if cell := cell_map.get(transaction_type):
-        try:
-            last_num = get_last_number_from_other_sheet(cell)
-        except Exception:
-            pass
+    try:
+        last_num = get_document_counter(transaction_type)
+    except Exception:
+        pass
     
     # Ask for receipt number or continue flow based on transaction type
     if transaction_type in ["دریافت", "پرداخت", "معامله"]:
         msg = "شماره سند را وارد کنید:"
         if last_num:
             msg = f"آخرین شماره سند ثبت شده: {last_num}\n{msg}"
-        await query.message.reply_text(msg)
+        await update_card(update, context, msg)
         return RECEIPT_NUM
     
     elif transaction_type == "حواله":
@@ -373,7 +2957,7 @@ async def handle_transaction_type_callback(update: Update, context: ContextTypes
             ]
         ]
         
-        await query.message.reply_text(
+        await update_card(update, context,
             "نوع حواله را انتخاب کنید:",
             reply_markup=InlineKeyboardMarkup(inline_keyboard)
         )
@@ -381,7 +2965,7 @@ async def handle_transaction_type_callback(update: Update, context: ContextTypes
     
     # Fallback
     else:
-        await query.message.reply_text("نوع تراکنش نامعتبر است. لطفا دوباره تلاش کنید.")
+        await update_card(update, context, "نوع تراکنش نامعتبر است. لطفا دوباره تلاش کنید.")
         return TRANSACTION_TYPE
 
 async def receipt_num(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -391,36 +2975,92 @@ async def receipt_num(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         return
 
     context.user_data["transaction"]["receipt_num"] = to_english_number(update.message.text)
+    warn_duplicate_receipt(update, context)
     
     if context.user_data["transaction"]["type"] == "دریافت":
-        await update.message.reply_text("شماره پاکت را وارد کنید:")
+        await update_card(update, context, "شماره پاکت را وارد کنید:")
         return PACK_NUM
     
     elif context.user_data["transaction"]["type"] == "پرداخت":
-        await update.message.reply_text("عیار را وارد کنید:")
-        return PURITY
+        # A pack number marks that packet as paid out; most payments have none
+        await update_card(update, context,
+            "شماره پاکتی که پرداخت می‌شود را وارد کنید (اختیاری):",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⏭ بدون پاکت", callback_data=CB_SKIP_PACK)]])
+        )
+        return PACK_NUM
     
     elif context.user_data["transaction"]["type"] == "معامله":
         inline_keyboard = [
             [InlineKeyboardButton("Buy", callback_data=f"{CB_DEAL_DIRECTION}Buy")],
             [InlineKeyboardButton("Sell", callback_data=f"{CB_DEAL_DIRECTION}Sell")]
         ]
-        await update.message.reply_text(
+        await update_card(update, context,
             "لطفا جهت معامله مشخص کنید؟",
             reply_markup=InlineKeyboardMarkup(inline_keyboard)
         )
         return DEAL_DIRECTION
 
+def warn_duplicate_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Warn as soon as a receipt number already used for this transaction type is typed."""
+    transaction = context.user_data["transaction"]
+    refresh_row_indexes()
+    duplicate = branch_index("receipts").lookup(transaction["type"], transaction.get("receipt_num", ""))
+    if duplicate is None:
+        # Drafts waiting in the basket aren't in the sheet yet
+        if _shared_store is not None:
+            items = [item for item in _shared_store.get("baskets", basket_key(update), [])
+                     if item["transaction"].get("idempotency_key") != transaction.get("idempotency_key")]
+            notices = basket_receipt_duplicates(items, transaction)
+            if notices:
+                context.user_data["card_notice"] = notices[0]
+        return
+
+    row_ref, _ = duplicate
+    if row_ref == context.user_data.get("saved_row", {}).get("ref"):
+        # A reopened saved transaction keeps its own receipt number
+        return
+    # Shown on the card with the next step, together with a button to view the saved row
+    context.user_data["card_notice"] = (
+        f"⚠️ شماره سند {transaction['receipt_num']} قبلاً برای {transaction['type']} "
+        f"در {format_row_ref(row_ref)} ثبت شده است."
+    )
+    context.user_data["card_show_duplicate"] = True
+
+async def show_duplicate_receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the summary of the saved transaction that already uses the draft's receipt number."""
+    transaction = context.user_data.get("transaction", {})
+    duplicate = branch_index("receipts").lookup(transaction.get("type", ""), transaction.get("receipt_num", ""))
+    if duplicate is None:
+        await answer_query(update, context, "تراکنش تکراری دیگر یافت نشد.")
+        return None
+
+    # Shown as an alert so the card keeps the current step
+    row_ref, row = duplicate
+    summary = format_transaction_summary(row_to_transaction(row), f"{format_row_ref(row_ref)}:")
+    await answer_query(update, context, summary[:CALLBACK_ALERT_LIMIT], show_alert=True)
+    # Stay in the current state
+    return None
+
 async def pack_num(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Process pack number for Receive transactions."""
+    """Process pack number for Receive transactions, or the optional one for Pay transactions."""
     # Ignore menu commands
     if update.message.text in ["🆕 تراکنش جدید", "🏠 بازگشت به صفحه اصلی", "❌ انصراف"]:
         return
 
     context.user_data["transaction"]["pack_num"] = to_english_number(update.message.text)
-    await update.message.reply_text("اسم ریگیری را وارد کنید:")
+    if context.user_data["transaction"]["type"] == "پرداخت":
+        await update_card(update, context, "عیار را وارد کنید:")
+        return PURITY
+    await update_card(update, context, "اسم ریگیری را وارد کنید:")
     return ID_NUM
 
+async def skip_pack_num_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Continue a Pay transaction without a pack number."""
+    await answer_query(update, context)
+    context.user_data["transaction"].pop("pack_num", None)
+    await update_card(update, context, "عیار را وارد کنید:")
+    return PURITY
+
 async def id_num(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process ID number for Receive transactions."""
     # Ignore menu commands
@@ -428,7 +3068,7 @@ async def id_num(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return
 
     context.user_data["transaction"]["id_num"] = to_english_number(update.message.text)
-    await update.message.reply_text("عیار را وارد کنید:")
+    await update_card(update, context, "عیار را وارد کنید:")
     return PURITY
 
 async def purity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -438,7 +3078,7 @@ async def purity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return
 
     context.user_data["transaction"]["purity"] = to_english_number(update.message.text)
-    await update.message.reply_text("وزن را وارد کنید:")
+    await update_card(update, context, "وزن را وارد کنید:")
     return WEIGHT
 
 async def weight(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -459,40 +3099,32 @@ async def weight(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def show_partner_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, title: str, callback_prefix: str, next_state: int) -> int:
     """Show partner selection buttons with debugging."""
-    logger.info(f"Fetching partner names for {title}")
-    partner_names = get_partner_names_from_sheet()
+    hot_logger.debug("Fetching partner names for %s", title)
+    partner_names = get_partner_names()
     
-    logger.info(f"Found {len(partner_names)} partner names")
+    hot_logger.debug("Found %d partner names", len(partner_names))
     
     if not partner_names:
         logger.warning("No partner names found in sheet")
         # If no partners found, go directly to text input
-        if update.callback_query:
-            await update.callback_query.message.reply_text(f"{title} را وارد کنید:")
-        else:
-            await update.message.reply_text(f"{title} را وارد کنید:")
+        await update_card(update, context, f"{title} را وارد کنید:")
         context.user_data["current_partner_field"] = title
         context.user_data["next_state"] = next_state
         return next_state
     
-    # Create buttons with partner names
-    keyboard = create_partner_buttons(partner_names, callback_prefix)
-    logger.info(f"Created keyboard with {len(keyboard)} rows")
+    # Create buttons with partner names, the user's most used ones first
+    pinned = _partner_ranking.top(update.effective_user.id, context.user_data["transaction"].get("type", ""))
+    keyboard = create_partner_buttons(partner_names, callback_prefix, pinned)
+    hot_logger.debug("Created keyboard with %d rows", len(keyboard))
     
     try:
-        if update.callback_query:
-            await update.callback_query.message.reply_text(
-                f"{title} را انتخاب کنید یا نام جدید اضافه کنید:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        else:
-            await update.message.reply_text(
-                f"{title} را انتخاب کنید یا نام جدید اضافه کنید:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        logger.info("Successfully sent partner selection message")
+        await update_card(update, context,
+            f"{title} را انتخاب کنید یا نام جدید اضافه کنید:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        hot_logger.debug("Successfully sent partner selection message")
     except Exception as e:
-        logger.error(f"Error sending partner selection: {e}")
+        logger.error("Error sending partner selection: %s", e)
     
     context.user_data["current_partner_field"] = title
     context.user_data["next_state"] = next_state
@@ -501,7 +3133,7 @@ async def show_partner_selection(update: Update, context: ContextTypes.DEFAULT_T
 async def handle_partner_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, field_name: str) -> int:
     """Handle partner selection from buttons."""
     query = update.callback_query
-    await query.answer()
+    await answer_query(update, context)
     
     callback_data = query.data
     
@@ -518,7 +3150,7 @@ async def handle_partner_selection(update: Update, context: ContextTypes.DEFAULT
     
     if selection == "ADD_NEW":
         # User wants to add a new partner
-        await query.message.reply_text(f"لطفا {context.user_data['current_partner_field']} جدید را وارد کنید:")
+        await update_card(update, context, f"لطفا {context.user_data['current_partner_field']} جدید را وارد کنید:")
         context.user_data["adding_new_partner"] = True
         return context.user_data["next_state"]
     else:
@@ -527,7 +3159,7 @@ async def handle_partner_selection(update: Update, context: ContextTypes.DEFAULT
         
         # Determine next state based on the transaction flow
         if field_name == "partner_name":
-            await query.message.reply_text("توضیحات را وارد کنید (اختیاری):")
+            await update_card(update, context, "توضیحات را وارد کنید (اختیاری):")
             return DESCRIPTION
         elif field_name == "giver_partner_name":
             return await show_partner_selection(
@@ -537,7 +3169,7 @@ async def handle_partner_selection(update: Update, context: ContextTypes.DEFAULT
                 RECEIVER_PARTNER_NAME 
             )
         elif field_name == "receiver_partner_name":
-            await query.message.reply_text("توضیحات را وارد کنید (اختیاری):")
+            await update_card(update, context, "توضیحات را وارد کنید (اختیاری):")
             return DESCRIPTION
         
 async def partner_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -552,15 +3184,15 @@ async def partner_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         context.user_data["transaction"]["partner_name"] = new_partner
         
         # Add the new partner to the sheet
-        success = add_partner_name_to_sheet(new_partner)
+        success = await asyncio.to_thread(add_partner_name_to_sheet, new_partner)
         if success:
-            await update.message.reply_text(f"نام '{new_partner}' به لیست مشتریان اضافه شد.")
+            context.user_data["card_notice"] = f"نام '{new_partner}' به لیست مشتریان اضافه شد."
         
         # Clear the flag
         context.user_data["adding_new_partner"] = False
         
         # Continue to description
-        await update.message.reply_text("توضیحات را وارد کنید (اختیاری):")
+        await update_card(update, context, "توضیحات را وارد کنید (اختیاری):")
         return DESCRIPTION
     
     # If this is a fresh request, show partner selection
@@ -573,7 +3205,7 @@ async def partner_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         context.user_data["transaction"]["partner_name"] = update.message.text
         
         # Continue to description
-        await update.message.reply_text("توضیحات را وارد کنید (اختیاری):")
+        await update_card(update, context, "توضیحات را وارد کنید (اختیاری):")
         return DESCRIPTION
     
     # Initial partner name request - show selection buttons
@@ -587,7 +3219,7 @@ async def partner_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 async def handle_deal_direction_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process deal direction from callback."""
     query = update.callback_query
-    await query.answer()
+    await answer_query(update, context)
     
     deal_direction = query.data.replace(CB_DEAL_DIRECTION, "")
     context.user_data["transaction"]["deal_direction"] = deal_direction
@@ -604,7 +3236,7 @@ async def handle_deal_direction_callback(update: Update, context: ContextTypes.D
         ]
     ]
     
-    await query.message.reply_text(
+    await update_card(update, context,
         "نوع معامله را انتخاب کنید:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard)
     )
@@ -613,13 +3245,13 @@ async def handle_deal_direction_callback(update: Update, context: ContextTypes.D
 async def handle_deal_type_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process deal type from callback."""
     query = update.callback_query
-    await query.answer()
+    await answer_query(update, context)
     
     deal_type = query.data.replace(CB_DEAL_TYPE, "")
     context.user_data["transaction"]["deal_type"] = deal_type
     
     # Ask for amount based on the selected deal type
-    await query.message.reply_text(f"مقدار را {deal_type} وارد کنید:")
+    await update_card(update, context, f"مقدار را {deal_type} وارد کنید:")
     return AMOUNT
 
 async def amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -631,11 +3263,13 @@ async def amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data["transaction"]["amount"] = to_english_number(update.message.text)
     
     if context.user_data["transaction"]["type"] == "معامله":
-        await update.message.reply_text("نرخ را وارد کنید:")
+        await update_card(update, context, "نرخ را وارد کنید:",
+            reply_markup=rate_suggestion_keyboard(context.user_data["transaction"], CB_RATE)
+        )
         return RATE
     
     elif context.user_data["transaction"]["type"] == "حواله":
-        logger.info("Bill transaction, now showing buy partner selection")
+        hot_logger.debug("Bill transaction, now showing buy partner selection")
         # Show buy partner selection
         return await show_partner_selection(
             update, context, 
@@ -651,7 +3285,19 @@ async def rate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return
 
     context.user_data["transaction"]["rate"] = to_english_number(update.message.text)
-    logger.info("Rate processed, now showing partner selection")
+    return await ask_deal_partner(update, context)
+
+async def rate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Use a suggested rate picked from the rate prompt buttons."""
+    query = update.callback_query
+    await answer_query(update, context)
+
+    context.user_data["transaction"]["rate"] = query.data.replace(CB_RATE, "")
+    return await ask_deal_partner(update, context)
+
+async def ask_deal_partner(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Ask for the partner of a deal once its rate is known."""
+    hot_logger.debug("Rate processed, now showing partner selection")
     
     # Show partner selection instead of asking for text input
     return await show_partner_selection(
@@ -673,9 +3319,9 @@ async def giver_partner_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context.user_data["transaction"]["giver_partner_name"] = new_partner
         
         # Add the new partner to the sheet
-        success = add_partner_name_to_sheet(new_partner)
+        success = await asyncio.to_thread(add_partner_name_to_sheet, new_partner)
         if success:
-            await update.message.reply_text(f"نام '{new_partner}' به لیست مشتریان اضافه شد.")
+            context.user_data["card_notice"] = f"نام '{new_partner}' به لیست مشتریان اضافه شد."
         
         # Clear the flag
         context.user_data["adding_new_partner"] = False
@@ -725,15 +3371,15 @@ async def receiver_partner_name(update: Update, context: ContextTypes.DEFAULT_TY
         context.user_data["transaction"]["receiver_partner_name"] = new_partner
         
         # Add the new partner to the sheet
-        success = add_partner_name_to_sheet(new_partner)
+        success = await asyncio.to_thread(add_partner_name_to_sheet, new_partner)
         if success:
-            await update.message.reply_text(f"نام '{new_partner}' به لیست مشتریان اضافه شد.")
+            context.user_data["card_notice"] = f"نام '{new_partner}' به لیست مشتریان اضافه شد."
         
         # Clear the flag
         context.user_data["adding_new_partner"] = False
         
         # Continue to description
-        await update.message.reply_text("توضیحات را وارد کنید (اختیاری):")
+        await update_card(update, context, "توضیحات را وارد کنید (اختیاری):")
         return DESCRIPTION
     
     # If this is a fresh request, show partner selection
@@ -746,7 +3392,7 @@ async def receiver_partner_name(update: Update, context: ContextTypes.DEFAULT_TY
         context.user_data["transaction"]["receiver_partner_name"] = update.message.text
         
         # Continue to description
-        await update.message.reply_text("توضیحات را وارد کنید (اختیاری):")
+        await update_card(update, context, "توضیحات را وارد کنید (اختیاری):")
         return DESCRIPTION
     
     # Initial sell partner name request - show selection buttons
@@ -767,11 +3413,292 @@ async def description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     
     return await show_transaction_summary(update, context)
 
-async def show_transaction_summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Show transaction summary for confirmation without changing description."""
-    # Build summary message based on transaction type
+def parse_quick_entry(command: str, text: str) -> dict:
+    """Parse the arguments of a quick-entry command into draft fields.
+
+    Raises ValueError with a message for the user when the line doesn't match the grammar.
+    """
+    transaction_type, fields, partner_fields = QUICK_ENTRY_COMMANDS[command]
+    text, _, note = text.partition("|")
+    tokens = text.split()
+    parsed = {"type": transaction_type}
+
+    for field in fields:
+        if not tokens:
+            raise ValueError("تعداد مقادیر کافی نیست.")
+        if field == "deal_type":
+            # Deal types may be two words ("Gold gr"); match the longest known type
+            options = {option.lower(): option for option in QUICK_ENTRY_DEAL_TYPES[transaction_type]}
+            two_words = " ".join(tokens[:2]).lower()
+            if len(tokens) > 1 and two_words in options:
+                parsed[field] = options[two_words]
+                del tokens[:2]
+            elif tokens[0].replace("_", " ").lower() in options:
+                parsed[field] = options[tokens.pop(0).replace("_", " ").lower()]
+            else:
+                raise ValueError(f"نوع معامله '{tokens[0]}' نامعتبر است.")
+            continue
+
+        value = to_english_number(tokens.pop(0))
+        if field == "deal_direction":
+            if value.lower() not in QUICK_ENTRY_DIRECTIONS:
+                raise ValueError(f"جهت معامله '{value}' نامعتبر است (Buy یا Sell).")
+            value = QUICK_ENTRY_DIRECTIONS[value.lower()]
+        elif field in QUICK_ENTRY_NUMERIC_FIELDS:
+            try:
+                float(value.replace(",", ""))
+            except ValueError:
+                raise ValueError(f"مقدار '{value}' عدد نیست.")
+        parsed[field] = value
+
+    partners = [" ".join(tokens)] if len(partner_fields) == 1 else " ".join(tokens).split(">")
+    if len(partners) != len(partner_fields) or not all(name.strip() for name in partners):
+        raise ValueError("طرف حساب وارد نشده است.")
+    for field, name in zip(partner_fields, partners):
+        parsed[field] = " ".join(name.split())
+
+    parsed["description"] = note.strip()
+    return parsed
+
+def resolve_partner_name(name: str) -> tuple:
+    """Return the saved spelling of a typed partner name and whether it is already known."""
+    key = normalize_partner_name(name)
+    for known in get_partner_names():
+        if normalize_partner_name(known) == key:
+            return known, True
+    return name, False
+
+async def quick_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Fill a whole draft from one command line and go straight to confirmation."""
+    command_text, _, arguments = update.message.text.partition(" ")
+    command = command_text[1:].split("@")[0].lower()
+    try:
+        fields = parse_quick_entry(command, arguments)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\nقالب دستور:\n{QUICK_ENTRY_USAGE[command]}")
+        # Keep whatever the user was doing before
+        return None
+
+    await make_room_for_draft(context)
+    transaction = start_transaction_draft(context)
+    transaction.update(fields)
+
+    notices = []
+    for field in ("partner_name", "giver_partner_name", "receiver_partner_name"):
+        if field in transaction:
+            transaction[field], known = resolve_partner_name(transaction[field])
+            if not known:
+                notices.append(f"⚠️ '{transaction[field]}' در لیست مشتریان نیست.")
+    if "receipt_num" in transaction:
+        warn_duplicate_receipt(update, context)
+    if notices:
+        notices.insert(0, context.user_data.get("card_notice", ""))
+        context.user_data["card_notice"] = "\n".join(notice for notice in notices if notice)
+
+    return await show_transaction_summary(update, context)
+
+async def edit_saved_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Reopen a saved transaction by receipt number or row reference and edit it like a draft."""
+    text = " ".join(context.args or [])
+    if not current_branch().store.supports_edit:
+        await update.message.reply_text("ویرایش تراکنش‌های ذخیره‌شده در این نوع ذخیره‌سازی پشتیبانی نمی‌شود.")
+        return None
+    if not text:
+        await update.message.reply_text("استفاده: /edit شماره‌سند یا /edit Transactions_2024-05!12")
+        return None
+
+    refresh_row_indexes()
+    history = branch_index("history")
+    if "!" in text:
+        matches = [(text, history.get(text))] if history.get(text) is not None else []
+    else:
+        matches = [
+            (row_ref, row) for row_ref, row in history.lookup(text)
+            if normalize_receipt(row.get("شماره سند", "")) == normalize_receipt(text)
+        ]
+    if not matches:
+        await update.message.reply_text(f"تراکنشی با «{text}» پیدا نشد.")
+        return None
+    if len(matches) > 1:
+        lines = [f"چند تراکنش با شماره سند {text} پیدا شد؛ یکی را باز کنید:"]
+        lines.extend(f"/edit {row_ref}  ({row.get('نوع تراکنش', '')} {row.get('تاریخ', '')})" for row_ref, row in matches)
+        await update.message.reply_text("\n".join(lines))
+        return None
+
+    row_ref = matches[0][0]
+    try:
+        # One single-row read: the values the edit is checked against when it is saved
+        values = await asyncio.to_thread(read_saved_row, row_ref)
+    except Exception as e:
+        logger.error("Error reading %s for editing: %s", row_ref, e)
+        await update.message.reply_text(f"❌ خطا در خواندن تراکنش: {str(e)}")
+        return None
+
+    await make_room_for_draft(context)
+    transaction = start_transaction_draft(context)
+    transaction.update(row_to_transaction(row_to_dict(values)))
+    context.user_data["saved_row"] = {"ref": row_ref, "values": values}
+    context.user_data["card_notice"] = f"✏️ ویرایش تراکنش ذخیره‌شده در {format_row_ref(row_ref)}"
+    return await show_transaction_summary(update, context)
+
+def basket_key(update: Update) -> str:
+    return f"{current_branch().name}:{update.effective_user.id}"
+
+def basket_receipt_duplicates(items: list, transaction: dict = None) -> list:
+    """Report lines for receipt numbers used twice in the basket or already saved in the sheet.
+
+    With `transaction`, only that draft is checked against the basket items.
+    """
+    refresh_row_indexes()
+    receipts = branch_index("receipts")
+    seen = {}
+    for position, item in enumerate(items, start=1):
+        draft = item["transaction"]
+        if draft.get("receipt_num"):
+            seen.setdefault((draft.get("type", ""), normalize_receipt(draft["receipt_num"])), []).append(position)
+    lines = []
+    if transaction is not None:
+        positions = seen.get((transaction.get("type", ""), normalize_receipt(transaction.get("receipt_num", ""))), [])
+        if transaction.get("receipt_num") and positions:
+            lines.append(f"⚠️ شماره سند {transaction['receipt_num']} در ردیف {'، '.join(map(str, positions))} سبد هم آمده است.")
+        return lines
+    for (kind, receipt), positions in seen.items():
+        if len(positions) > 1:
+            lines.append(f"⚠️ شماره سند {receipt} ({kind}) در ردیف‌های {'، '.join(map(str, positions))} سبد تکرار شده است.")
+    for position, item in enumerate(items, start=1):
+        draft = item["transaction"]
+        # A row already saved from this basket is its own receipt, not a duplicate
+        if not draft.get("receipt_num") or _committed_keys.get(draft.get("idempotency_key", "")) is not None:
+            continue
+        duplicate = receipts.lookup(draft.get("type", ""), draft["receipt_num"])
+        if duplicate is not None:
+            lines.append(f"⚠️ شماره سند {draft['receipt_num']} (ردیف {position} سبد) قبلاً در {format_row_ref(duplicate[0])} ثبت شده است.")
+    return lines
+
+def format_transaction_line(transaction: dict) -> str:
+    """One-line summary of a transaction for the basket review."""
+    parts = [transaction.get("type", "")]
+    if transaction.get("receipt_num"):
+        parts.append(f"سند {transaction['receipt_num']}")
+    if transaction.get("type") in ("دریافت", "پرداخت"):
+        parts.append(f"{transaction.get('weight', '')} گرم {transaction.get('purity', '')}")
+    else:
+        amount = f"{transaction.get('amount', '')} {transaction.get('deal_type', '')}"
+        if transaction.get("type") == "معامله":
+            amount = f"{transaction.get('deal_direction', '')} {amount} × {transaction.get('rate', '')}"
+        parts.append(amount)
+    if transaction.get("partner_name"):
+        parts.append(transaction["partner_name"])
+    if transaction.get("giver_partner_name") or transaction.get("receiver_partner_name"):
+        parts.append(f"{transaction.get('giver_partner_name', '')} > {transaction.get('receiver_partner_name', '')}")
+    return " | ".join(parts)
+
+def render_basket(items: list, force: bool = False) -> tuple:
+    """Return the combined summary of a basket and its commit/clear buttons.
+
+    With `force`, the commit button saves the basket despite duplicate receipt numbers.
+    """
+    counts = {}
+    for item in items:
+        counts[item["transaction"].get("type", "")] = counts.get(item["transaction"].get("type", ""), 0) + 1
+    lines = [f"🧺 سبد: {len(items)} تراکنش ({'، '.join(f'{count} {kind}' for kind, count in counts.items())})", ""]
+    lines.extend(f"{i}. {format_transaction_line(item['transaction'])}" for i, item in enumerate(items, start=1))
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ ثبت با وجود تکرار", callback_data=CB_BASKET_COMMIT_FORCE) if force
+         else InlineKeyboardButton("✅ ثبت همه", callback_data=CB_BASKET_COMMIT)],
+        [InlineKeyboardButton("🗑 خالی کردن سبد", callback_data=CB_BASKET_CLEAR)]
+    ])
+    return "\n".join(lines)[:4096], keyboard
+
+async def basket_add_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Move the confirmed draft into the user's basket instead of saving it now."""
     transaction = context.user_data["transaction"]
-    summary = f"خلاصه تراکنش:\n\n"
+    key = basket_key(update)
+    items = _shared_store.get("baskets", key, [])
+    if len(items) >= BASKET_LIMIT:
+        await answer_query(update, context, f"سبد پر است ({BASKET_LIMIT} تراکنش)؛ ابتدا آن را با /basket ثبت کنید.", show_alert=True)
+        return CONFIRMATION
+    await answer_query(update, context)
+
+    idempotency_key = get_idempotency_key(transaction)
+    notices = []
+    if all(item["transaction"].get("idempotency_key") != idempotency_key for item in items):
+        notices = basket_receipt_duplicates(items, transaction)
+        items.append({"transaction": dict(transaction), "saved_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+        # Written straight to the state database so the basket survives a restart
+        _shared_store.set("baskets", key, items)
+
+    await edit_card(update, context,
+        f"{format_transaction_summary(transaction)}\n🧺 به سبد اضافه شد ({len(items)} تراکنش). برای بازبینی و ثبت: /basket"
+        + "".join(f"\n{notice}" for notice in notices)
+    )
+    finish_transaction_card(context)
+    return MAIN_MENU
+
+async def basket_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the user's basket with buttons to commit or clear it."""
+    items = _shared_store.get("baskets", basket_key(update), [])
+    if not items:
+        await update.message.reply_text("سبد خالی است. در خلاصه تراکنش «🧺 افزودن به سبد» را بزنید.")
+        return
+    text, reply_markup = render_basket(items)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def basket_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Commit every transaction in the basket in one batched write, or clear the basket."""
+    query = update.callback_query
+    await answer_query(update, context)
+    key = basket_key(update)
+    items = _shared_store.get("baskets", key, [])
+
+    if query.data == CB_BASKET_CLEAR:
+        _shared_store.delete("baskets", key)
+        await query.edit_message_text(f"🗑 سبد خالی شد ({len(items)} تراکنش حذف شد).")
+        return
+    if not items:
+        await query.edit_message_text("سبد خالی است.")
+        return
+
+    if query.data == CB_BASKET_COMMIT:
+        # Receipts may have been saved since the items were added; a second tap commits anyway
+        duplicates = basket_receipt_duplicates(items)
+        if duplicates:
+            text, reply_markup = render_basket(items, force=True)
+            await query.edit_message_text(f"{text}\n\n" + "\n".join(duplicates)[:1000], reply_markup=reply_markup)
+            return
+
+    rows = [build_row_data(item["transaction"], item["saved_at"]) for item in items]
+    idempotency_keys = [item["transaction"]["idempotency_key"] for item in items]
+    already_saved = {key for key in idempotency_keys if _committed_keys.get(key) is not None}
+    try:
+        # Off the event loop, like single saves, so other chats are served during the batch write
+        row_refs = await asyncio.to_thread(append_transaction_rows, rows, idempotency_keys)
+    except Exception as e:
+        logger.error("Error saving basket to Google Sheets: %s", e)
+        text, reply_markup = render_basket(items)
+        await query.edit_message_text(f"{text}\n\n❌ خطا در ثبت سبد: {str(e)}", reply_markup=reply_markup)
+        return
+
+    _shared_store.delete("baskets", key)
+    for item in items:
+        transaction = item["transaction"]
+        if transaction["idempotency_key"] in already_saved:
+            continue
+        _partner_ranking.record(update.effective_user.id, transaction.get("type", ""), [
+            transaction.get(field) for field in ("partner_name", "giver_partner_name", "receiver_partner_name")
+        ])
+    text, _ = render_basket(items)
+    await query.edit_message_text(f"{text}\n\n✅ {len(row_refs)} تراکنش با یک درخواست در Google Sheets ذخیره شد.")
+
+def get_idempotency_key(transaction: dict) -> str:
+    """Return the draft's idempotency key, creating one for drafts started without it."""
+    if not transaction.get("idempotency_key"):
+        transaction["idempotency_key"] = uuid.uuid4().hex
+    return transaction["idempotency_key"]
+
+def format_transaction_summary(transaction: dict, title: str = "خلاصه تراکنش:") -> str:
+    """Build the summary text for a transaction based on its type."""
+    summary = f"{title}\n\n"
     summary += f"نوع: {transaction['type']}\n"
     summary += f"تاریخ: {transaction['date']}\n"
     
@@ -811,109 +3738,134 @@ async def show_transaction_summary(update: Update, context: ContextTypes.DEFAULT
     if "receiver_partner_name" in transaction:
         summary += f"طرف دریافت کننده: {transaction['receiver_partner_name']}\n"
     
-    summary += f"توضیحات: {transaction['description']}\n"
+    if "description" in transaction:
+        summary += f"توضیحات: {transaction['description']}\n"
+    return summary
+
+async def show_transaction_summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Show transaction summary for confirmation without changing description."""
+    # Build summary message based on transaction type
+    transaction = context.user_data["transaction"]
+    summary = format_transaction_summary(transaction)
     
     # Add confirmation buttons
     keyboard = [
         [
-            InlineKeyboardButton("تایید", callback_data="confirm"),
+            InlineKeyboardButton("تایید", callback_data=f"{CB_CONFIRM}{get_idempotency_key(transaction)}"),
             InlineKeyboardButton("ویرایش", callback_data="edit")
         ],
         [InlineKeyboardButton("انصراف", callback_data="cancel")]
     ]
+    if "saved_row" not in context.user_data:
+        keyboard[1].insert(0, InlineKeyboardButton("🧺 افزودن به سبد", callback_data=CB_BASKET_ADD))
+    # Warnings raised while filling the draft (e.g. a duplicate receipt number) stay visible
+    notice = context.user_data.pop("card_notice", None)
+    if notice:
+        summary += f"\n{notice}"
+    if context.user_data.pop("card_show_duplicate", False):
+        keyboard.append([InlineKeyboardButton("نمایش تراکنش موجود", callback_data=CB_SHOW_DUPLICATE)])
     
-    # Check if this is a callback update or a message update
-    if update.callback_query:
-        await update.callback_query.edit_message_text(
-            summary,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    else:
-        await update.message.reply_text(
-            summary,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    # The summary replaces the card's contents in place
+    await edit_card(update, context, summary, InlineKeyboardMarkup(keyboard))
     
     return CONFIRMATION
 
+def build_row_data(transaction: dict, saved_at: str) -> list:
+    """Turn a draft into a row in SHEET_HEADERS order, with numbers parsed and derived columns computed."""
+    data_dict = {
+        "نوع تراکنش": transaction.get("type", ""),
+        "تاریخ": transaction.get("date", ""),
+        "شماره سند": transaction.get("receipt_num", ""),
+        "شماره پاکت": transaction.get("pack_num", ""),
+        "اسم ریگیری": transaction.get("id_num", ""),
+        "عیار": transaction.get("purity", ""),
+        "وزن": transaction.get("weight", ""),
+        "طرف حساب": transaction.get("partner_name", ""),
+        "جهت معامله": transaction.get("deal_direction", ""),
+        "نوع معامله": transaction.get("deal_type", ""),
+        "مقدار": transaction.get("amount", ""),
+        "نرخ": transaction.get("rate", ""),
+        "طرف پرداخت کننده": transaction.get("giver_partner_name", ""),
+        "طرف دریافت کننده": transaction.get("receiver_partner_name", ""),
+        "توضیحات": transaction.get("description", ""),
+        "زمان ثبت": saved_at
+    }
+
+    hot_logger.debug("Saving row with keys %s", data_dict.keys())
+    # Convert numeric fields to numbers if possible
+    numeric_fields = [
+        "شماره سند", "شماره پاکت", "عیار", "وزن", "مقدار", "نرخ"
+    ]
+    for field in numeric_fields:
+        value = data_dict.get(field, "")
+        if isinstance(value, str) and value.strip() != "":
+            try:
+                # Try to convert to int first, then fall back to float if necessary
+                num = int(value.replace(",", ""))
+            except ValueError:
+                try:
+                    num = float(value.replace(",", ""))
+                except ValueError:
+                    num = value  # Leave as is if conversion fails
+            data_dict[field] = num
+
+    # Create a row with values in the correct order based on headers
+    row_data = []
+    for header in HEADERS:
+        row_data.append(data_dict.get(header, ""))
+    # Derived columns are computed once here instead of by formulas in the sheet
+    row_data.extend(derived_values(data_dict))
+    return row_data
+
 async def confirmation_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle confirmation callback query with improved sheet writing."""
     query = update.callback_query
-    await query.answer()
+    if query.data.startswith(CB_CONFIRM):
+        idempotency_key = context.user_data.get("transaction", {}).get("idempotency_key")
+        if query.data.replace(CB_CONFIRM, "") != idempotency_key:
+            # A stale or redelivered tap from another draft's card: answer it and leave this draft alone
+            await repeated_confirmation_callback(update, context)
+            return CONFIRMATION
+    await answer_query(update, context)
     
-    if query.data == "confirm":
+    if query.data.startswith(CB_CONFIRM):
         try:
-            # Open the Google Sheet
-            worksheet = setup_google_sheets()
-            
-           # Find the next empty row
-            all_values = worksheet.get_all_values()
-            next_row = len(all_values) + 1  # 1-based index for sheets
-            
-            # Prepare the data as a dictionary
             transaction = context.user_data["transaction"]
-            data_dict = {
-                "نوع تراکنش": transaction.get("type", ""),
-                "تاریخ": transaction.get("date", ""),
-                "شماره سند": transaction.get("receipt_num", ""),
-                "شماره پاکت": transaction.get("pack_num", ""),
-                "اسم ریگیری": transaction.get("id_num", ""),
-                "عیار": transaction.get("purity", ""),
-                "وزن": transaction.get("weight", ""),
-                "طرف حساب": transaction.get("partner_name", ""),
-                "جهت معامله": transaction.get("deal_direction", ""),
-                "نوع معامله": transaction.get("deal_type", ""),
-                "مقدار": transaction.get("amount", ""),
-                "نرخ": transaction.get("rate", ""),
-                "طرف پرداخت کننده": transaction.get("giver_partner_name", ""),
-                "طرف دریافت کننده": transaction.get("receiver_partner_name", ""),
-                "توضیحات": transaction.get("description", ""),
-                "زمان ثبت": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-            
-            logger.info(f"Sheet headers: {HEADERS}")
-            logger.info(f"Data dict keys: {list(data_dict.keys())}")
-            # Convert numeric fields to numbers if possible
-            numeric_fields = [
-                "شماره سند", "شماره پاکت", "عیار", "وزن", "مقدار", "نرخ"
-            ]
-            for field in numeric_fields:
-                value = data_dict.get(field, "")
-                if isinstance(value, str) and value.strip() != "":
-                    try:
-                        # Try to convert to int first, then fall back to float if necessary
-                        num = int(value.replace(",", ""))
-                    except ValueError:
-                        try:
-                            num = float(value.replace(",", ""))
-                        except ValueError:
-                            num = value  # Leave as is if conversion fails
-                    data_dict[field] = num
-
-            # Create a row with values in the correct order based on headers
-            row_data = []
-            for header in HEADERS:
-                row_data.append(data_dict.get(header, ""))
-            
-            # # Add to Google Sheets
-            # worksheet.append_row(row_data)
-            # Update specific cells in the next empty row (ensure same order as HEADERS)
-            cell_range = f"A{next_row}:P{next_row}"  # A-P covers 16 columns
-            worksheet.update(cell_range, [row_data])
+            saved_row = context.user_data.get("saved_row")
+            if saved_row:
+                # Reopened saved transaction: write back only the cells that changed, off the event loop
+                # like new rows; a repeated confirm finds the row already edited and writes nothing
+                row_data = build_row_data(transaction, saved_row["values"][HEADERS.index("زمان ثبت")])
+                written = await asyncio.to_thread(update_transaction_row, saved_row["ref"], saved_row["values"], row_data)
+                _committed_keys.add(idempotency_key, saved_row["ref"])
+                await edit_card(update, context,
+                    f"{format_transaction_summary(transaction)}\n"
+                    f"✅ ویرایش {format_row_ref(saved_row['ref'])} ذخیره شد ({written} خانه تغییر کرد)."
+                )
+                finish_transaction_card(context)
+                return MAIN_MENU
 
-            await query.edit_message_text("✅ تراکنش با موفقیت در Google Sheets ذخیره شد!")
+            # Prepare the row in HEADERS order
+            row_data = build_row_data(transaction, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
             
-            # Return to main menu with buttons after successful transaction
-            await query.message.reply_text(
-                "می‌توانید تراکنش جدید ثبت کنید یا به صفحه اصلی برگردید.",
-                reply_markup=MENU_KEYBOARD
-            )
+            # Add to Google Sheets (serialized so concurrent saves never share a row); the write
+            # runs off the event loop so other chats keep being served while it waits
+            already_saved = _committed_keys.get(idempotency_key) is not None
+            await asyncio.to_thread(append_transaction_row, row_data, idempotency_key)
+            # A draft that was already saved is not counted twice in the ranking
+            if not already_saved:
+                _partner_ranking.record(update.effective_user.id, transaction.get("type", ""), [
+                    transaction.get(field) for field in ("partner_name", "giver_partner_name", "receiver_partner_name")
+                ])
+
+            # The persistent menu stays visible, so the card is the only message to update
+            await edit_card(update, context, f"{format_transaction_summary(transaction)}\n{SAVE_SUCCESS_MESSAGE}")
             
         except Exception as e:
-            logger.error(f"Error saving to Google Sheets: {e}")
-            await query.edit_message_text(f"❌ خطا در ذخیره تراکنش: {str(e)}")
+            logger.error("Error saving to Google Sheets: %s", e)
+            await edit_card(update, context, f"❌ خطا در ذخیره تراکنش: {str(e)}")
         
-        context.user_data.clear()
+        finish_transaction_card(context)
         return MAIN_MENU
     
     elif query.data == "edit":
@@ -924,7 +3876,8 @@ async def confirmation_callback(update: Update, context: ContextTypes.DEFAULT_TY
         if transaction["type"] == "دریافت":
             fields.extend(["شماره پاکت", "اسم ریگیری", "عیار", "وزن", "طرف حساب"])
         elif transaction["type"] == "پرداخت":
-            fields.extend(["عیار", "وزن", "طرف حساب"])
+            # A pack number on a payment marks that packet as paid out
+            fields.extend(["شماره پاکت", "عیار", "وزن", "طرف حساب"])
         elif transaction["type"] == "معامله":
             fields.extend(["جهت معامله", "نوع معامله", "مقدار", "نرخ", "طرف حساب"])
         elif transaction["type"] == "حواله":
@@ -941,7 +3894,7 @@ async def confirmation_callback(update: Update, context: ContextTypes.DEFAULT_TY
         
         keyboard.append([InlineKeyboardButton("بازگشت به تأیید", callback_data="back_to_confirm")])
         
-        await query.edit_message_text(
+        await update_card(update, context,
             "فیلدی که می‌خواهید ویرایش کنید را انتخاب کنید:",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
@@ -949,22 +3902,33 @@ async def confirmation_callback(update: Update, context: ContextTypes.DEFAULT_TY
         return EDIT_FIELD
     
     elif query.data == "cancel":
-        await query.edit_message_text("تراکنش لغو شد.")
+        await edit_card(update, context, "تراکنش لغو شد.")
         
-        # Return to main menu with buttons after cancellation
-        await query.message.reply_text(
-            "می‌توانید تراکنش جدید ثبت کنید یا به صفحه اصلی برگردید.",
-            reply_markup=MENU_KEYBOARD
-        )
-        
-        context.user_data.clear()
+        finish_transaction_card(context)
         return MAIN_MENU
 
 
+async def repeated_confirmation_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Answer a confirm tap for a draft that was already handled, without touching the sheet."""
+    query = update.callback_query
+    idempotency_key = query.data.replace(CB_CONFIRM, "")
+
+    if _committed_keys.get(idempotency_key) is not None:
+        await query.answer(SAVE_SUCCESS_MESSAGE)
+        try:
+            await query.edit_message_text(SAVE_SUCCESS_MESSAGE)
+        except Exception:
+            # The message already shows the success text
+            pass
+    else:
+        await query.answer("این تراکنش دیگر فعال نیست.")
+
+    return MAIN_MENU
+
 async def edit_field_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle edit field selection with appropriate buttons for certain fields."""
     query = update.callback_query
-    await query.answer()
+    await answer_query(update, context)
     
     if query.data == "back_to_confirm":
         # Go back to confirmation without changes
@@ -1000,7 +3964,7 @@ async def edit_field_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Check if this field requires buttons
     if field == "جهت معامله":
-        await query.edit_message_text(
+        await update_card(update, context,
             f"لطفا مقدار جدید برای {field} را انتخاب کنید:",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("Buy", callback_data=f"{CB_EDIT_VALUE}Buy")],
@@ -1010,7 +3974,7 @@ async def edit_field_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         return EDIT_FIELD  # Stay in EDIT_FIELD state but process value in callback
         
     elif field == "نوع معامله":
-        await query.edit_message_text(
+        await update_card(update, context,
             f"لطفا مقدار جدید برای {field} را انتخاب کنید:",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("Gold gr", callback_data=f"{CB_EDIT_VALUE}Gold gr")],
@@ -1021,8 +3985,15 @@ async def edit_field_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return EDIT_FIELD  # Stay in EDIT_FIELD state but process value in callback
     
+    elif field == "نرخ":
+        await update_card(update, context,
+            f"لطفا مقدار جدید برای {field} را وارد کنید:",
+            reply_markup=rate_suggestion_keyboard(context.user_data["transaction"], CB_EDIT_VALUE)
+        )
+        return EDIT_VALUE  # Typed rate, or a suggested one from the buttons
+    
     else:
-        await query.edit_message_text(f"لطفا مقدار جدید برای {field} را وارد کنید:")
+        await update_card(update, context, f"لطفا مقدار جدید برای {field} را وارد کنید:")
         return EDIT_VALUE  # Regular text input field
 
 async def edit_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1042,6 +4013,8 @@ async def edit_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     data_key = FIELD_MAPPING.get(field)
     if data_key:
         context.user_data["transaction"][data_key] = new_value
+    if data_key == "receipt_num":
+        warn_duplicate_receipt(update, context)
     
     # Go back to confirmation without changing description
     return await show_transaction_summary(update, context)
@@ -1049,7 +4022,7 @@ async def edit_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def edit_value_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process edited value from buttons and return to confirmation."""
     query = update.callback_query
-    await query.answer()
+    await answer_query(update, context)
     
     if query.data.startswith(CB_EDIT_VALUE):
         new_value = query.data.replace(CB_EDIT_VALUE, "")
@@ -1076,15 +4049,199 @@ async def cancel_from_any_state(update: Update, context: ContextTypes.DEFAULT_TY
     
     return MAIN_MENU
 
-def main() -> None:
-    """Run the bot."""
+async def warm_up_branch(branch: Branch) -> None:
+    """Validate one branch's sheet schema, seed its row indexes and load its partners and counters concurrently."""
+    if STORAGE_BACKEND == "sheets":
+        # The spreadsheet lookup is shared by everything below
+        await asyncio.to_thread(get_spreadsheet, branch)
+    results = await asyncio.gather(
+        # The row indexes are seeded right after the schema check, from one full read
+        asyncio.to_thread(lambda: (branch.store.ensure_loaded(), seed_row_indexes(branch))),
+        asyncio.to_thread(get_partner_names, branch),
+        asyncio.to_thread(load_document_counters, branch),
+        return_exceptions=True
+    )
+    for step, result in zip(["schema and indexes", "partners", "counters"], results):
+        if isinstance(result, Exception):
+            logger.error("Warm-up step '%s' failed for branch '%s': %s", step, branch.name, result)
+
+async def warm_up() -> None:
+    """Warm up every branch concurrently."""
+    if STORAGE_BACKEND == "sheets":
+        # Authorization is shared by all branches
+        await asyncio.to_thread(get_sheets_client)
+    results = await asyncio.gather(
+        *(warm_up_branch(branch) for branch in get_branches().values()),
+        return_exceptions=True
+    )
+    for branch, result in zip(get_branches().values(), results):
+        if isinstance(result, Exception):
+            logger.error("Warm-up failed for branch '%s': %s", branch.name, result)
+
+async def post_init(application: Application) -> None:
+    """Run the warm-up phase before polling starts and report readiness."""
+    started = time.monotonic()
+    # Stop signals start a drain instead of stopping at once; installed first so a stop during
+    # warm-up is not lost (run_polling's own handlers are turned off)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, begin_drain, application)
+    warm_up_task = asyncio.ensure_future(asyncio.wait_for(warm_up(), timeout=WARMUP_TIMEOUT))
+    application.bot_data["warm_up_task"] = warm_up_task
+    try:
+        await warm_up_task
+    except asyncio.CancelledError:
+        if application.drain_started is None:
+            raise
+        # begin_drain() cancelled the warm-up; run_polling() shuts down on SystemExit
+        raise SystemExit(0)
+    except asyncio.TimeoutError:
+        logger.warning("Warm-up did not finish within %ss; remaining data will load on first use", WARMUP_TIMEOUT)
+    except Exception as e:
+        logger.error("Warm-up failed, data will load on first use: %s", e)
+    application.bot_data["first_response_logged"] = False
+    start_background_task(partner_flush_loop())
+    if RECONCILE_INTERVAL_HOURS > 0:
+        start_background_task(reconcile_loop(application))
+    logger.info(
+        "Bot ready: warm-up took %.2fs, %.2fs since process start",
+        time.monotonic() - started, time.monotonic() - PROCESS_START
+    )
+
+async def partner_flush_loop() -> None:
+    """Periodically write queued partner names in one batched update."""
+    while True:
+        await asyncio.sleep(PARTNER_FLUSH_INTERVAL)
+        await asyncio.to_thread(flush_partner_queue)
+
+async def reconcile_loop(application: Application) -> None:
+    """Reconcile the ledgers whenever the interval has passed and report differences to the admin chat."""
+    while True:
+        if reconciliation_due():
+            report = await asyncio.to_thread(reconcile_ledgers)
+            if report:
+                await send_admin_report(application.bot, report)
+        await asyncio.sleep(600)
+
+def start_background_task(coroutine) -> asyncio.Task:
+    """Start a periodic loop that is cancelled when the bot drains.
+
+    Application.create_task() tasks are awaited by Application.stop(), which
+    would never return for an endless loop.
+    """
+    task = asyncio.create_task(coroutine)
+    _background_tasks.append(task)
+    return task
+
+def cancel_background_tasks() -> None:
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+
+class DrainingApplication(Application):
+    """Application that counts the updates being handled, so a shutdown can report what it drained."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.in_flight = 0
+        self.handled = 0
+        self.drain_started = None
+
+    async def process_update(self, update: object) -> None:
+        self.in_flight += 1
+        try:
+            await super().process_update(update)
+        finally:
+            self.in_flight -= 1
+            self.handled += 1
+
+    def drain_status(self) -> str:
+        return f"{self.in_flight} updates in flight, {self.update_queue.qsize()} queued"
+
+def begin_drain(application: DrainingApplication) -> None:
+    """Stop taking new updates and let in-flight and queued ones finish before shutting down.
+
+    Updates not yet fetched stay with Telegram and are delivered after the restart.
+    """
+    if application.drain_started is not None:
+        return
+    application.drain_started = (time.monotonic(), application.handled)
+    logger.info("Stop signal received; draining %s (up to %ss)", application.drain_status(), DRAIN_TIMEOUT)
+    cancel_background_tasks()
+    watchdog = threading.Timer(DRAIN_TIMEOUT, drain_deadline_exceeded, args=(application,))
+    watchdog.daemon = True
+    watchdog.start()
+    application.bot_data["drain_watchdog"] = watchdog
+    warm_up_task = application.bot_data.get("warm_up_task")
+    if warm_up_task is not None and not warm_up_task.done():
+        # Polling has not started yet; post_init() stops the bot once the warm-up is cancelled
+        warm_up_task.cancel()
+    # run_polling() then stops the updater and calls Application.stop(), which handles the queued updates
+    application.stop_running()
+
+def drain_deadline_exceeded(application: DrainingApplication) -> None:
+    """Runs on a timer thread: save what can be saved and exit before the platform kills the process."""
+    logger.error("Drain did not finish within %ss; exiting with %s", DRAIN_TIMEOUT, application.drain_status())
+    try:
+        # Drafts changed since the last persistence update would otherwise be lost
+        _shared_store.set_many("user_data", {str(user_id): data for user_id, data in dict(application.user_data).items()})
+    except Exception as e:
+        logger.error("Could not save user data before exiting: %s", e)
+    flush_partner_queue()
+    stop_logging()
+    logging.shutdown()
+    os._exit(1)
+
+def log_drain(application: DrainingApplication) -> None:
+    if application.drain_started is None:
+        return
+    started, handled = application.drain_started
+    logger.info(
+        "Drained %d updates in %.2fs; %s left",
+        application.handled - handled, time.monotonic() - started, application.drain_status()
+    )
+
+async def post_shutdown(application: Application) -> None:
+    """Write anything still queued before the process exits."""
+    await asyncio.to_thread(flush_partner_queue)
+    watchdog = application.bot_data.pop("drain_watchdog", None)
+    if watchdog is not None:
+        watchdog.cancel()
+    log_drain(application)
+
+async def log_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Log how long after process start the first update was handled."""
+    if not context.bot_data.get("first_response_logged", True):
+        context.bot_data["first_response_logged"] = True
+        logger.info("First update received %.2fs after process start", time.monotonic() - PROCESS_START)
+
+def build_application(store: SharedStore, worker: bool = False) -> Application:
+    """Create the Application with all handlers; workers get updates from the router instead of polling."""
     # Create the Application and pass it your bot's token
-    application = Application.builder().token(os.getenv('TELEGRAM_TOKEN')).build()
+    builder = (Application.builder().application_class(DrainingApplication)
+               .token(os.getenv('TELEGRAM_TOKEN')).persistence(SQLitePersistence(store)))
+    if worker:
+        builder = builder.updater(None)
+    else:
+        builder = builder.post_init(post_init).post_shutdown(post_shutdown)
+    application = builder.build()
+
+    # Measure time-to-first-response after a restart
+    application.add_handler(TypeHandler(Update, log_first_update), group=-1)
+
+    # Pick the branch ledger before any other handler runs
+    application.add_handler(TypeHandler(Update, route_to_branch), group=-2)
+
+    # Track activity so idle drafts can be closed
+    application.add_handler(TypeHandler(Update, track_draft_activity), group=-3)
 
     # Add conversation handler with states
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("start", start),
+            CommandHandler(list(QUICK_ENTRY_COMMANDS), quick_entry),
+            CommandHandler("edit", edit_saved_transaction),
+            CallbackQueryHandler(resume_draft_callback, pattern=f"^{CB_RESUME_DRAFT}$"),
             MessageHandler(filters.Regex("^(🚀 شروع|🆕 تراکنش جدید|❌ انصراف|🏠 بازگشت به صفحه اصلی)$"), handle_main_menu)
         ],
         states={
@@ -1102,6 +4259,7 @@ def main() -> None:
                 MessageHandler(filters.Regex("^🆕 تراکنش جدید$"), new_transaction)
             ],
             PACK_NUM: [
+                CallbackQueryHandler(skip_pack_num_callback, pattern=f"^{CB_SKIP_PACK}$"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex("^(❌ انصراف|🏠 بازگشت به صفحه اصلی|🆕 تراکنش جدید)$"), pack_num),
                 MessageHandler(filters.Regex("^(❌ انصراف|🏠 بازگشت به صفحه اصلی)$"), handle_main_menu),
                 MessageHandler(filters.Regex("^🆕 تراکنش جدید$"), new_transaction)
@@ -1146,6 +4304,7 @@ def main() -> None:
                 MessageHandler(filters.Regex("^🆕 تراکنش جدید$"), new_transaction)
             ],
             RATE: [
+                CallbackQueryHandler(rate_callback, pattern=f"^{CB_RATE}"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex("^(❌ انصراف|🏠 بازگشت به صفحه اصلی|🆕 تراکنش جدید)$"), rate),
                 MessageHandler(filters.Regex("^(❌ انصراف|🏠 بازگشت به صفحه اصلی)$"), handle_main_menu),
                 MessageHandler(filters.Regex("^🆕 تراکنش جدید$"), new_transaction)
@@ -1174,7 +4333,8 @@ def main() -> None:
                 MessageHandler(filters.Regex("^🆕 تراکنش جدید$"), new_transaction)
             ],
             CONFIRMATION: [
-                CallbackQueryHandler(confirmation_callback),
+                CallbackQueryHandler(confirmation_callback, pattern=f"^({CB_CONFIRM}|edit$|cancel$)"),
+                CallbackQueryHandler(basket_add_callback, pattern=f"^{CB_BASKET_ADD}$"),
                 MessageHandler(filters.Regex("^(❌ انصراف|🏠 بازگشت به صفحه اصلی)$"), handle_main_menu),
                 MessageHandler(filters.Regex("^🆕 تراکنش جدید$"), new_transaction)
             ],
@@ -1198,19 +4358,244 @@ def main() -> None:
                     lambda u, c: handle_partner_selection(u, c, "receiver_partner_name"), 
                     pattern=f"^{CB_RECEIVER_PARTNER}"
                 ),
+                CallbackQueryHandler(edit_value_callback, pattern=f"^{CB_EDIT_VALUE}"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex("^(❌ انصراف|🏠 بازگشت به صفحه اصلی|🆕 تراکنش جدید)$"), edit_value),
                 MessageHandler(filters.Regex("^(❌ انصراف|🏠 بازگشت به صفحه اصلی)$"), handle_main_menu),
                 MessageHandler(filters.Regex("^🆕 تراکنش جدید$"), new_transaction)
             ],
+            # Drafts left idle for DRAFT_IDLE_MINUTES are parked when the conversation times out
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, draft_timeout)]
                     },
-        fallbacks=[CommandHandler("cancel", cancel_from_any_state)],
-        allow_reentry=True
+        fallbacks=[
+            CommandHandler("cancel", cancel_from_any_state),
+            CallbackQueryHandler(repeated_confirmation_callback, pattern=f"^{CB_CONFIRM}"),
+            CallbackQueryHandler(show_duplicate_receipt_callback, pattern=f"^{CB_SHOW_DUPLICATE}$")
+        ],
+        allow_reentry=True,
+        conversation_timeout=DRAFT_IDLE_MINUTES * 60 or None,
+        name="transaction_conversation",
+        persistent=True
     )
 
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("apicalls", api_calls_command))
+    application.add_handler(CommandHandler("drafts", drafts_command))
+    application.add_handler(CommandHandler("asof", asof_command))
+    application.add_handler(CommandHandler("backfill", backfill_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("basket", basket_command))
+    application.add_handler(CommandHandler("packets", packets_command))
+    application.add_handler(CommandHandler("settle", settle_command))
+    application.add_handler(CallbackQueryHandler(
+        basket_callback, pattern=f"^({CB_BASKET_COMMIT}|{CB_BASKET_COMMIT_FORCE}|{CB_BASKET_CLEAR})$"))
+    application.add_handler(CallbackQueryHandler(history_page_callback, pattern=f"^{CB_HISTORY}"))
+    return application
+
+def worker_for_update(update: Update, worker_count: int) -> int:
+    """Pick the worker for an update by chat ID so a conversation always stays on one worker."""
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    return key % worker_count
+
+def ignore_stop_signals() -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def run_sheets_writer(requests, reply_queues, state_db_path: str, ready) -> None:
+    """Single-writer process: every Sheets write from every worker is applied here in order."""
+    global _shared_store, _publish_rows
+    # Keep writing until the router sends the stop request after the workers have drained
+    # Spawned processes don't run main(), so each one sets up its own logging
+    setup_logging()
+    ignore_stop_signals()
+    _shared_store = SharedStore(state_db_path)
+    _publish_rows = True
+
+    try:
+        asyncio.run(warm_up())
+    except Exception as e:
+        logger.error("Sheets writer warm-up failed: %s", e)
+    publish_shared_caches()
+    ready.set()
+    logger.info("Sheets writer ready")
+
+    operations = {
+        "append_transaction": lambda payload: append_transaction_row(
+            payload["row"], payload["idempotency_key"], get_branch(payload["branch"])),
+        "add_partner": lambda payload: add_partner_name_to_sheet(payload["name"], get_branch(payload["branch"])),
+        "append_transactions": lambda payload: append_transaction_rows(
+            payload["rows"], payload["idempotency_keys"], get_branch(payload["branch"])),
+        "backfill_derived": lambda payload: backfill_derived_step(get_branch(payload["branch"]), payload["cursor"]),
+        "read_row": lambda payload: read_saved_row(payload["row_ref"], get_branch(payload["branch"])),
+        "update_transaction": lambda payload: update_transaction_row(
+            payload["row_ref"], payload["original"], payload["row"], get_branch(payload["branch"])),
+    }
+    while True:
+        try:
+            request = requests.get(timeout=PARTNER_FLUSH_INTERVAL)
+        except queue.Empty:
+            flush_partner_queue()
+            if reconciliation_due():
+                report = reconcile_ledgers()
+                if report:
+                    asyncio.run(report_from_writer(report))
+            continue
+        except KeyboardInterrupt:
+            continue
+        if request is None:
+            break
+        op, request_id, worker_index, payload = request
+        try:
+            reply = (request_id, True, operations[op](payload))
+        except Exception as e:
+            logger.error("Sheets writer failed on '%s': %s", op, e)
+            reply = (request_id, False, str(e))
+        reply_queues[worker_index].put(reply)
+
+        if op in ("append_transaction", "append_transactions", "update_transaction"):
+            # Saves moved the cached document counters; hand them to every worker without another read
+            publish_shared_caches()
+        if any(branch.partner_index.flush_due(PARTNER_FLUSH_INTERVAL) for branch in get_branches().values()):
+            flush_partner_queue()
+
+    flush_partner_queue()
+    logger.info("Sheets writer stopped")
+
+async def report_from_writer(text: str) -> None:
+    async with Bot(os.getenv('TELEGRAM_TOKEN')) as bot:
+        await send_admin_report(bot, text)
+
+async def serve_worker(worker_index: int, updates, store: SharedStore) -> None:
+    """Feed routed updates into this worker's Application until the router stops."""
+    application = build_application(store, worker=True)
+    # Build the row indexes from the rows the writer mirrored into the shared store
+    for branch in get_branches().values():
+        refresh_row_indexes(branch)
+    application.bot_data["worker_slot"] = (worker_index, BOT_WORKERS)
+    async with application:
+        await application.start()
+        logger.info("Worker %d ready", worker_index)
+        while True:
+            data = await asyncio.to_thread(updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        # The router has stopped: finish the routed updates, then persist
+        application.drain_started = (time.monotonic(), application.handled)
+        logger.info("Worker %d draining %s", worker_index, application.drain_status())
+        cancel_background_tasks()
+        await application.stop()
+        log_drain(application)
+    logger.info("Worker %d stopped", worker_index)
+
+def run_bot_worker(worker_index: int, updates, writer_requests, writer_replies, state_db_path: str) -> None:
+    """Worker process entry point."""
+    global _shared_store, _sheets_writer
+    # The router coordinates shutdown; it stops sending updates and then tells the worker to drain
+    setup_logging()
+    ignore_stop_signals()
+    _shared_store = SharedStore(state_db_path)
+    _sheets_writer = SheetsWriterClient(writer_requests, writer_replies, worker_index)
+    try:
+        asyncio.run(serve_worker(worker_index, updates, _shared_store))
+    except KeyboardInterrupt:
+        pass
+
+async def route_updates(update_queues) -> None:
+    """Long-poll Telegram once and distribute updates to the workers by chat ID."""
+    async with Bot(os.getenv('TELEGRAM_TOKEN')) as bot:
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logger.error("Error fetching updates: %s", e)
+                await asyncio.sleep(3)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                update_queues[worker_for_update(update, len(update_queues))].put(update.to_dict())
+
+def run_multi_process(worker_count: int) -> None:
+    """Run one router, one Sheets writer and N bot workers."""
+    # SIGTERM stops the start-up or polling the same way Ctrl+C does; the workers and the
+    # writer ignore it and drain
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    ctx = multiprocessing.get_context("spawn")
+    writer_requests = ctx.Queue()
+    writer_replies = [ctx.Queue() for _ in range(worker_count)]
+    update_queues = [ctx.Queue() for _ in range(worker_count)]
+    writer_ready = ctx.Event()
+
+    writer = ctx.Process(
+        target=run_sheets_writer,
+        args=(writer_requests, writer_replies, STATE_DB_PATH, writer_ready),
+        name="sheets-writer"
+    )
+    workers = []
+    writer.start()
+    try:
+        if not writer_ready.wait(WARMUP_TIMEOUT):
+            logger.warning("Sheets writer not ready after %ss; starting workers anyway", WARMUP_TIMEOUT)
+        for i in range(worker_count):
+            worker = ctx.Process(
+                target=run_bot_worker,
+                args=(i, update_queues[i], writer_requests, writer_replies[i], STATE_DB_PATH),
+                name=f"bot-worker-{i}"
+            )
+            worker.start()
+            workers.append(worker)
+        logger.info(
+            "Bot ready with %d workers, %.2fs since process start",
+            worker_count, time.monotonic() - PROCESS_START
+        )
+        asyncio.run(route_updates(update_queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Workers started so far drain their updates, then the writer its queued writes
+        drain_processes(workers, update_queues, writer, writer_requests)
+
+def drain_processes(workers, update_queues, writer, writer_requests) -> None:
+    """Let the workers finish their routed updates, then the writer its queued writes, within DRAIN_TIMEOUT."""
+    started = time.monotonic()
+    deadline = started + DRAIN_TIMEOUT
+    logger.info("Draining %d workers (up to %ss)", len(workers), DRAIN_TIMEOUT)
+    for update_queue in update_queues:
+        update_queue.put(None)
+    for worker in workers:
+        worker.join(max(deadline - time.monotonic(), 0))
+    # Writes sent by draining workers are queued ahead of the writer's stop request
+    writer_requests.put(None)
+    writer.join(max(deadline - time.monotonic(), 0))
+
+    unfinished = [process for process in workers + [writer] if process.is_alive()]
+    for process in unfinished:
+        logger.error("%s did not drain within %ss; terminating it", process.name, DRAIN_TIMEOUT)
+        process.terminate()
+    logger.info(
+        "Drain finished in %.2fs, %d of %d processes stopped cleanly",
+        time.monotonic() - started, len(workers) + 1 - len(unfinished), len(workers) + 1
+    )
+
+def main() -> None:
+    """Run the bot."""
+    # Logging is configured here rather than on import, so importing the module has no side effects
+    setup_logging()
+    if BOT_WORKERS > 1:
+        run_multi_process(BOT_WORKERS)
+        return
+
+    global _shared_store
+    _shared_store = SharedStore(STATE_DB_PATH)
+    application = build_application(_shared_store)
 
-    # Start the Bot
-    application.run_polling()
+    # Start the Bot; stop signals are handled by begin_drain (installed in post_init)
+    application.run_polling(stop_signals=None)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
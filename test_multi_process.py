@@ -0,0 +1,347 @@
+"""Multi-process deployment tests: router, bot workers and the Sheets writer.
+
+The processes are started the way run_multi_process() starts them, but the
+writer talks to an in-memory spreadsheet and the workers' Telegram calls are
+answered locally, so the tests need no network access. Both sides can be
+given a simulated latency to measure how throughput scales with workers.
+"""
+import asyncio
+import json
+import multiprocessing
+import re
+import time
+import types
+
+import gspread
+from telegram import Bot, Update, User
+from telegram.ext import ExtBot
+
+import Moein_Balance as M
+
+CHATS = [101, 102, 103, 104]
+TRANSACTIONS_PER_CHAT = 3
+# Simulated round trip of one Sheets request, set in the writer process
+API_LATENCY = 0.0
+
+
+def a1_to_cell(a1: str) -> tuple:
+    """(row, column) of an A1 reference such as "B12"; the row is None for whole columns."""
+    letters, digits = re.match(r"([A-Z]+)(\d*)", a1).groups()
+    column = 0
+    for letter in letters:
+        column = column * 26 + ord(letter) - 64
+    return (int(digits) if digits else None), column
+
+
+def call_api() -> None:
+    time.sleep(API_LATENCY)
+
+
+class FakeWorksheet:
+    def __init__(self, title: str, rows=None, cols: int = 26):
+        self.title = title
+        self.rows = [list(row) for row in rows or []]
+        self.row_count = 1000
+        self.col_count = cols
+
+    def cell(self, row: int, column: int):
+        if row <= len(self.rows) and column <= len(self.rows[row - 1]):
+            return self.rows[row - 1][column - 1]
+        return ""
+
+    def set(self, row: int, column: int, value) -> None:
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        cells.extend([""] * (column - len(cells)))
+        cells[column - 1] = value
+
+    def write(self, a1: str, values) -> None:
+        row, column = a1_to_cell(a1.split(":")[0])
+        for i, cells in enumerate(values):
+            for j, value in enumerate(cells):
+                self.set(row + i, column + j, value)
+
+    def read(self, a1_range: str) -> list:
+        start, _, end = a1_range.partition(":")
+        first_row, first_column = a1_to_cell(start)
+        last_row, last_column = a1_to_cell(end or start)
+        last_row = min(last_row or len(self.rows), len(self.rows))
+        values = [[self.cell(r, c) for c in range(first_column, last_column + 1)]
+                  for r in range(first_row or 1, last_row + 1)]
+        # Like the Sheets API, trailing empty rows are left out
+        while values and not any(str(value) for value in values[-1]):
+            values.pop()
+        return values
+
+    def get_all_values(self):
+        call_api()
+        return [[str(value) for value in row] for row in self.rows]
+
+    def row_values(self, row: int):
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, column: int):
+        return [self.cell(row, column) for row in range(1, len(self.rows) + 1)]
+
+    def update(self, a1: str, values) -> None:
+        call_api()
+        self.write(a1, values)
+
+    def batch_get(self, ranges):
+        call_api()
+        return [self.read(a1_range) for a1_range in ranges]
+
+    def add_cols(self, count: int) -> None:
+        self.col_count += count
+
+    def add_rows(self, count: int) -> None:
+        self.row_count += count
+
+    def delete_row(self, row: int) -> None:
+        del self.rows[row - 1]
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.worksheets = {
+            "GreenLand": FakeWorksheet("GreenLand", [["A", "B", "C", "نام مشتری"], ["0", "0", "0", "علی"]])
+        }
+
+    def worksheet(self, title: str):
+        if title not in self.worksheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title: str, rows: int, cols: int, **kwargs):
+        self.worksheets[title] = FakeWorksheet(title, cols=cols)
+        return self.worksheets[title]
+
+    @staticmethod
+    def split_range(a1_range: str) -> tuple:
+        title, _, cells = a1_range.rpartition("!")
+        return title.strip("'"), cells
+
+    def values_get(self, a1_range: str, params=None):
+        call_api()
+        title, cells = self.split_range(a1_range)
+        return {"values": self.worksheets[title].read(cells)}
+
+    def values_batch_update(self, body):
+        call_api()
+        for data in body["data"]:
+            title, cells = self.split_range(data["range"])
+            self.worksheets[title].write(cells, data["values"])
+
+
+class FakeClient:
+    def __init__(self, spreadsheet: FakeSpreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_key(self, key: str):
+        return self.spreadsheet
+
+
+def run_fake_writer(requests, reply_queues, state_db_path: str, ready, dump_path: str, api_latency: float) -> None:
+    """Writer process against an in-memory spreadsheet, dumped to JSON once it stops."""
+    global API_LATENCY
+    API_LATENCY = api_latency
+    spreadsheet = FakeSpreadsheet()
+    M._sheets_client = FakeClient(spreadsheet)
+    M.run_sheets_writer(requests, reply_queues, state_db_path, ready)
+    with open(dump_path, "w", encoding="utf-8") as f:
+        json.dump({title: worksheet.rows for title, worksheet in spreadsheet.worksheets.items()}, f, ensure_ascii=False)
+
+
+def answer_telegram_locally(latency: float, events, cards) -> None:
+    """Replace the Telegram calls the handlers make with local answers after `latency` seconds.
+
+    The time of every answered call is put on `events`, after a "ready" event
+    at start-up, and the confirm button of every card sent or edited on `cards`.
+    """
+    message_ids = iter(range(1000, 10**6))
+
+    def answered(chat_id=None, reply_markup=None) -> None:
+        events.put(time.time())
+        for row in getattr(reply_markup, "inline_keyboard", ()):
+            for button in row:
+                if str(button.callback_data).startswith(M.CB_CONFIRM):
+                    cards.put((chat_id, button.callback_data))
+
+    async def initialize(self):
+        self._bot_user = User(1, "bot", True, username="test_bot")
+        events.put("ready")
+
+    async def shutdown(self):
+        pass
+
+    async def send_message(self, chat_id, text, *args, reply_markup=None, **kwargs):
+        await asyncio.sleep(latency)
+        answered(chat_id, reply_markup)
+        return types.SimpleNamespace(chat_id=chat_id, message_id=next(message_ids))
+
+    async def edit_message_text(self, text, chat_id=None, *args, reply_markup=None, **kwargs):
+        await asyncio.sleep(latency)
+        answered(chat_id, reply_markup)
+        return True
+
+    async def answer_callback_query(self, *args, **kwargs):
+        await asyncio.sleep(latency)
+        answered()
+        return True
+
+    ExtBot.initialize = initialize
+    ExtBot.shutdown = shutdown
+    ExtBot.send_message = send_message
+    ExtBot.edit_message_text = edit_message_text
+    ExtBot.answer_callback_query = answer_callback_query
+
+
+def run_fake_worker(worker_index: int, updates, writer_requests, writer_replies, state_db_path: str,
+                    telegram_latency: float, events, cards) -> None:
+    answer_telegram_locally(telegram_latency, events, cards)
+    M.run_bot_worker(worker_index, updates, writer_requests, writer_replies, state_db_path)
+
+
+def chat_script(chat: int, confirm_data: list):
+    """Updates one chat sends, yielding None while it waits for the bot's next card.
+
+    Per transaction: a quick-entry receipt, then its confirm tapped twice
+    with the key from the card. From the second transaction on, the previous
+    card's confirm is tapped once more first, while the new draft waits.
+    """
+    user = {"id": chat, "is_bot": False, "first_name": f"user{chat}"}
+    chat_data = {"id": chat, "type": "private"}
+
+    def tap(data: str, tap_id: str) -> dict:
+        return {"callback_query": {
+            "id": f"{chat}-{tap_id}", "from": user, "chat_instance": str(chat), "data": data,
+            "message": {"message_id": 1000, "date": 0, "chat": chat_data}
+        }}
+
+    for k in range(TRANSACTIONS_PER_CHAT):
+        text = f"/r {chat * 100 + k} 5 name 750 10 علی"
+        yield {"message": {
+            "message_id": k, "date": 0, "chat": chat_data, "from": user, "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": 2}]
+        }}
+        while len(confirm_data) <= k:
+            yield None
+        if k:
+            yield tap(confirm_data[k - 1], f"{k}-stale")
+        for repeat in range(2):
+            yield tap(confirm_data[k], f"{k}-{repeat}")
+
+
+async def route_scripted_updates(update_queues, cards, monkeypatch) -> None:
+    """Run the real router against a fake getUpdates until every scripted update was handed out."""
+    confirm_data = {chat: [] for chat in CHATS}
+    scripts = {chat: chat_script(chat, confirm_data[chat]) for chat in CHATS}
+    update_ids = iter(range(1, 10**6))
+    delivered = asyncio.Event()
+
+    async def get_updates(self, offset=None, **kwargs):
+        while not cards.empty():
+            chat, data = cards.get()
+            if data not in confirm_data[chat]:
+                confirm_data[chat].append(data)
+        batch = []
+        for chat, script in list(scripts.items()):
+            for data in script:
+                if data is None:
+                    break
+                batch.append(Update.de_json(dict(data, update_id=next(update_ids)), None))
+            else:
+                del scripts[chat]
+        if not scripts:
+            delivered.set()
+        if not batch:
+            await asyncio.sleep(0.01)
+        return batch
+
+    async def noop(self, *args, **kwargs):
+        pass
+
+    monkeypatch.setattr(Bot, "initialize", noop)
+    monkeypatch.setattr(Bot, "shutdown", noop)
+    monkeypatch.setattr(Bot, "get_updates", get_updates)
+    router = asyncio.create_task(M.route_updates(update_queues))
+    await asyncio.wait_for(delivered.wait(), timeout=60)
+    router.cancel()
+
+
+def run_deployment(tmp_path, monkeypatch, worker_count: int, telegram_latency: float = 0.0,
+                   api_latency: float = 0.0) -> tuple:
+    """Route the scripted updates through a writer and `worker_count` workers.
+
+    Returns the final spreadsheet and the seconds from routing the first
+    update to the last Telegram call the workers made.
+    """
+    monkeypatch.setenv("TELEGRAM_TOKEN", "123:test")
+    monkeypatch.setenv("SPREADSHEET_KEY", "test-key")
+    monkeypatch.setenv("BOT_WORKERS", str(worker_count))
+    monkeypatch.setenv("RECONCILE_INTERVAL_HOURS", "0")
+    monkeypatch.setenv("DRAFT_RESUME_PROMPT", "0")
+    monkeypatch.setattr(M, "DRAIN_TIMEOUT", 60)
+    state_db_path = str(tmp_path / f"state-{worker_count}.sqlite3")
+    dump_path = str(tmp_path / f"sheets-{worker_count}.json")
+
+    ctx = multiprocessing.get_context("spawn")
+    writer_requests = ctx.Queue()
+    writer_replies = [ctx.Queue() for _ in range(worker_count)]
+    update_queues = [ctx.Queue() for _ in range(worker_count)]
+    events = ctx.Queue()
+    cards = ctx.Queue()
+    writer_ready = ctx.Event()
+    writer = ctx.Process(target=run_fake_writer,
+                         args=(writer_requests, writer_replies, state_db_path, writer_ready, dump_path, api_latency))
+    writer.start()
+    assert writer_ready.wait(60)
+    workers = [
+        ctx.Process(target=run_fake_worker,
+                    args=(i, update_queues[i], writer_requests, writer_replies[i], state_db_path,
+                          telegram_latency, events, cards))
+        for i in range(worker_count)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        # Start the clock once every worker is up, so start-up time is not measured
+        for _ in range(worker_count):
+            assert events.get(timeout=60) == "ready"
+        started = time.time()
+        asyncio.run(route_scripted_updates(update_queues, cards, monkeypatch))
+    finally:
+        M.drain_processes(workers, update_queues, writer, writer_requests)
+
+    assert writer.exitcode == 0 and all(worker.exitcode == 0 for worker in workers)
+    finished = started
+    while not events.empty():
+        finished = max(finished, events.get())
+    with open(dump_path, encoding="utf-8") as f:
+        return json.load(f), finished - started
+
+
+def test_workers_share_one_writer_without_reordering_or_double_writes(tmp_path, monkeypatch):
+    sheets, _ = run_deployment(tmp_path, monkeypatch, 2)
+    partitions = [title for title in sheets if title.startswith("Transactions")]
+    rows = [row for title in sorted(partitions) for row in sheets[title][1:]]
+    receipts = [int(row[M.HEADERS.index("شماره سند")]) for row in rows]
+
+    # Every confirmed transaction was written exactly once, despite the repeated and stale taps
+    assert sorted(receipts) == sorted(chat * 100 + k for chat in CHATS for k in range(TRANSACTIONS_PER_CHAT))
+    # Each chat's transactions kept the order they were sent in
+    for chat in CHATS:
+        assert [r for r in receipts if r // 100 == chat] == [chat * 100 + k for k in range(TRANSACTIONS_PER_CHAT)]
+    # The partition index counts every written row
+    counts = {row[0]: int(row[3]) for row in sheets[M.PARTITION_INDEX_SHEET][1:] if row}
+    assert sum(counts[title] for title in partitions) == len(rows)
+
+
+def test_throughput_scales_with_workers(tmp_path, monkeypatch):
+    # Telegram round trips dominate a handler; the single writer only adds the Sheets requests
+    _, one_worker = run_deployment(tmp_path, monkeypatch, 1, telegram_latency=0.05, api_latency=0.005)
+    _, four_workers = run_deployment(tmp_path, monkeypatch, len(CHATS), telegram_latency=0.05, api_latency=0.005)
+    print(f"1 worker: {one_worker:.2f}s, {len(CHATS)} workers: {four_workers:.2f}s")
+    # Each chat has its own worker, so the ideal is a quarter of the time; allow for the shared writer
+    assert four_workers < one_worker / 2
@@ -0,0 +1,48 @@
+"""Block fingerprints used by reconciliation must change on any manual edit of a cell."""
+import Moein_Balance as M
+
+
+def saved_block() -> dict:
+    """A block of saved rows (row number -> values), as the bot writes them."""
+    rows = {}
+    for row_number in range(2, 7):
+        row = dict.fromkeys(M.HEADERS, "")
+        row.update({
+            "نوع تراکنش": "دریافت", "تاریخ": f"2026-10-{row_number:02d}", "شماره سند": str(4100 + row_number),
+            "عیار": 750, "وزن": 1.5, "طرف حساب": "علی", "توضیحات": "نقد",
+        })
+        rows[row_number] = [row[header] for header in M.HEADERS]
+    return rows
+
+
+def edited(rows: dict, row_number: int, header: str, value) -> dict:
+    rows = {n: list(values) for n, values in rows.items()}
+    rows[row_number][M.HEADERS.index(header)] = value
+    return rows
+
+
+def test_equal_length_edits_change_the_fingerprint():
+    rows = saved_block()
+    original = M.block_fingerprint(rows)
+    for header, value in [
+        ("تاریخ", "2026-10-14"),   # dates are fixed-width text
+        ("شماره سند", "4140"),     # digits swapped in 4104
+        ("طرف حساب", "رضا"),       # another name of the same length
+    ]:
+        changed = M.block_fingerprint(edited(rows, 4, header, value))
+        assert changed != original, header
+        assert changed[2] == original[2]
+
+
+def test_moving_a_value_between_rows_changes_the_fingerprint():
+    rows = saved_block()
+    swapped = edited(edited(rows, 2, "تاریخ", rows[3][1]), 3, "تاریخ", rows[2][1])
+    assert M.block_fingerprint(swapped) != M.block_fingerprint(rows)
+
+
+def test_fingerprint_matches_the_sheet_values():
+    rows = saved_block()
+    expected = M.block_fingerprint(rows)
+    # The checksum sheet returns plain numbers for the three formulas
+    assert M.fingerprints_match(expected, [expected[0], expected[1], expected[2]])
+    assert not M.fingerprints_match(expected, [(expected[0] + 1) % M.FINGERPRINT_MODULUS, expected[1], expected[2]])